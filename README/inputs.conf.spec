@@ -6,11 +6,51 @@ server = <string>
 * (required)
 timeline = <string>
 * Timeline id from QuoLab
+* Only one input per server and websocket_engine may subscribe to a given
+* timeline; other inputs for the same timeline are skipped with an error.
 * (required)
 backfill = <bool>
 * If enabled, the first run will retrieve all existing events from the queue
 * Default: True
 * (optional)
+batch_max_events = <int>
+* Maximum number of events written to Splunk at once
+* Default: 100
+* (optional)
+batch_max_bytes = <int>
+* Maximum size (in bytes) of the events written to Splunk at once
+* Default: 1048576
+* (optional)
+batch_max_latency = <float>
+* Maximum time (in seconds) an event is held back while building a batch
+* Default: 1.0
+* (optional)
+checkpoint_fsync = <string>
+* When the ids of ingested events are synced to disk.  'always' syncs after
+  every event, 'batch' after each batch of events, and 'never' leaves it to
+  the operating system.
+* Choices: always, batch, never
+* Default: batch
+* (optional)
+queue_size = <int>
+* Number of received events held in memory while waiting to be written to
+  Splunk.  Once full, more events are spilled to disk (next to the
+  checkpoint) and read back in order.
+* Default: 1024
+* (optional)
+queue_spill_max_bytes = <int>
+* Maximum size (in bytes) of the events spilled to disk.  Once reached,
+  receiving events waits for the queue to drain.  0 disables spilling.
+* Default: 1073741824
+* (optional)
+websocket_engine = <string>
+* How the websocket connection for this input is run.  'thread' runs each
+  connection in its own threads.  'asyncio' runs all connections on one
+  shared event loop, which has less overhead for many timelines.
+* Inputs for the same server and engine share one websocket connection.
+* Choices: thread, asyncio
+* Default: thread
+* (optional)
 log_level = <string>
 * Logging level for internal logging
 * Choices: DEBUG, INFO, WARN, ERROR
@@ -21,10 +21,96 @@ max_batch_size = <int>
 * Number of catalog items to fetch per HTTP call
 * Default: 500
 * (required)
+min_batch_size = <int>
+* Number of catalog items to fetch in the first HTTP call of a query.  Later
+  calls grow toward 'max_batch_size' as long as responses are fast and small
+  enough, and shrink again for slow or heavy responses (such as queries with
+  the 'document' facet).  Set equal to 'max_batch_size' to always use a fixed
+  batch size.
+* Default: 50
+* (optional)
 max_execution_time = <int>
 * The longest duration in seconds that any individual query may last.
 * Default: 300
 * (required)
+prefetch_depth = <int>
+* Number of catalog result pages to fetch ahead (in a background thread) while
+  the current page is being processed.  Set to 0 to fetch pages serially.
+* Default: 2
+* (optional)
+id_batch_size = <int>
+* Maximum number of ids to include in a single catalog query.  Longer id lists
+  (for example, from a subsearch) are split into multiple queries that are run
+  concurrently and then merged back together based on 'order'.
+  Set to 0 to disable splitting.
+* Default: 200
+* (optional)
+max_concurrency = <int>
+* Maximum number of catalog queries to run concurrently against this server.
+* Default: 4
+* (optional)
+max_count = <int>
+* Maximum number of objects that 'quolabquery count=true' will count.
+* Counting is not done on the QuoLab server.  Every matching object is fetched
+  (only its id and grouping fields) and counted by the search command, so a
+  count costs a full scan of the matching objects, up to this many.  Larger
+  values mean longer running searches.  A warning is shown when the count
+  reaches this limit.
+* Default: 100000
+* (optional)
+cache_ttl = <int>
+* Number of seconds that catalog query results are kept in the on-disk cache
+  located in $SPLUNK_HOME/var/run/splunk/quolab/catalog_cache/<stanza>.
+  Identical queries (same type, ids, facets, order, ...) sent to this server
+  within this window are returned from the cache without contacting the API.
+  Use the 'cache' option of 'quolabquery' to bypass or refresh the cache.
+  Set to 0 to disable caching.
+* Default: 0
+* (optional)
+cache_max_size_mb = <int>
+* Maximum size of the on-disk cache for this server.  The least recently used
+  entries are removed once this size is exceeded.
+* Default: 256
+* (optional)
+lookup_cache_size = <int>
+* Number of ids (found or not) that 'quolablookup' remembers within a single
+  search, so that values repeated across events are only queried once.
+* Default: 10000
+* (optional)
+http_pool_connections = <int>
+* Number of connection pools to cache (one pool is used per host).
+* Default: 10
+* (optional)
+http_pool_maxsize = <int>
+* Maximum number of connections to keep open (for reuse) to the server.  This
+  should be at least 'max_concurrency'.
+* Default: 10
+* (optional)
+http_keep_alive = <bool>
+* Keep HTTP connections open so they can be reused for subsequent requests.
+* Default: True
+* (optional)
+http_compression = <bool>
+* Ask the server for compressed (gzip or deflate) responses.
+* Default: True
+* (optional)
+tcp_nodelay = <bool>
+* Disable Nagle's algorithm (TCP_NODELAY) on connections to the server.
+* Default: True
+* (optional)
+max_retries = <int>
+* Number of times a catalog query request is retried after a transient failure
+  (connection error, timeout, truncated response, or 5xx server error).
+  Retries use exponential backoff and resume from the last page received.
+  No retries are attempted after the query's overall time limit (10 times
+  'max_execution_time') has been reached.
+* Default: 5
+* (optional)
+tcp_keepalive = <bool>
+* Enable TCP keep-alive probes (SO_KEEPALIVE) on connections to the server.
+  This can help long-running queries through firewalls that drop idle connections.
+* Default: False
+* (optional)
 disabled = <bool>
 * Toggle configuration entry status
 * Default: False
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))  # nopep8
+
+from splunklib.searchcommands import (Configuration, Option, StreamingCommand,
+                                      dispatch, validators)
+from ta_quolab import __version__
+from ta_quolab.cache import LRUCache
+from ta_quolab.const import facets, quolab_class_from_type, quolab_types
+from ta_quolab.searchcommand import QuoLabServerMixin, apply_projection, field_param_regex
+from ta_quolab.stats import QueryStats, monotonic
+from ta_quolab.workers import fan_out
+
+
+@Configuration(distributed=False)
+class QuoLabLookupCommand(QuoLabServerMixin, StreamingCommand):
+    """
+    ##Syntax
+
+    .. code-block::
+        quolablookup type=X field=Y [facets=...] [fields=...] [prefix=quolab.]
+
+    ##Description
+
+    Enrich events with QuoLab catalog objects whose id is found in an event
+    field.  Distinct values are looked up in batches for each chunk of events,
+    and recent results are remembered so repeated values aren't re-queried.
+
+    ##Example
+
+    .. code-block::
+        ... | quolablookup type=domain field=query facets=display,refcount
+    """
+
+    server = Option(
+        require=False,
+        default="quolab",
+        validate=validators.Match("server", r"[a-zA-Z0-9._]+"))
+
+    type = Option(
+        require=True,
+        validate=validators.Set(*quolab_types)
+    )
+
+    field = Option(
+        require=True,
+        validate=validators.Fieldname()
+    )
+
+    facets = Option(
+        require=False,
+        default=None,
+        validate=validators.List(validator=validators.Set(*facets))
+    )
+
+    fields = Option(
+        require=False,
+        default=None,
+        validate=validators.List(validators.Match(name="<field>", pattern=field_param_regex))
+    )
+
+    prefix = Option(
+        require=False,
+        default="quolab.",
+        validate=validators.Match("prefix", r"[a-zA-Z0-9._-]*"))
+
+    # Fields from results that are not copied onto events
+    skip_fields = ("_raw", "_time")
+
+    def __init__(self):
+        self.quolab_api = None
+        self.api_url = None
+        self.api_username = None
+        self.verify = True
+        self.api_fetch_count = None
+        self.api_min_fetch_count = None
+        self.api_timeout = None
+        self.api_secret = None
+        self.api_id_batch_size = 200
+        self.api_max_concurrency = 1
+        self.lookup_cache = None
+        self.lookup_stats = QueryStats()
+        super(QuoLabLookupCommand, self).__init__()
+
+    def prepare(self):
+        super(QuoLabLookupCommand, self).prepare()
+        will_execute = bool(self.metadata.searchinfo.sid and
+                            not self.metadata.searchinfo.sid.startswith("searchparsetmp_"))
+        if will_execute:
+            self.logger.info("Launching version %s", __version__)
+
+        if self.fieldnames:
+            self.write_error("The following arguments to quolablookup are "
+                             "unknown:  {!r}  Please check the syntax.", self.fieldnames)
+            sys.exit(1)
+
+        if not will_execute:
+            return
+
+        api = self.load_server()
+        self.api_id_batch_size = int(api.content.get("id_batch_size", 0)) or self.api_fetch_count
+        self.lookup_cache = LRUCache(int(api.content.get("lookup_cache_size", 10000)))
+
+    def _build_query(self, ids):
+        query = {
+            "query": {
+                "class": quolab_class_from_type[self.type],
+                "type": self.type,
+                "id": ids,
+            },
+            # A stable order keeps 'resume' paging consistent when a batch spans pages
+            "order": [["id", "ascending"]],
+        }
+        if self.facets:
+            query["facets"] = {facet: 1 for facet in self.facets}
+        if self.fields:
+            apply_projection(query, self.fields)
+        return query
+
+    def _lookup(self, values):
+        """ Return a dictionary of the fields to add for each of ``values``
+        (ids), or None for unknown values.  Values that aren't already cached
+        are queried from the QuoLab API in batches and cached. """
+        cache = self.lookup_cache
+        matches = {}
+        missing = []
+        for value in values:
+            if value in cache:
+                matches[value] = cache.get(value)
+            else:
+                missing.append(value)
+        self.lookup_stats.incr("cache_hits", len(values) - len(missing))
+        if not missing:
+            return matches
+        batch_size = self.api_id_batch_size
+        batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+
+        def run(ids):
+            stats = QueryStats()
+            results = list(self.quolab_api.query_catalog(
+                self._build_query(ids), len(ids),
+                timeout=self.api_timeout,
+                fetch_count=self.api_fetch_count,
+                min_fetch_count=self.api_min_fetch_count,
+                write_error=self.write_error,
+                write_warning=self.write_warning,
+                fields=self.fields,
+                stats=stats))
+            return ids, results, stats
+
+        for ids, results, stats in fan_out(run, batches, self.api_max_concurrency):
+            self.lookup_stats.merge(stats)
+            found = {}
+            for result in results:
+                found[result["id"]] = {self.prefix + name: value for name, value in result.items()
+                                       if name not in self.skip_fields}
+            complete = not (stats.counters["errors"] or stats.counters["expired"])
+            for value in ids:
+                match = matches[value] = found.get(value)
+                if match is not None or complete:
+                    # Unknown values are remembered too, unless the query was cut short
+                    cache[value] = match
+            self.lookup_stats.incr("lookups", len(ids))
+            self.lookup_stats.incr("found", len(found))
+        return matches
+
+    @staticmethod
+    def _enrich(record, values, lookup):
+        matches = [match for match in (lookup.get(value) for value in values) if match]
+        if not matches:
+            return
+        if len(matches) == 1:
+            record.update(matches[0])
+            return
+        # Multiple matches (multivalue input field) become multivalue output fields
+        combined = {}
+        for match in matches:
+            for name, value in match.items():
+                combined.setdefault(name, []).extend(value if isinstance(value, list) else [value])
+        record.update(combined)
+
+    @staticmethod
+    def _field_values(value):
+        if value is None or value == "":
+            return []
+        if isinstance(value, list):
+            return [v for v in value if v != ""]
+        return [value]
+
+    def stream(self, records):
+        start = monotonic()
+        # Read the whole chunk so all its distinct values can be looked up at once
+        records = list(records)
+        values = []
+        seen = set()
+        for record in records:
+            for value in self._field_values(record.get(self.field)):
+                if value not in seen:
+                    seen.add(value)
+                    values.append(value)
+        lookup = self._lookup(values)
+        for record in records:
+            self._enrich(record, self._field_values(record.get(self.field)), lookup)
+            yield record
+        self.lookup_stats.incr("events", len(records))
+        self.lookup_stats.incr("chunks")
+        self.logger.info("Lookup chunk: events=%d distinct=%d duration=%0.3f  totals: %s",
+                         len(records), len(values), monotonic() - start,
+                         self.lookup_stats.to_kv())
+
+
+if __name__ == '__main__':
+    dispatch(QuoLabLookupCommand, sys.argv, sys.stdin, sys.stdout, __name__)
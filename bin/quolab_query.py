@@ -4,25 +4,33 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import copy
 import json
 import os
 import re
 import sys
+import time
+from collections import Counter
+from itertools import islice, product
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))  # nopep8
 
-from cypresspoint.datatype import as_bool
 from cypresspoint.searchcommand import ensure_fields
-from splunklib.client import Entity, HTTPError
 from splunklib.searchcommands import (Configuration, GeneratingCommand, Option,
                                       dispatch, validators)
 from ta_quolab import __version__
-from ta_quolab.api import QuoLabAPI
+from ta_quolab.cache import CatalogCache
 from ta_quolab.const import facets, quolab_class_from_type, quolab_types
+from ta_quolab.searchcommand import QuoLabServerMixin, apply_projection, field_param_regex
+from ta_quolab.stats import QueryStats, monotonic, time_consumer, time_producer
+
+# Note:  ta_quolab.api and ta_quolab.transport (and therefore 'requests') are
+# imported by load_server() only when the search will actually execute.  Splunk
+# launches this command for parse-only runs too, where the import time is wasted.
 
 
 @Configuration()
-class QuoLabQueryCommand(GeneratingCommand):
+class QuoLabQueryCommand(QuoLabServerMixin, GeneratingCommand):
     """
     ##Syntax
 
@@ -36,6 +44,7 @@ class QuoLabQueryCommand(GeneratingCommand):
     """
 
     order_param_regex = r'^(?P<order>[+-])?(?P<field>(?:[a-z_-]+\.)*[a-z_-]+)$'
+    time_field_regex = r'^(?:[A-Za-z0-9_-]+\.)*[A-Za-z0-9_:-]+$'
 
     server = Option(
         require=False,
@@ -74,20 +83,72 @@ class QuoLabQueryCommand(GeneratingCommand):
         validate=validators.List(validator=validators.Set(*facets))
     )
 
+    cache = Option(
+        require=False,
+        default="use",
+        validate=validators.Set("use", "refresh", "bypass")
+    )
+
+    fields = Option(
+        require=False,
+        default=None,
+        validate=validators.List(validators.Match(name="<field>", pattern=field_param_regex))
+    )
+
+    time_field = Option(
+        require=False,
+        default=None,
+        validate=validators.Match("time_field", time_field_regex)
+    )
+
+    count = Option(
+        require=False,
+        default=False,
+        validate=validators.Boolean()
+    )
+
+    by = Option(
+        require=False,
+        default=None,
+        validate=validators.List(validators.Match(name="<field>", pattern=field_param_regex))
+    )
+
     # Always run on the searchhead (not the indexers)
     distributed = False
 
     # Don't allow this to run in preview mode to limit API hits
     run_in_preview = False
 
+    # Phases reported in the search job inspector:  (timer, counter of invocations)
+    stats_phases = (
+        ("http_request", "http_calls"),
+        ("http_read", "pages"),
+        ("decompress", None),
+        ("parse", "pages"),
+        ("flatten", "records"),
+        ("ensure_fields", None),
+        ("emit", "records"),
+    )
+
     def __init__(self):
         self.quolab_api = None
         self.api_url = None
         self.api_username = None
         self.verify = True
         self.api_fetch_count = None
+        self.api_min_fetch_count = None
         self.api_timeout = None
         self.api_secret = None
+        self.api_prefetch_depth = 0
+        self.api_id_batch_size = None
+        self.api_max_concurrency = 1
+        self.api_cache_ttl = 0
+        self.api_cache_max_bytes = 0
+        self.api_max_count = 100000
+        self.query_stats = None
+        self.query_fields = None
+        self.time_range = (None, None)
+        self.time_ordered = False
         super(QuoLabQueryCommand, self).__init__()
 
     def prepare(self):
@@ -107,6 +168,10 @@ class QuoLabQueryCommand(GeneratingCommand):
             self.write_error("Must provide either 'query' or 'type' but not both")
             sys.exit(1)
 
+        if self.by and not self.count:
+            self.write_error("The 'by' option can only be used with 'count=true'")
+            sys.exit(1)
+
         # Check to see if an unused arguments remain after argument parsing
         if self.fieldnames:
             self.write_error("The following arguments to quolabquery are "
@@ -117,39 +182,12 @@ class QuoLabQueryCommand(GeneratingCommand):
             # Nothing else can be done/checked in this pre-execution mode
             return
 
-        self.logger.debug("Fetching API endpoint configurations from Splunkd (quolab_servers.conf)")
-
-        # Determine name of stanza to load
-        try:
-            api = Entity(self.service, "quolab/quolab_servers/{}/full".format(self.server))
-        except HTTPError:
-            self.error_exit("No known server named '{}', check quolab_servers.conf".format(self.server),
-                            "Unknown server named '{}'.  Please update 'server=' option.".format(self.server))
-        except Exception as e:
-            self.logger.exception("Unhandled exception: ")
-            self.write_error("Aborting due to internal error:  {}", e)
-
-        self.api_url = api["url"]
-        self.api_username = api["username"]
-        self.api_fetch_count = int(api["max_batch_size"])
-        self.api_timeout = int(api["max_execution_time"])
-        self.verify = as_bool(api["verify"])
-        if not self.verify:
-            import urllib3
-            urllib3.disable_warnings()
-        self.logger.debug("Entity api: %r", self.api_url)
-        self.api_secret = api["secret"]
-        if not self.api_secret:
-            self.error_exit("Check the configuration.  Unable to fetch data "
-                            "from {} without secret.".format(self.api_url),
-                            "Missing secret.  Did you run setup?")
-
-        # Setup quolab interface
-        self.quolab_api = QuoLabAPI(self.api_url, verify=self.verify)
-        if self.api_username == "<TOKEN>":
-            self.quolab_api.login_token(self.api_secret)
-        else:
-            self.quolab_api.login(self.api_username, self.api_secret)
+        api = self.load_server()
+        self.api_prefetch_depth = int(api.content.get("prefetch_depth", 0))
+        self.api_id_batch_size = int(api.content.get("id_batch_size", 0)) or None
+        self.api_cache_ttl = int(api.content.get("cache_ttl", 0))
+        self.api_cache_max_bytes = int(api.content.get("cache_max_size_mb", 0)) * 1024 * 1024
+        self.api_max_count = int(api.content.get("max_count", self.api_max_count))
 
     @classmethod
     def _order_to_dict(cls, order_option, query):
@@ -177,18 +215,167 @@ class QuoLabQueryCommand(GeneratingCommand):
         doc = doc.setdefault("order", [])
         doc.append([".".join(field), order])
 
+    def _time_order_to_dict(self, query):
+        """ Order results by 'time_field', newest first.  Returns False if the
+        field can't be sorted on. """
+        field = self.time_field.split(".")
+        if len(field) == 1:
+            doc = query
+        elif field[0] == "document":
+            doc = query.setdefault("documents", {})
+            field.pop(0)
+        else:
+            return False
+        doc["order"] = [[".".join(field), "descending"]]
+        return True
+
+    def _search_time_range(self):
+        """ Return the search's (earliest, latest) time as epoch seconds.
+        Either is None when the time range is unbounded on that end. """
+        searchinfo = self._metadata.searchinfo
+        times = []
+        for name in ("earliest_time", "latest_time"):
+            try:
+                value = float(getattr(searchinfo, name, None) or 0)
+            except (TypeError, ValueError):
+                value = 0
+            times.append(value or None)
+        return tuple(times)
+
+    def _order_to_sort_key(self):
+        """ Return the requested 'order' as a list of (field_name, descending) tuples """
+        order = []
+        for order_option in self.order or ["id"]:
+            match = re.match(self.order_param_regex, order_option)
+            order.append((match.group("field"), match.group("order") == "-"))
+        return order
+
+    def _fields_from_search(self):
+        """ Detect which fields are used when this command is directly followed
+        by a 'table' or 'fields' command (for example: '| quolabquery ... |
+        table id document.name').  Returns None if that can't be determined. """
+        search = getattr(self._metadata.searchinfo, "search", None)
+        if not search:
+            return None
+        raw_args = getattr(self._metadata.searchinfo, "raw_args", None) or []
+        segments = self._split_pipeline(search)
+        for i, segment in enumerate(segments[:-1]):
+            words = segment.split(None, 1)
+            if not words or words[0] != "quolabquery":
+                continue
+            if not all(arg in segment for arg in raw_args):
+                # Some other use of quolabquery in the same search
+                continue
+            match = re.match(r'^\s*(table|fields)\s+(\+\s*)?([^-].*)$', segments[i + 1], re.DOTALL)
+            if not match:
+                return None
+            fields = [f.strip("\"'") for f in re.split(r"[\s,]+", match.group(3)) if f]
+            if not fields or not all(re.match(field_param_regex, f) for f in fields):
+                # Wildcards, renames and such are not supported
+                return None
+            if match.group(1) == "fields":
+                # 'fields' keeps internal fields (like _raw) unless asked otherwise
+                fields.append("_raw")
+            return fields
+        return None
+
+    @staticmethod
+    def _split_pipeline(search):
+        """ Split a search into its commands at each pipe that isn't quoted or
+        within a subsearch. """
+        segments = []
+        current = []
+        depth = 0
+        for token in re.findall(r'"(?:[^"\\]|\\.)*"?|[\[\]|]|[^"\[\]|]+', search):
+            if token == "[":
+                depth += 1
+            elif token == "]":
+                depth -= 1
+            elif token == "|" and depth == 0:
+                segments.append("".join(current).strip())
+                current = []
+                continue
+            current.append(token)
+        segments.append("".join(current).strip())
+        return segments
+
+    def _split_ids(self, query):
+        """ Split a query with a long list of ids into multiple queries, each
+        holding at most 'id_batch_size' ids.  Returns None if no split is needed. """
+        batch_size = self.api_id_batch_size
+        ids = query.get("query", {}).get("id")
+        if not batch_size or not isinstance(ids, list) or len(ids) <= batch_size:
+            return None
+        queries = []
+        for i in range(0, len(ids), batch_size):
+            q = copy.deepcopy(query)
+            q["query"]["id"] = ids[i:i + batch_size]
+            queries.append(q)
+        return queries
+
+    def _get_cache(self):
+        """ Return the on-disk catalog cache for this server, or None if disabled """
+        if self.cache == "bypass" or self.api_cache_ttl <= 0:
+            return None
+        directory = os.path.join(os.environ.get("SPLUNK_HOME", "."), "var", "run", "splunk",
+                                 "quolab", "catalog_cache", self.server)
+        return CatalogCache(directory, self.api_cache_ttl, self.api_cache_max_bytes,
+                            stats=self.query_stats)
+
     def _query_catalog(self, query, query_limit):
-        """ Handle the query to QuoLab API that drives this SPL command
+        """ Handle the query to QuoLab API that drives this SPL command.  Results
+        are served from (and saved to) the on-disk cache, when enabled.
         Returns [results]
         """
+        self.query_stats = QueryStats()
+        cache = self._get_cache()
+        if cache is None:
+            return self._query_catalog_api(query, query_limit)
+
+        key = CatalogCache.make_key(self.server, query, fields=self.query_fields,
+                                    time_field=self.time_field,
+                                    time_range=[t for t in self.time_range if t])
+        if self.cache == "use":
+            results = cache.get(key, query_limit)
+            if results is not None:
+                self.logger.info("Returning cached results for query key=%s", key)
+                return results
+        stats = self.query_stats
+        return cache.store(key, self._query_catalog_api(query, query_limit), query_limit,
+                           valid=lambda: not (stats.counters["errors"] or
+                                              stats.counters["expired"]))
+
+    def _query_catalog_api(self, query, query_limit):
+        """ Send query to the QuoLab API, splitting long id lists if necessary """
+        kwargs = dict(timeout=self.api_timeout,
+                      fetch_count=self.api_fetch_count,
+                      min_fetch_count=self.api_min_fetch_count,
+                      write_error=self.write_error,
+                      write_warning=self.write_warning,
+                      fields=self.query_fields,
+                      time_field=self.time_field,
+                      earliest=self.time_range[0],
+                      latest=self.time_range[1],
+                      default_time=False,
+                      stats=self.query_stats)
+
+        queries = self._split_ids(query)
+        if queries:
+            self.logger.info("Splitting %d ids into %d queries of up to %d ids each",
+                             len(query["query"]["id"]), len(queries), self.api_id_batch_size)
+            return self.quolab_api.query_catalog_parallel(queries, query_limit,
+                                                          order=self._order_to_sort_key(),
+                                                          max_workers=self.api_max_concurrency,
+                                                          **kwargs)
         # Return generator function
         return self.quolab_api.query_catalog(query, query_limit,
-                                             timeout=self.api_timeout,
-                                             fetch_count=self.api_fetch_count,
-                                             write_error=self.write_error)
+                                             prefetch_depth=self.api_prefetch_depth,
+                                             time_ordered=self.time_ordered,
+                                             **kwargs)
 
     def generate(self):
-        # Because the splunklib search interface does a bad job a reporting exceptions / logging stack traces :-(
+        # Because the splunklib search interface does a bad job a reporting exceptions /
+        # logging stack traces :-(
         try:
             return self._generate()
         except Exception as e:
@@ -229,8 +416,19 @@ class QuoLabQueryCommand(GeneratingCommand):
             if self.id:
                 query["query"]["id"] = self.id
 
+        self.time_range = (None, None)
+        self.time_ordered = False
+        if self.time_field:
+            self.time_range = self._search_time_range()
+            if any(self.time_range) and not self.order and "id" not in query["query"]:
+                # Newest first, so paging can stop once the search's earliest time is passed
+                self.time_ordered = self._time_order_to_dict(query)
+            time_facet = self.time_field.split(".", 1)[0]
+            if time_facet in facets:
+                query.setdefault("facets", {})[time_facet] = 1
+
         # Build 'order' structure.   Defaults to 'id' to enable pagination
-        for order in self.order or ["id"]:
+        for order in self.order or ([] if self.time_ordered else ["id"]):
             try:
                 self._order_to_dict(order, query)
             except ValueError as e:
@@ -244,10 +442,109 @@ class QuoLabQueryCommand(GeneratingCommand):
             for facet in self.facets:
                 query_facets[facet] = 1
 
-        self.write_info("Query sent to {} server: {}", self.server, json.dumps(query))
-        results = self._query_catalog(query, self.limit)
+        if self.count:
+            # Only the grouping fields are needed; no facets unless 'by' refers to them
+            self.query_fields = list(self.by or ["id"])
+            apply_projection(query, self.query_fields +
+                             ([self.time_field] if self.time_field else []))
+            self.write_info("Query sent to {} server (results are counted here): {}",
+                            self.server, json.dumps(query))
+            self.query_stats = QueryStats()
+            return self._emit(self._count_catalog(query))
+
+        self.query_fields = self.fields
+        if self.query_fields is None:
+            self.query_fields = self._fields_from_search()
+            if self.query_fields:
+                self.logger.info("Using fields from the search:  %s", ",".join(self.query_fields))
+        if self.query_fields:
+            if self.time_field:
+                apply_projection(query, list(self.query_fields) + [self.time_field])
+            else:
+                apply_projection(query, self.query_fields)
 
-        return ensure_fields(results)
+        self.write_info("Query sent to {} server: {}", self.server, json.dumps(query))
+        results = self._stamp_time(self._query_catalog(query, self.limit))
+
+        # ensure_fields() reads all results up front; don't count that against it
+        stats = self.query_stats
+        start = monotonic()
+        results = ensure_fields(time_producer(results, stats, "fetch"))
+        stats.add_time("ensure_fields", monotonic() - start - stats.timers["fetch"])
+        return self._emit(results)
+
+    @staticmethod
+    def _stamp_time(results):
+        """ Set '_time' to now on results without a timestamp (from 'time_field').
+        This is done on the way out, so cached results don't replay the time
+        they were first fetched. """
+        for result in results:
+            if "_time" not in result:
+                result["_time"] = time.time()
+            yield result
+
+    def _count_catalog(self, query):
+        """ Count the objects matching ``query``.  The API has no way to count
+        on the server side, so (projected) objects are fetched and counted
+        here, up to the server's 'max_count'. """
+        # One extra object tells whether there are more than can be counted
+        results = self._query_catalog_api(query, self.api_max_count + 1)
+        results = time_producer(results, self.query_stats, "fetch")
+        rows = self._count_results(islice(results, self.api_max_count))
+        if any(True for _ in results):
+            self.write_warning("Only the first {} objects were counted.  Increase 'max_count' "
+                               "for server {} to count more.", self.api_max_count, self.server)
+        return rows
+
+    def _count_results(self, results):
+        """ Count ``results`` grouped by the values of the 'by' fields, most
+        common first.  Multivalue fields count towards each of their values,
+        like 'stats count by' does. """
+        fields = self.by or []
+        counts = Counter()
+        for result in results:
+            values = []
+            for field in fields:
+                value = result.get(field)
+                values.append(value if isinstance(value, list) else [value])
+            for group in product(*values):
+                counts[group] += 1
+        if not fields and not counts:
+            counts[()] = 0
+        rows = []
+        for group, count in counts.most_common():
+            row = {field: value for field, value in zip(fields, group) if value is not None}
+            row["count"] = count
+            rows.append(row)
+        return rows
+
+    def _emit(self, results):
+        """ Yield results to Splunk, then report query statistics """
+        for result in time_consumer(results, self.query_stats, "emit"):
+            yield result
+        self._report_stats()
+
+    def _report_stats(self):
+        """ Publish per-phase timers and counters to the search job (as an
+        info message and inspector metrics) and to the log. """
+        stats = self.query_stats
+        counters, timers = stats.counters, stats.timers
+        duration = stats.duration
+        self.logger.info("Query stats: server=%s mode=%s limit=%d prefetch_depth=%d "
+                         "duration=%0.3f %s", self.server, self.mode, self.limit,
+                         self.api_prefetch_depth, duration, stats.to_kv())
+        self.write_info("QuoLab query stats:  records={} duration={:0.3f}s network={:0.3f}s "
+                        "parse={:0.3f}s flatten={:0.3f}s ensure_fields={:0.3f}s emit={:0.3f}s "
+                        "http_calls={} pages={} retries={} bytes={}",
+                        counters["records"], duration,
+                        timers["http_request"] + timers["http_read"], timers["parse"],
+                        timers["flatten"], timers["ensure_fields"], timers["emit"],
+                        counters["http_calls"], counters["pages"], counters["retries"],
+                        counters["bytes"])
+        for phase, counter in self.stats_phases:
+            self.write_metric("quolabquery.{}".format(phase),
+                              (timers[phase], counters[counter] if counter else None,
+                               None, None))
 
 
 if __name__ == '__main__':
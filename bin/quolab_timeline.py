@@ -5,15 +5,14 @@ Modular Input for QuoLab timeline activity stream indexing
 from __future__ import absolute_import, print_function, unicode_literals
 
 import functools
-import json
 import os
+import random
 import sys
 import threading
 import time
-from collections import Counter
-from datetime import timedelta
+from collections import Counter, OrderedDict
 from logging import getLogger, Formatter
-from queue import Empty, Queue
+from queue import Empty
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))  # noqa
 
@@ -24,9 +23,15 @@ from cypresspoint.checkpoint import ModInputCheckpoint
 from cypresspoint.datatype import as_bool
 from cypresspoint.modinput import ScriptWithSimpleSecret
 from splunklib.client import Entity, HTTPError
-from splunklib.modularinput import Argument, Event, Scheme  # nopqa
+from splunklib.modularinput import Argument, Scheme  # nopqa
 
-from ta_quolab.api import QuoLabAPI, __version__, monotonic
+from ta_quolab.api import QuoLabAPI, TimelineCursor, __version__, monotonic, record_time
+from ta_quolab.checkpoint import EventIdJournal, fsync_policies
+from ta_quolab.dedupe import DedupeIndex
+from ta_quolab.eventwriter import BatchEventWriter
+from ta_quolab.jsonstream import append_fields
+from ta_quolab.spillqueue import SpillQueue
+from ta_quolab.transport import transport_options
 
 logger = getLogger("QuoLab.Input.Timeline")
 
@@ -56,20 +61,24 @@ def counter_to_kv(c):
     return " ".join("{}={}".format(k, v) for k, v in c.items())
 
 
-# Track if subscribing binding has been completed or not.
-subscribed = threading.Event()
+websocket_engines = ("thread", "asyncio")
+
+# Set to stop all inputs (and websocket reconnects) in this process
 shutdown = threading.Event()
 
 
 class QuoLabTimelineModularInput(ScriptWithSimpleSecret):
-
-    # XXX: Make this a configurable parameter
-    queue_size = 1024
+    # Reconnect delay (seconds) doubles per failed attempt, up to the max.  A
+    # connection that stayed up for 'reconnect_reset' seconds starts over.
+    reconnect_delay = 1.0
+    reconnect_delay_max = 60.0
+    reconnect_reset = 300.0
 
     def get_scheme(self):
         scheme = Scheme("QuoLab Timeline")
         scheme.description = "Ingest QuoLab timeline using Web Sockets"
-        scheme.use_single_instance = False
+        # One process handles all inputs, sharing API sessions and websockets
+        scheme.use_single_instance = True
         scheme.use_external_validation = True
 
         scheme.add_argument(
@@ -92,6 +101,48 @@ class QuoLabTimelineModularInput(ScriptWithSimpleSecret):
                      description="If enabled, the first run will retrieve all existing events from the queue",
                      data_type=Argument.data_type_boolean,
                      ))
+        scheme.add_argument(
+            Argument("checkpoint_fsync",
+                     title="Checkpoint fsync policy",
+                     description="When ingested event ids are synced to disk:  always, batch, or never",
+                     data_type=Argument.data_type_string,
+                     ))
+        scheme.add_argument(
+            Argument("batch_max_events",
+                     title="Batch size",
+                     description="Maximum number of events written to Splunk at once",
+                     data_type=Argument.data_type_number,
+                     ))
+        scheme.add_argument(
+            Argument("batch_max_bytes",
+                     title="Batch bytes",
+                     description="Maximum size (in bytes) of events written to Splunk at once",
+                     data_type=Argument.data_type_number,
+                     ))
+        scheme.add_argument(
+            Argument("batch_max_latency",
+                     title="Batch latency",
+                     description="Maximum time (in seconds) an event is held back to build a batch",
+                     data_type=Argument.data_type_string,
+                     ))
+        scheme.add_argument(
+            Argument("queue_size",
+                     title="Queue size",
+                     description="Number of received events held in memory before spilling to disk",
+                     data_type=Argument.data_type_number,
+                     ))
+        scheme.add_argument(
+            Argument("queue_spill_max_bytes",
+                     title="Queue spill limit",
+                     description="Maximum size (in bytes) of events spilled to disk.  0 disables spilling",
+                     data_type=Argument.data_type_number,
+                     ))
+        scheme.add_argument(
+            Argument("websocket_engine",
+                     title="Websocket engine",
+                     description="How websocket connections are run:  thread or asyncio",
+                     data_type=Argument.data_type_string,
+                     ))
         scheme.add_argument(
             Argument("log_level",
                      title="Log_level",
@@ -129,33 +180,329 @@ class QuoLabTimelineModularInput(ScriptWithSimpleSecret):
         if params["log_level"] not in valid_log_level_values:
             raise ValueError("Unexpected value for 'log_level'. "
                              "Please pick from {}".format(" ".join(valid_log_level_values)))
+        for name in ("batch_max_events", "batch_max_bytes", "batch_max_latency"):
+            value = params.get(name)
+            try:
+                if value and float(value) <= 0:
+                    raise ValueError
+            except ValueError:
+                raise ValueError("'{}' must be a positive number".format(name))
+        for name in ("queue_size", "queue_spill_max_bytes"):
+            value = params.get(name)
+            try:
+                if value and int(value) < (1 if name == "queue_size" else 0):
+                    raise ValueError
+            except ValueError:
+                raise ValueError("'{}' must be a {} integer".format(
+                    name, "positive" if name == "queue_size" else "non-negative"))
+        if params.get("websocket_engine", "thread") not in websocket_engines:
+            raise ValueError("Unexpected value for 'websocket_engine'. "
+                             "Please pick from {}".format(" ".join(websocket_engines)))
+        if params.get("checkpoint_fsync", "batch") not in fsync_policies:
+            raise ValueError("Unexpected value for 'checkpoint_fsync'. "
+                             "Please pick from {}".format(" ".join(fsync_policies)))
+
+    def connect_server(self, server_name):
+        """ Return a logged in QuoLabAPI for a quolab_servers.conf stanza, or
+        None if the server isn't known. """
+        server = self.fetch_quolab_servers(server_name)
+        if not server:
+            return None
+        api = QuoLabAPI(server["url"], verify=as_bool(server["verify"]))
+        api.configure_transport(**transport_options(server.content))
+        if server["username"] == "<TOKEN>":
+            api.login_token(server["secret"])
+        else:
+            api.login(server["username"], server["secret"])
+        return api
+
+    @classmethod
+    @log_exception
+    def websocket_reader(cls, api, timeline_inputs, engine="thread"):
+        """ Subscribe to all timelines of ``timeline_inputs`` (which share
+        ``api``) over one websocket.  Whenever the websocket is closed, it's
+        reopened (with backoff) until shutdown, or until none of the inputs
+        are ingesting events any more. """
+        bindings = [(ti.timeline, ti.put_event_queue, ti.out_of_band, ti.facets)
+                    for ti in timeline_inputs]
+
+        def stopping():
+            return shutdown.is_set() or all(ti.ingest_stopped() for ti in timeline_inputs)
+
+        attempt = 0
+        while not stopping():
+            logger.info("Starting websocket listening for %d timeline(s) on %s....  "
+                        "engine=%s attempt=%d", len(timeline_inputs), api.url, engine, attempt)
+            connected = monotonic()
+            qws = api.subscribe_timelines(bindings, engine=engine)
+            while not qws.is_done.wait(1) and not stopping():
+                pass
+            if stopping():
+                qws.close()
+                break
+
+            if monotonic() - connected >= cls.reconnect_reset:
+                attempt = 0
+            delay = min(cls.reconnect_delay_max, cls.reconnect_delay * 2 ** attempt)
+            delay *= random.uniform(0.5, 1.0)
+            attempt += 1
+            for ti in timeline_inputs:
+                ti.counter["websocket_reconnects"] += 1
+            logger.warning("Websocket to %s closed.  Reconnecting in %0.1f seconds (attempt=%d)",
+                           api.url, delay, attempt)
+            resume = monotonic() + delay
+            while not stopping() and monotonic() < resume:
+                shutdown.wait(min(1.0, resume - monotonic()))
+        if not shutdown.is_set():
+            logger.error("Ingestion stopped for all %d timeline(s) on %s.  Websocket closed",
+                         len(timeline_inputs), api.url)
+
+    def group_inputs(self, inputs, checkpoint_dir):
+        """ Create a :class:`TimelineInput` for each input, and group them by
+        (server, websocket engine).  Each group shares one API session and one
+        websocket.  Returns an OrderedDict of lists of inputs. """
+        # All quolab_timeline:// stanzas are handled by this one process.  Inputs
+        # for the same server share one API session, and one websocket per engine.
+        apis = {}
+        inputs_by_server = OrderedDict()
+        for input_name, input_item in six.iteritems(inputs.inputs):
+            # FOR DEVELOPMENT -- Risks sensitive data leaks
+            # logger.info("input_item :   %s", input_item)
+            # logger.info("inputs.metadata :   %s", inputs.metadata)
+            ti = TimelineInput(input_name, input_item, checkpoint_dir)
+
+            # Load reference content from quolab_servers.conf
+            if ti.server_name not in apis:
+                apis[ti.server_name] = self.connect_server(ti.server_name)
+            ti.api = apis[ti.server_name]
+            if not ti.api:
+                # Skip current input due to reference failure
+                continue
+
+            group = inputs_by_server.setdefault((ti.server_name, ti.websocket_engine), [])
+            # A websocket routes events by timeline, so it can't carry two
+            # subscriptions to the same one
+            duplicate = [other.name for other in group if other.timeline == ti.timeline]
+            if duplicate:
+                logger.error('Skipping input input_name="%s":  timeline=%s on server=%s is '
+                             'already ingested by input_name="%s"', input_name, ti.timeline,
+                             ti.server_name, duplicate[0])
+                continue
+
+            logger.info('Processing input input_name="%s" app=%s ta_version=%s '
+                        'server=%s', input_name, ti.app, __version__, ti.api.url)
+            ti.open_checkpoint()
+            group.append(ti)
+        return inputs_by_server
+
+    def stream_events(self, inputs, ew):
+        # Workaround for Splunk SDK's poor modinput error capturing.  Logging enhancement
+        try:
+            self._stream_events(inputs, ew)
+        except Exception:
+            logger.exception("Exception while trying to stream events.")
+            sys.exit(1)
+
+    def _stream_events(self, inputs, ew):
+        checkpoint_dir = inputs.metadata.get("checkpoint_dir")
+        self.lifetime_counter = Counter()
+
+        inputs_by_server = self.group_inputs(inputs, checkpoint_dir)
+        timeline_inputs = [ti for tis in inputs_by_server.values() for ti in tis]
+        for ti in timeline_inputs:
+            ti.start_backfill()
+
+        # XXX: Technically, there's a race-condition here.
+        # Q:  Should the websocket stream should be established before the backfill?
+        # A:  Per Fred/Tiago:  YES
+        # Doh, there is still a race condition.  Because we don't known exactly when the websocket is subscribed
+
+        # XXX: Not sure why calling this function directly doesn't seem to work; but the thread approach works
+        for (server_name, engine), tis in inputs_by_server.items():
+            threading.Thread(target=self.websocket_reader, args=(tis[0].api, tis, engine)).start()
+
+        # Each input drains its own queue; their batches share the output stream
+        write_lock = threading.Lock()
+        ingest_threads = []
+        for ti in timeline_inputs:
+            t = ti.ingest_thread = threading.Thread(target=ti.ingest, args=(ew, write_lock),
+                                                    name="ingest-{}".format(ti.timeline))
+            t.start()
+            ingest_threads.append(t)
+
+        try:
+            while not shutdown.is_set() and any(t.is_alive() for t in ingest_threads):
+                shutdown.wait(1)
+        except (KeyboardInterrupt, SystemExit) as e:
+            # Note that using 'get()' in python 2.7 and on Windows, this get() with timeout may not be interuptable
+            # See https://docs.python.org/3/library/queue.html#queue.Queue.get the implications are not clear to me
+            # Just existing the above loop is good enough
+            logger.info("Exiting loop due to %s", e)
+        finally:
+            # Also stops the websocket readers (and backfills) if every ingest thread died
+            shutdown.set()
+
+        for t in ingest_threads:
+            t.join()
+        for ti in timeline_inputs:
+            self.lifetime_counter += ti.counter
+
+        if self.lifetime_counter["inputs_processed"] > 1:
+            logger.info("Modular input shutting down.  Lifetime stats:  %s",
+                        counter_to_kv(self.lifetime_counter))
+
+
+class TimelineInput(object):
+    """ Ingestion of one quolab_timeline:// stanza.  Each input has its own
+    queue, event id journal, counters, and batch writer. """
+
+    queue_size = 1024
+    queue_spill_max_bytes = 1024 ** 3
+    history_size = 10000
+    maint_interval = 30
+    # After a reconnect, backfill events this many seconds older than the
+    # last one received, to allow for events arriving out of order
+    gap_overlap = 60
+
+    def __init__(self, name, item, checkpoint_dir):
+        self.name = name
+        self.checkpoint_dir = checkpoint_dir
+        # Monkey patch!
+        self.app = item["__app"]
+        self.server_name = item['server']
+        self.timeline = item['timeline']
+        self.backfill = as_bool(item['backfill'])
+        self.checkpoint_fsync = item.get('checkpoint_fsync') or "batch"
+        self.websocket_engine = item.get('websocket_engine') or "thread"
+        self.batch_max_events = int(item.get('batch_max_events') or 100)
+        self.batch_max_bytes = int(item.get('batch_max_bytes') or 1048576)
+        self.batch_max_latency = float(item.get('batch_max_latency') or 1.0)
+        self.queue_size = int(item.get('queue_size') or self.queue_size)
+        spill_max_bytes = item.get('queue_spill_max_bytes')
+        if spill_max_bytes not in (None, ""):
+            self.queue_spill_max_bytes = int(spill_max_bytes)
+        self.log_level = item['log_level']
+
+        # XXX: Add these as param :=)
+        self.facets = ["display"]
+
+        self.api = None
+        self.journal = None
+        self.known_ids = None
+        self.load_from_buffer = True
+
+        # Q:  is a counter thread safe?
+        # A:  Kinda, thread-safe enough.  It's subclass of dict so that helps, but
+        #     d[x] += 1 is NOT threadsafe in general, but if we avoid updating the
+        #     same key multiples places, that should be safe.  To put this in
+        #     perspective, worse case is an invalid count, so an acceptable risk.
+        self.counter = Counter(inputs_processed=1)
+
+        # Use queue to safely manage work from backfill websocket streams.  When
+        # ingestion falls behind, events spill to disk rather than blocking the
+        # websocket.
+        self.queue = SpillQueue(self.queue_size, checkpoint_dir, name,
+                                self.queue_spill_max_bytes, counter=self.counter)
+
+        # Track if subscribing binding has been completed or not.
+        self.subscribed = threading.Event()
+        self.bound_count = 0
+        # Newest timestamp of a streamed event (or time of first binding)
+        self.last_event_time = None
+        # Thread running ingest(), once started
+        self.ingest_thread = None
+
+    def ingest_stopped(self):
+        """ Has this input's ingest thread exited (normally or not)? """
+        return self.ingest_thread is not None and not self.ingest_thread.is_alive()
 
     @staticmethod
+    def load_event_ids(checkpoint_dir, input_name, history_size, fsync="batch"):
+        """ Open the event id journal for an input, and load the ids of
+        previously ingested events.  Ids are migrated from the older JSON
+        checkpoint the first time.  Returns (journal, known_ids, first_run) """
+        journal = EventIdJournal(checkpoint_dir, input_name, fsync=fsync)
+        known_ids = DedupeIndex(history_size)
+        if journal.exists():
+            journal.load(known_ids)
+            logger.info("Loaded %d event ids from %s", len(known_ids), journal.path)
+            return journal, known_ids, False
+
+        cp = ModInputCheckpoint(checkpoint_dir, input_name)
+        cp.load()
+        event_ids = cp.get("event_ids", None)
+        if event_ids is None:
+            return journal, known_ids, True
+        for event_id in event_ids:
+            known_ids.add(event_id)
+        journal.compact(known_ids.to_list())
+        logger.info("Migrated %d event ids from %s to %s",
+                    len(known_ids), cp.filename, journal.path)
+        return journal, known_ids, False
+
+    def open_checkpoint(self):
+        # Keep track of which event ids have been previously loaded
+        self.journal, self.known_ids, first_run = self.load_event_ids(
+            self.checkpoint_dir, self.name, self.history_size, self.checkpoint_fsync)
+        if first_run:
+            if self.backfill:
+                logger.info("[%s] First run.  Will backfill with events from queue.", self.name)
+            else:
+                logger.info("[%s] First run.  Skipping backfill.", self.name)
+                self.load_from_buffer = False
+
+    def start_backfill(self):
+        if self.load_from_buffer:
+            threading.Thread(target=self.backfill_reader).start()
+
+    def start_gap_backfill(self):
+        """ Backfill only the events that may have been missed while the
+        websocket was down """
+        since = self.last_event_time - self.gap_overlap
+        logger.info("[%s] Backfilling events since %0.3f", self.name, since)
+        threading.Thread(target=self.backfill_reader, kwargs={"since": since}).start()
+
     @log_exception
-    def backfill_reader(api, timeline, queue, facets, counter, retry=0):
-        """ This will be launched in its own thread. """
+    def backfill_reader(self, retry=0, since=None, cursor=None):
+        """ This will be launched in its own thread.  Events already in
+        ``known_ids`` are dropped here, rather than after being queued.  If
+        ``since`` is given, so are events with an older timestamp.  A retry
+        continues from ``cursor``, rather than from the start of the buffer. """
+        counter = self.counter
+        source = "backfill" if since is None else "gap_backfill"
+        if cursor is None:
+            cursor = TimelineCursor()
         logger.info("backfill thread activated.  Waiting for subscription event.")
-        wait_return = subscribed.wait(100)
+        wait_return = self.subscribed.wait(100)
         logger.info("backfill thread subscription received. return=%r", wait_return)
 
         # XXX: We likely don't need this anymore?
         time.sleep(.5)
         logger.info("Reading from the queue to backfill missing events")
         try:
-            for body in api.get_timeline_events(timeline, facets):
-                queue.put(("backfill", body["id"], body))
-                counter["backfill_queued"] += 1
+            for body, raw in self.api.get_timeline_events(self.timeline, self.facets, raw=True,
+                                                          cursor=cursor):
+                if since is not None:
+                    timestamp = record_time(body, ["timestamp"])
+                    if timestamp is not None and timestamp < since:
+                        counter["gap_backfill_older"] += 1
+                        continue
+                if body["id"] in self.known_ids:
+                    counter["{}_skipped".format(source)] += 1
+                    continue
+                self.queue.put((source, body["id"], raw))
+                counter["{}_queued".format(source)] += 1
         except Exception:
-            logger.exception("Failed to retrieve all backfill events.")
+            logger.exception("Failed to retrieve all backfill events.  records_received=%d",
+                             cursor.count)
 
             # XXX: Experimental attempt to workaround this an elusive issue
             if retry <= 3:
                 retry += 1
                 logger.info("Will attempt to re-run the backfill (retry=%d)", retry)
                 time.sleep(5)
-                threading.Thread(target=QuoLabTimelineModularInput.backfill_reader,
-                                 args=(api, timeline, queue, facets, counter),
-                                 kwargs={"retry": retry}).start()
+                threading.Thread(target=self.backfill_reader,
+                                 kwargs={"retry": retry, "since": since, "cursor": cursor}).start()
                 return
 
         # We can't easily determine how many events were written vs skipped, without waiting for the queue to drain
@@ -164,215 +511,126 @@ class QuoLabTimelineModularInput(ScriptWithSimpleSecret):
         while timeout > 0:
             time.sleep(1)
             timeout -= 1
-            if queue.empty():
+            if self.queue.empty():
                 # There's still a race condition here :-(   there could be a gap between queue.get() in the receiver
                 time.sleep(1)
                 break
 
-        logger.info("Loaded %d of %d events from queue buffer.  %d skipped  quiesce_time_s=%d attempt=%d",
-                    counter["backfill_ingested"],
-                    counter["backfill_queued"],
-                    counter["backfill_skipped"],
+        logger.info("Loaded %d of %d events from queue buffer.  %d skipped  quiesce_time_s=%d "
+                    "attempt=%d source=%s pages=%d http_retries=%d",
+                    counter["{}_ingested".format(source)],
+                    counter["{}_queued".format(source)],
+                    counter["{}_skipped".format(source)],
                     timeout_limit - timeout,
-                    retry)
+                    retry, source, cursor.pages, cursor.retries)
 
-    @staticmethod
     @log_exception
-    def websocket_reader(api, timeline, queue, facets, counter):
-        global shutdown
-
-        @log_exception
-        def put_event_queue(record):
-            body = record["body"]
-            event_id = body["id"]
-            queue.put(("websocket", event_id, body))
-            counter["websocket_queued"] += 1
-
-        @log_exception
-        def out_of_band(type, *info):
-            if type == "bound":
-                logger.info("OOB Callback:  Triggering backfill")
-                subscribed.set()
-            elif type == "error":
-                logger.info("OOB Callback:  Error encountered:  %s", info)
-            elif type == "close":
-                logger.info("OOB Callback:  Close socket")
-
-        logger.info("Starting websocket listening....")
-        ws = api.subscribe_timeline(put_event_queue, out_of_band, timeline, facets)
-        shutdown = ws.is_done
-        logger.info("Registed shutdown event")
-
-    def stream_events(self, inputs, ew):
-        # Workaround for Splunk SDK's poor modinput error capturing.  Logging enhancement
-        try:
-            self._stream_events(inputs, ew)
-        except Exception:
-            logger.exception("Exception while trying to stream events.")
-            sys.exit(1)
-
-    def _stream_events(self, inputs, ew):
-        checkpoint_dir = inputs.metadata.get("checkpoint_dir")
-        self.lifetime_counter = Counter()
-
-        # XXX: Make this check more 'official' and drop the loop below / dedent.
-        # One input is fundamental limitation of this design at this point.
-        if len(inputs.inputs) != 1:
-            raise AssertionError("Expecting exactly 1 input!")
-
-        for input_name, input_item in six.iteritems(inputs.inputs):
-            # Q:  is a counter thread safe?
-            # A:  Kinda, thread-safe enough.  It's subclass of dict so that helps, but
-            #     d[x] += 1 is NOT threadsafe in general, but if we avoid updating the
-            #     same key multiples places, that should be safe.  To put this in
-            #     perspective, worse case is an invalid count, so an acceptable risk.
-            counter = Counter(inputs_processed=1)
-
-            # FOR DEVELOPMENT -- Risks sensitive data leaks
-            # logger.info("input_item :   %s", input_item)
-            # logger.info("inputs.metadata :   %s", inputs.metadata)
-
-            # Monkey patch!
-            app = input_item["__app"]
-
-            server = input_item['server']
-            timeline = input_item['timeline']
-            backfill = as_bool(input_item['backfill'])
-            history_size = 10000
-
-            # XXX: Add these as param :=)
-            facets = ["display"]
-            # stats_interval = 300
-
-            log_level = input_item['log_level']
-
-            # Load reference content from quolab_servers.conf
-            server = self.fetch_quolab_servers(server)
-            if not server:
-                # Skip current input due to reference failure
-                continue
-            api_url = server["url"]
-            api_username = server["username"]
-            api_secret = server["secret"]
-            api_verify = as_bool(server["verify"])
+    def put_event_queue(self, record, raw_body):
+        event_id = record["body"]["id"]
+        timestamp = record_time(record["body"], ["timestamp"])
+        if timestamp is not None and (self.last_event_time is None or
+                                      timestamp > self.last_event_time):
+            self.last_event_time = timestamp
+        self.queue.put(("websocket", event_id, raw_body))
+        self.counter["websocket_queued"] += 1
 
-            logger.info('Processing input input_name="%s" app=%s ta_version=%s '
-                        'server=%s', input_name, app, __version__, api_url)
-            cp = ModInputCheckpoint(checkpoint_dir, input_name)
-            cp.load()
-            cp.dump_after_updates = 50
-
-            # Use queue to safely manage work from backfill websocket streams
-            queue = Queue(self.queue_size)
-
-            api = QuoLabAPI(api_url, verify=api_verify)
-            if api_username == "<TOKEN>":
-                api.login_token(api_secret)
+    @log_exception
+    def out_of_band(self, type, *info):
+        if type == "bound":
+            self.bound_count += 1
+            self.subscribed.set()
+            if self.bound_count == 1:
+                logger.info("OOB Callback:  Triggering backfill for timeline=%s", self.timeline)
+                if self.last_event_time is None:
+                    self.last_event_time = time.time()
             else:
-                api.login(api_username, api_secret)
-
-            load_from_buffer = True
-            backfill_thread = None
-
-            # Keep track of which event ids have been previously loaded
-            known_ids = cp.get("event_ids", [])
-            if known_ids is None:
-                if backfill:
-                    logger.info("First run.  Will backfill with events from queue.")
-                else:
-                    logger.info("First run.  Skipping backfill.")
-                    load_from_buffer = False
-
-            if load_from_buffer:
-                backfill_thread = threading.Thread(target=self.backfill_reader,
-                                                   args=(api, timeline, queue, facets, counter))
-                backfill_thread.start()
-
-            # XXX: Technically, there's a race-condition here.
-            # Q:  Should the websocket stream should be established before the backfill?
-            # A:  Per Fred/Tiago:  YES
-            # Doh, there is still a race condition.  Because we don't known exactly when the websocket is subscribed
-
-            # XXX: Not sure why calling this function directly doesn't seem to work; but the thread approach works
-            # self.websocket_reader(api, timeline, queue, facets, counter)
-            websocket_thread = threading.Thread(target=self.websocket_reader,
-                                                args=(api, timeline, queue, facets, counter))
-            websocket_thread.start()
-
-            maint_interval = 30
-            dump_max_interval = timedelta(seconds=45)
-            next_maint = monotonic() + maint_interval
-
-            # XXX:  For debugging where duplicates are comming from
-            PID = os.getpid()
-            EVENT_ID = 0
-
-            # Fetch queued events and send them to Splunk
+                logger.info("OOB Callback:  Rebound timeline=%s", self.timeline)
+                self.start_gap_backfill()
+        elif type == "error":
+            # The websocket is reopened by websocket_reader()
+            logger.info("OOB Callback:  Error encountered:  %s", info)
+            self.subscribed.clear()
+        elif type == "close":
+            logger.info("OOB Callback:  Close socket")
+            self.subscribed.clear()
+
+    @log_exception
+    def ingest(self, ew, write_lock=None):
+        """ Fetch queued events and send them to Splunk until shutdown """
+        counter = self.counter
+        known_ids = self.known_ids
+        journal = self.journal
+        queue = self.queue
+        next_maint = monotonic() + self.maint_interval
+
+        # XXX:  For debugging where duplicates are comming from
+        PID = os.getpid()
+        EVENT_ID = 0
+
+        # Events are written to Splunk in batches.  Ids are held back from the
+        # journal until their events have been written out.
+        writer = BatchEventWriter(ew, self.batch_max_events, self.batch_max_bytes,
+                                  self.batch_max_latency, counter=counter, lock=write_lock)
+        unwritten_ids = []
+
+        def journal_written():
+            journal.extend(unwritten_ids)
+            journal.flush()
+            del unwritten_ids[:]
+
+        while not shutdown.is_set():
+            # Wait for an event, then take whatever else is already queued
+            items = []
             try:
-                while not shutdown.is_set():
-                    do_maint = False
-                    try:
-                        queue_source, event_id, record = queue.get(timeout=maint_interval)
-                        # Q: should we only check for dups for queue_source=="backfill"?  (check counter)
-                        if event_id in known_ids:
-                            counter["{}_skipped".format(queue_source)] += 1
-                            continue
-
-                        # XXX:  'TA_CODEPATH' for debugging where events come from.
-                        record["TA_CODEPATH"] = queue_source
-                        record["TA_PID"] = PID
-                        EVENT_ID += 1
-                        record["TA_EVENT_ID"] = EVENT_ID
-
-                        msg = json.dumps(record, separators=(',', ':'))
-                        e = Event(sourcetype="quolab:timeline", unbroken=True, data=msg)
-                        ew.write_event(e)
-
-                        known_ids.append(event_id)
-                        cp["event_ids"] = known_ids
-                        counter["{}_ingested".format(queue_source)] += 1
-                        counter["events_ingested"] += 1
-
-                        if monotonic() > next_maint:
-                            do_maint = True
-
-                    except Empty:
-                        logger.debug("timeout waiting for events in queue.  Trigger maint tasks.")
-                        do_maint = True
-
-                    if do_maint:
-                        logger.info('Processing stats:  input_name="%s" '
-                                    'Event counts:  %s', input_name,
-                                    counter_to_kv(counter))
-
-                        # XXX: Improve cleanup logic to probe /v1/timeline for queue length at startup
-                        if len(known_ids) > history_size:
-                            logger.debug("Cleaning up event_id history.   "
-                                         "Had %d entries, capping at %d", len(known_ids), history_size)
-                            known_ids = known_ids[history_size:]
-                            cp["event_ids"] = known_ids
-                        cp.dump_on_interval(dump_max_interval)
-                        next_maint = monotonic() + maint_interval
-
-            except (KeyboardInterrupt, SystemExit) as e:
-                # Note that using 'get()' in python 2.7 and on Windows, this get() with timeout may not be interuptable
-                # See https://docs.python.org/3/library/queue.html#queue.Queue.get the implications are not clear to me
-                # Just existing the above loop is good enough
-                logger.info("Exiting loop due to %s", e)
+                items.append(queue.get(timeout=writer.wait_time(self.maint_interval)))
+                while len(items) < self.batch_max_events:
+                    items.append(queue.get_nowait())
+            except Empty:
                 pass
 
-            logger.info('Done processing:  input_name="%s" shutdown_reason=%s'
-                        'Event counts:  backfill=%d streamed=%d events_ingested=%d  |  %s', input_name,
-                        "requested" if shutdown.isSet() else "exception",
-                        counter["backfill_ingested"], counter["websocket_ingested"],
-                        counter["events_ingested"], counter_to_kv(counter))
-            self.lifetime_counter += counter
-            cp.dump()
-            del cp
-
-        if self.lifetime_counter["inputs_processed"] > 1:
-            logger.info("Modular input shutting down.  Lifetime stats:  %s",
-                        counter_to_kv(self.lifetime_counter))
+            for queue_source, event_id, raw in items:
+                # Backfill skips known ids before queuing, but may race with the websocket
+                if not known_ids.add(event_id):
+                    counter["{}_skipped".format(queue_source)] += 1
+                    continue
+
+                # XXX:  'TA_CODEPATH' for debugging where events come from.
+                EVENT_ID += 1
+                # Original JSON text from the API is written as-is (no re-encoding)
+                msg = append_fields(raw, OrderedDict([
+                    ("TA_CODEPATH", queue_source),
+                    ("TA_PID", PID),
+                    ("TA_EVENT_ID", EVENT_ID)]))
+                unwritten_ids.append(event_id)
+                if writer.write(msg, sourcetype="quolab:timeline", stanza=self.name):
+                    journal_written()
+                counter["{}_ingested".format(queue_source)] += 1
+                counter["events_ingested"] += 1
+
+            if writer.flush_if_due():
+                journal_written()
+
+            if monotonic() > next_maint:
+                logger.info('Processing stats:  input_name="%s" '
+                            'Event counts:  %s  Batching:  %s  Queue:  %s', self.name,
+                            counter_to_kv(counter), writer.settings_kv(), queue.stats_kv())
+
+                # XXX: Improve cleanup logic to probe /v1/timeline for queue length at startup
+                if writer.flush():
+                    journal_written()
+                if journal.needs_compaction(self.history_size):
+                    journal.compact(known_ids.to_list())
+                next_maint = monotonic() + self.maint_interval
+
+        if writer.flush():
+            journal_written()
+        journal.close()
+        queue.close()
+        logger.info('Done processing:  input_name="%s" shutdown_reason=%s'
+                    'Event counts:  backfill=%d streamed=%d events_ingested=%d  |  %s', self.name,
+                    "requested" if shutdown.is_set() else "exception",
+                    counter["backfill_ingested"], counter["websocket_ingested"],
+                    counter["events_ingested"], counter_to_kv(counter))
 
 
 if __name__ == "__main__":
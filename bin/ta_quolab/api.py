@@ -1,26 +1,31 @@
 """ QuoLab Add on for Splunk share code for QuoLab API access
 """
 
+import heapq
 import json
+import random
 import re
 import ssl
 import time
-from logging import getLogger
-from threading import Event, Thread
+from collections import OrderedDict
+from logging import DEBUG, getLogger
+from threading import Event, Semaphore, Thread
 
 import requests
+import urllib3
+from six import string_types
 
-from cypresspoint.spath import splunk_dot_notation
 from requests.auth import AuthBase, HTTPBasicAuth
 from requests.utils import default_user_agent
 
-try:
-    from time import monotonic
-except ImportError:
-    # Good-enough fallback for PY2 users
-    from time import time as monotonic
-
 from . import __version__
+from .batching import AdaptiveBatchSize
+from .deadline import Deadline, DeadlineExceeded
+from .flatten import Flattener, build_projection
+from .jsonstream import JSONRecordStream, TruncatedResponse, decode_object_spans
+from .stats import QueryStats, monotonic
+from .transport import TunedHTTPAdapter, build_socket_options, iter_response_chunks
+from .workers import prefetch, throttle
 
 logger = getLogger("quolab.common")
 
@@ -34,6 +39,83 @@ log.setLevel(logging.DEBUG)
 """
 
 
+class QuoLabQueryError(Exception):
+    """ A catalog query failed in a way that should be reported to the user """
+    pass
+
+
+def _compare_values(a, b):
+    """ Compare two field values for sorting purposes.  None sorts first and
+    values of incompatible types are compared as strings. """
+    if a == b:
+        return 0
+    if a is None:
+        return -1
+    if b is None:
+        return 1
+    try:
+        return -1 if a < b else 1
+    except TypeError:
+        return -1 if str(a) < str(b) else 1
+
+
+def result_sort_key(order):
+    """ Build a sort key function for (flattened) results given ``order`` as a
+    list of ``(field_name, descending)`` tuples. """
+    order = list(order)
+
+    class SortKey(object):
+        __slots__ = ("values",)
+
+        def __init__(self, result):
+            self.values = [result.get(field) for field, _ in order]
+
+        def __lt__(self, other):
+            for (_, descending), a, b in zip(order, self.values, other.values):
+                c = _compare_values(a, b)
+                if c:
+                    return c > 0 if descending else c < 0
+            return False
+
+    return SortKey
+
+
+def record_time(record, path):
+    """ Return the timestamp (in epoch seconds) found in ``record`` by following
+    ``path`` (a list of keys), or None if it's missing or not a timestamp. """
+    value = record
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, string_types):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+class _ServerError(Exception):
+    """ Server side (5xx) failure of an API call; these are retried """
+    pass
+
+
+# Failures that may succeed if the same request is sent again
+_transient_errors = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    urllib3.exceptions.HTTPError,
+    _ServerError,
+    TruncatedResponse,
+)
+
+
 class QuolabAuth(AuthBase):
     def __init__(self, token):
         self._token = token
@@ -55,11 +137,32 @@ class QuoLabAPI(object):
         self.password = None
         self.url = url
         self.verify = verify
+        self.flattener = Flattener()
         if verify is False:
-            import urllib3
             urllib3.disable_warnings()
             logger.info("SSL Certificate validation has been disabled.")
 
+    def configure_transport(self, pool_connections=10, pool_maxsize=10, keep_alive=True,
+                            compression=True, tcp_nodelay=True, tcp_keepalive=False):
+        """ Tune the HTTP(S) connection handling of this API session.
+
+        ``pool_maxsize`` should be at least the number of concurrent queries
+        sent through this session, otherwise extra connections are discarded
+        after each use (rather than kept alive for reuse).
+        """
+        adapter = TunedHTTPAdapter(socket_options=build_socket_options(tcp_nodelay, tcp_keepalive),
+                                   pool_connections=pool_connections,
+                                   pool_maxsize=pool_maxsize,
+                                   max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate" if compression else "identity"
+        self.session.headers["Connection"] = "keep-alive" if keep_alive else "close"
+        logger.debug("HTTP transport configured:  pool_connections=%d pool_maxsize=%d "
+                     "keep_alive=%s compression=%s tcp_nodelay=%s tcp_keepalive=%s",
+                     pool_connections, pool_maxsize, keep_alive, compression, tcp_nodelay,
+                     tcp_keepalive)
+
     def login(self, username, password):
         self.username = username
         self.password = password
@@ -98,12 +201,49 @@ class QuoLabAPI(object):
     '''
     timeline_default_facets = ("display",)
 
-    def get_timeline_events(self, timeline_id, facets=None):
-        """ Call /v1/timeline/<timeline_id>/event to return events within the timeline's buffer. """
+    # Size of reads from streaming HTTP responses
+    stream_chunk_size = 64 * 1024
+
+    # Results each query of query_catalog_parallel() may hold ahead of the merge
+    parallel_buffer_size = 100
+
+    # Per-request timeouts (in seconds) for establishing a connection and for
+    # waiting on data from the server.  These are lowered as a deadline nears.
+    connect_timeout = 10
+    read_timeout = 300
+
+    # Fields that are always returned when only some fields are requested
+    projection_fields = ("id", "class", "type")
+
+    # Retry handling for transient failures.  Delays are in seconds
+    max_retries = 5
+    retry_backoff = 0.5
+    retry_backoff_max = 30
+
+    def get_timeline_events(self, timeline_id, facets=None, raw=False, deadline=None,
+                            cursor=None, page_size=None):
+        """ Call /v1/timeline/<timeline_id>/event to return events within the timeline's buffer.
+
+        If ``raw`` is True, tuples of (record, original_json_text) are returned.
+        If a ``deadline`` (:class:`Deadline`) is given, the download is aborted
+        with :class:`DeadlineExceeded` once it expires.
+
+        Events are parsed as they're downloaded, so memory use doesn't depend
+        on the size of the buffer.  If the server splits the buffer into pages
+        (by returning an 'ellipsis'), the next page is requested with 'resume'.
+        A 'limit' is only sent if ``page_size`` is given.
+
+        Transient failures are retried from the start of the current page,
+        skipping events that were already returned.  The position is kept in
+        ``cursor`` (a :class:`TimelineCursor`), so passing the same cursor to
+        a new call continues after the last event returned by a failed one.
+        """
         # https://node77.cloud.quolab.com/v1/timeline/51942b79b8b34827bf721077fa22a590/event?facets.display=1
         url = "{}/v1/timeline/{}/event".format(self.url, timeline_id)
         if facets is None:
             facets = self.timeline_default_facets
+        if cursor is None:
+            cursor = TimelineCursor()
 
         headers = {
             'content-type': "application/json",
@@ -112,174 +252,580 @@ class QuoLabAPI(object):
         data = {}
         for facet in facets:
             data["facets.{}".format(facet)] = 1
-        auth = self.get_auth()
+        if page_size:
+            data["limit"] = page_size
 
+        attempt = 0
+        while not cursor.complete:
+            if cursor.resume is not None:
+                data["resume"] = cursor.resume
+            try:
+                for record in self._timeline_events_page(url, data, headers, raw, deadline,
+                                                         cursor):
+                    yield record
+            except _transient_errors as e:
+                if deadline is not None and deadline.expired():
+                    raise DeadlineExceeded("Timeline download aborted after {} seconds.  records={}"
+                                           .format(deadline.seconds, cursor.count))
+                attempt += 1
+                delay = min(self.retry_backoff_max,
+                            self.retry_backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+                if attempt > self.max_retries or \
+                        (deadline is not None and delay >= deadline.remaining()):
+                    logger.error("QuoLab API failed due to %s  url=%s records=%d  (attempts=%d)",
+                                 e, url, cursor.count, attempt)
+                    raise
+                logger.warning("QuoLab API timeline request failed due to %s.  Retrying in %0.1f "
+                               "seconds (attempt=%d, records_received=%d)",
+                               e, delay, attempt, cursor.count)
+                cursor.retries += 1
+                time.sleep(delay)
+                continue
+            attempt = 0
+        logger.info("QuoLab API response was parsed as json successfully!  records=%d pages=%d",
+                    cursor.count, cursor.pages)
+
+    def _timeline_events_page(self, url, data, headers, raw, deadline, cursor):
+        """ Generator that yields the events of one page of the timeline buffer
+        that haven't been returned yet, and advances ``cursor`` """
+        if deadline is None:
+            timeout = (self.connect_timeout, self.read_timeout)
+        else:
+            timeout = deadline.timeout()
         try:
             response = self.session.request(
                 "GET", url,
                 data=data,
                 headers=headers,
-                auth=auth,
-                verify=self.verify)
+                auth=self.get_auth(),
+                verify=self.verify,
+                timeout=timeout,
+                stream=True)
         except requests.ConnectionError as e:
             logger.error("QuoLab API failed due to %s", e)
-
-        response.raise_for_status()
-        try:
-            data = response.json()
-        except ValueError as e:
-            raw = response.content
-            content_length = len(raw)
-            logger.error("QuoLab API response could not be parsed.  url=%s content-length=%d  %s",
-                         url, content_length, e)
-            logger.error("QuoLab API response could not be parsed.  url=%s Sample:\n%s\n...\n%s",
-                         url, raw[:200], raw[-200:])
-            logger.debug("QuoLab API raw response: url=%s \n%s", url, raw)
             raise
-        # debugging
-        logger.info("QuoLab API response was parsed as json successfully!")
-        assert data["status"] == "OK"
 
-        for record in data.get("records", []):
-            yield record
+        with response:
+            if response.status_code >= 500:
+                raise _ServerError("{} Server Error: {}".format(response.status_code,
+                                                                response.reason))
+            response.raise_for_status()
+            watchdog = deadline.watch(response) if deadline else None
+            chunks = iter_response_chunks(response, self.stream_chunk_size, deadline=deadline)
+            stream = JSONRecordStream(chunks, raw=raw)
+            try:
+                for n, record in enumerate(stream, 1):
+                    if n > cursor.skip:
+                        cursor.skip = n
+                        cursor.count += 1
+                        yield record
+            finally:
+                if watchdog:
+                    watchdog.cancel()
+        assert stream.meta["status"] == "OK"
+        cursor.pages += 1
+        ellipsis = stream.meta.get("ellipsis")
+        if ellipsis:
+            cursor.resume = ellipsis
+            cursor.skip = 0
+        else:
+            cursor.complete = True
 
     def subscribe_timeline(self, recv_message_callback, oob_callback, timeline_id, facets=None):
-        if facets is None:
-            facets = self.timeline_default_facets
-        qws = QuoLabWebSocket(self.url, self.get_auth(), timeline_id,
-                              recv_message_callback, oob_callback, self.verify, facets=facets)
-
-        # Run server_forever() in it's own thread, so we can return to the caller
-        # thread.start_new_thread(qws.connect, ())
-        # Python 3 use:  Thread(target=qws.connect, daemon=True).start()
-        t = Thread(target=qws.connect)
-        t.daemon = True
-        t.start()
-
-        if not qws.is_setup.wait(15):
-            logger.error("Took too long to setup websocket to {}.  Triggering a shutdown", self.url)
-            qws.is_done.set()
-            time.sleep(120)
-            # Forceable shutdown that will kill all threads
-            logger.error("Forcing a hard shutdown!")
-            # Give log time to write
-            time.sleep(3)
-
-            import os
-            os._exit(3)
-            # XXX: Trigger a clean shutdown
-            raise SystemExit(3)
+        return self.subscribe_timelines(
+            [(timeline_id, recv_message_callback, oob_callback, facets)])
+
+    def subscribe_timelines(self, bindings, engine="thread"):
+        """ Subscribe to several timelines over a single websocket.  ``bindings``
+        is a list of (timeline_id, recv_message_callback, oob_callback, facets)
+
+        With the 'thread' engine, the websocket runs in its own thread.  The
+        'asyncio' engine runs it on an event loop shared by all websockets in
+        the process (see :mod:`ta_quolab.asyncws`).
+        """
+        if engine == "asyncio":
+            from .asyncws import AsyncQuoLabWebSocket as socket_class
+        elif engine == "thread":
+            socket_class = QuoLabWebSocket
+        else:
+            raise ValueError("Unknown websocket engine '{}'".format(engine))
+        qws = socket_class(self.url, self.get_auth(), None, None, None, self.verify)
+        for timeline_id, recv_message_callback, oob_callback, facets in bindings:
+            if facets is None:
+                facets = self.timeline_default_facets
+            qws.add_binding(timeline_id, recv_message_callback, oob_callback, facets)
+
+        if engine == "asyncio":
+            qws.start()
+            setup_timeout = qws.connect_timeout
+        else:
+            # Run server_forever() in it's own thread, so we can return to the caller
+            t = Thread(target=qws.connect)
+            t.daemon = True
+            t.start()
+            setup_timeout = 15
+
+        # Connection failures are reported to the bindings' oob_callback.  It's
+        # up to the caller to retry once ``is_done`` is set.
+        expires = monotonic() + setup_timeout
+        while not qws.is_setup.wait(0.1):
+            if qws.is_done.is_set():
+                break
+            if monotonic() > expires:
+                logger.error("Took too long to setup websocket to %s", self.url)
+                qws.close()
+                qws.is_done.set()
+                break
         return qws
 
-    def query_catalog(self, query, query_limit, timeout=30, fetch_count=1000, write_error=None):
+    def query_catalog(self, query, query_limit, timeout=30, fetch_count=1000, write_error=None,
+                      prefetch_depth=0, stats=None, min_fetch_count=None, target_fetch_time=None,
+                      write_warning=None, deadline=None, fields=None, time_field=None,
+                      earliest=None, latest=None, time_ordered=False, default_time=True,
+                      slots=None):
         """ Handle the query to QuoLab API that drives this SPL command
         Returns [results]
+
+        The overall run time is limited by ``deadline`` (a :class:`Deadline`),
+        which defaults to 10x ``timeout``.  Each HTTP call gets connect/read
+        timeouts derived from the remaining time, and a read still in progress
+        when the deadline expires is aborted.  Results returned up to that
+        point are kept and ``write_warning`` is called to report that they are
+        incomplete.
+
+        If ``fields`` (a list of dot-notation field names) is given, only
+        those fields (along with 'id', 'class', and 'type') are returned.
+        The '_raw' field is only included if explicitly requested.
+
+        If ``time_field`` (a dot separated path into the record, like
+        'document.last:Max') is given, it's used as the '_time' of each
+        result instead of the current time.  Records outside of ``earliest``
+        and ``latest`` (epoch seconds; either may be None) are then skipped,
+        as are records without a timestamp when a time range is given.  Set
+        ``time_ordered`` if the query returns records in descending order of
+        ``time_field``; no more pages are requested once a record older than
+        ``earliest`` shows up.  Results without a timestamp get the current
+        time as '_time', unless ``default_time`` is False (so they can be
+        cached and stamped when they're used).
+
+        The number of records requested per HTTP call adapts between
+        ``min_fetch_count`` and ``fetch_count`` based on the observed response
+        time (aiming for ``target_fetch_time`` seconds) and response size.  If
+        ``min_fetch_count`` is not given, ``fetch_count`` is always used.
+
+        When ``prefetch_depth`` is greater than 0, the next page of results is
+        requested from a background thread (as soon as the ellipsis is known)
+        while the current page is being processed.  Up to ``prefetch_depth``
+        pages will be held ready ahead of the consumer.
+
+        If ``slots`` (a Semaphore shared by several queries) is given, one of
+        them is held while each page is requested and read.
         """
         if write_error is None:
             def write_error(s, *args, **kwargs): pass
-
-        # XXX:  COMPLETE MIGRATION OF THIS METHOD!!
-        # XXX:  REPLACE THIS CODE IN quolab_query.py
-
-        # CATALOG QUERY
-        session = self.session
+        if write_warning is None:
+            def write_warning(s, *args, **kwargs): pass
+        if stats is None:
+            stats = QueryStats()
 
         start = monotonic()
-        # Allow total run time to be 10x the individual query limit
-        expire = start + (timeout * 10)
+        if deadline is None:
+            deadline = self.catalog_deadline(timeout)
+        flattener = self.flattener
+        include_raw = True
+        if fields:
+            flattener = Flattener(projection=build_projection(
+                list(fields) + list(self.projection_fields)))
+            include_raw = "_raw" in fields
+
+        time_path = time_field.split(".") if time_field else None
+        time_bound = bool(earliest or latest)
+
+        if min_fetch_count is None:
+            min_fetch_count = fetch_count
+        if target_fetch_time is None:
+            target_fetch_time = timeout / 10.0
+        batch_size = AdaptiveBatchSize(min_fetch_count, fetch_count, target_fetch_time)
+
+        # Q: What do query results look like when time has been exceeded?  Any special
+        #    handling required?
+        query.setdefault("hints", {})["timeout"] = timeout
+        i = 0
+
+        # Background fetching, and holding a slot for the whole request, require
+        # each page to be fully read before moving on
+        pages = self._query_catalog_pages(query, query_limit, deadline, stats, batch_size,
+                                          materialize=prefetch_depth > 0 or slots is not None)
+        if slots is not None:
+            pages = throttle(pages, slots)
+        if prefetch_depth > 0:
+            pages = prefetch(pages, prefetch_depth, deadline=deadline)
+
+        flatten_time = 0.0
+        done = False
+        try:
+            while not done:
+                if prefetch_depth > 0:
+                    # Time spent waiting on the background fetch
+                    with stats.timer("wait"):
+                        records = next(pages, None)
+                else:
+                    records = next(pages, None)
+                if records is None:
+                    break
 
+                for record, raw in records:
+                    timestamp = None
+                    if time_path:
+                        timestamp = record_time(record, time_path)
+                        if timestamp is None:
+                            if time_bound:
+                                stats.incr("time_skipped")
+                                continue
+                        elif latest and timestamp >= latest:
+                            stats.incr("time_skipped")
+                            continue
+                        elif earliest and timestamp < earliest:
+                            if time_ordered:
+                                # Everything that follows is older still
+                                stats.incr("time_cutoff")
+                                done = True
+                                break
+                            stats.incr("time_skipped")
+                            continue
+
+                    flatten_start = monotonic()
+                    result = flattener.flatten(record)
+                    flatten_time += monotonic() - flatten_start
+                    if include_raw:
+                        # Pass along the record's JSON text as-is from the server's response
+                        result["_raw"] = raw
+                    if timestamp is not None:
+                        result["_time"] = timestamp
+                    elif default_time:
+                        result["_time"] = time.time()
+                    yield result
+                    i += 1
+                    if i >= query_limit:
+                        done = True
+                        break
+        except DeadlineExceeded as e:
+            logger.warning("Aborting query due to time expiration:  %s  records=%d", e, i)
+            stats.incr("expired")
+            write_warning("QuoLab query did not complete within {} seconds.  Results are "
+                          "incomplete ({} records returned).", deadline.seconds, i)
+        except QuoLabQueryError as e:
+            stats.incr("errors")
+            write_error("{}", e)
+            return
+        finally:
+            pages.close()
+            duration = monotonic() - start
+            stats.incr("records", i)
+            stats.add_time("flatten", flatten_time)
+            stats.add_time("process", duration - stats.timers["wait"])
+            logger.info("Query/return efficiency: http_calls=%d, query_limit=%d, per_post_limit=%d "
+                        "duration=%0.3f batch_sizes=%s", stats.counters["http_calls"], query_limit,
+                        query.get("limit", 0), duration, batch_size)
+            logger.info("Query pipeline stats: prefetch_depth=%d %s", prefetch_depth, stats.to_kv())
+
+    def catalog_deadline(self, timeout):
+        """ Return the default :class:`Deadline` for a catalog query with a
+        per-call (server side) ``timeout``. """
+        # Allow total run time to be 10x the individual query limit, and give
+        # the server some leeway beyond its own time limit for each call.
+        return Deadline(timeout * 10, connect_timeout=self.connect_timeout,
+                        read_timeout=timeout * 2)
+
+    def query_catalog_parallel(self, queries, query_limit, order=(("id", False),),
+                               max_workers=4, stats=None, **kwargs):
+        """ Run several catalog queries concurrently, sharing this API session,
+        and merge the results back into a single stream.
+
+        Each query in ``queries`` must use the same ordering, given by
+        ``order`` as a list of ``(field_name, descending)`` tuples using the
+        flattened (dot-notation) field names.  Since any one of the queries
+        could hold the top results, each query is run with the full
+        ``query_limit`` and the merged output is truncated to ``query_limit``.
+        Remaining keyword arguments are passed along to :meth:`query_catalog`.
+        All queries share the same deadline.
+
+        All queries are started right away, each in its own thread, and their
+        results are streamed into the merge holding at most
+        ``parallel_buffer_size`` results ahead, so memory use doesn't grow with
+        ``query_limit``.  At most ``max_workers`` requests are sent to the
+        server at any one time:  a query holds one of the slots while it sends
+        a request and reads the whole page, and gives it up while it waits for
+        the merge to catch up.  Errors are reported (with ``write_error``)
+        from the caller's thread once the merge is done.
+        """
+        if stats is None:
+            stats = QueryStats()
+        # Individual queries already run concurrently; skip the per-query prefetch thread
+        kwargs["prefetch_depth"] = 0
+        if kwargs.get("deadline") is None:
+            kwargs["deadline"] = self.catalog_deadline(kwargs.get("timeout", 30))
+        deadline = kwargs["deadline"]
+        # Report incomplete results and errors once for the merged output rather than per query
+        write_warning = kwargs.pop("write_warning", None)
+        write_error = kwargs.pop("write_error", None)
+        errors = []
+        slots = Semaphore(max(1, max_workers))
+        query_stats = []
+
+        def run(query):
+            query_stats.append(QueryStats())
+            results = self.query_catalog(
+                query, query_limit, stats=query_stats[-1], slots=slots,
+                write_error=lambda s, *args, **kw: errors.append((s, args, kw)), **kwargs)
+            return prefetch(results, self.parallel_buffer_size, deadline=deadline)
+
+        logger.info("Running %d catalog queries with max_workers=%d", len(queries), max_workers)
+        streams = [run(query) for query in queries]
+        emitted = 0
+        try:
+            if query_limit > 0:
+                for result in heapq.merge(*streams, key=result_sort_key(order)):
+                    yield result
+                    emitted += 1
+                    if emitted >= query_limit:
+                        break
+        finally:
+            for stream in streams:
+                stream.close()
+            for sub_stats in query_stats:
+                stats.merge(sub_stats)
+            # Count what was returned, rather than everything each query fetched
+            stats.counters["records_fetched"] = stats.counters.pop("records", 0)
+            stats.counters["records"] = emitted
+            stats.incr("parallel_queries", len(queries))
+            if write_warning and stats.counters["expired"]:
+                write_warning("QuoLab query did not complete within {} seconds.  "
+                              "Results are incomplete.", deadline.seconds)
+            if write_error:
+                for s, args, kw in errors:
+                    write_error(s, *args, **kw)
+
+    def _query_catalog_pages(self, query, query_limit, deadline, stats, batch_size,
+                             materialize=False):
+        """ Generator that sends the catalog query and yields the records of each
+        page.  Pagination continues (using the returned 'ellipsis') until
+        ``query_limit`` records have been fetched.  Failures are reported by
+        raising :class:`QuoLabQueryError`, or :class:`DeadlineExceeded` once
+        ``deadline`` expires with more records left to fetch.
+        The per-call limit is picked by ``batch_size`` (AdaptiveBatchSize).
+
+        Records are parsed incrementally from the response stream, so each
+        page must be fully consumed before requesting the next one.  Use
+        ``materialize`` to read each page into a list before it's yielded.
+        """
         url = "{}/v1/catalog/query".format(self.url)
         headers = {
             'content-type': "application/json",
             'user-agent': "ta-quolab/{} {}".format(__version__, default_user_agent())
         }
-        # XXX: Per query limit optimization?  Maybe based on type, or number of facets enabled?
-        query["limit"] = min(query_limit, fetch_count)
+        fetched = 0
 
-        # Q: What do query results look like when time has been exceeded?  Any special handling required?
-        query.setdefault("hints", {})["timeout"] = timeout
-        i = http_calls = 0
+        while True:
+            query["limit"] = min(batch_size.size, query_limit - fetched)
+            page = _PageInfo()
+            records = self._query_catalog_page(url, query, headers, deadline, stats, page)
+            if materialize:
+                yield list(records)
+            else:
+                yield records
+            logger.debug("Response metadata:   %s", page.meta)
+
+            batch_size.update(query["limit"], page.count, page.elapsed, page.bytes)
+            stats.incr("pages")
+            stats.incr("bytes", page.bytes)
+            fetched += page.count
+            if fetched >= query_limit:
+                break
 
+            ellipsis = page.meta.get("ellipsis", None)
+            if not ellipsis:
+                break
+            deadline.check()
+            logger.debug("Query next batch.  fetched=%d, query_limit=%d, limit=%d, ellipsis=%s",
+                         fetched, query_limit, query["limit"], ellipsis)
+            query["resume"] = ellipsis
+
+    def _query_catalog_page(self, url, query, headers, deadline, stats, page):
+        """ Generator that yields the records of a single page of a catalog query.
+
+        Transient failures (connection errors, timeouts, truncated responses,
+        and 5xx status codes) are retried with exponential backoff and jitter,
+        using the same query (and therefore the same 'resume' ellipsis).  Any
+        records that were already returned before the failure are skipped.
+        Retries stop after ``max_retries`` attempts or when the next attempt
+        would start after ``deadline`` expires.  Reads that are still in
+        progress at the deadline are aborted and :class:`DeadlineExceeded` is
+        raised.  Details of the completed page are stored in ``page``.
+        """
         auth = self.get_auth()
-
+        data = json.dumps(query)
+        attempt = 0
+        delivered = 0
         while True:
-            data = json.dumps(query)
             logger.debug("Sending query to API:  %r   headers=%r auth=%s",
                          data, headers, auth.__class__.__name__)
+            requested = monotonic()
             try:
-                response = session.request(
-                    "POST", url,
-                    data=data,
-                    headers=headers,
-                    auth=auth,
-                    verify=self.verify)
-                http_calls += 1
-            except requests.ConnectionError as e:
-                logger.error("QuoLab API failed due to %s", e)
-                write_error("QuoLab server connection failed to {}", url)
+                with stats.timer("http_request"):
+                    response = self.session.request(
+                        "POST", url,
+                        data=data,
+                        headers=headers,
+                        auth=auth,
+                        verify=self.verify,
+                        timeout=deadline.timeout(),
+                        stream=True)
+                stats.incr("http_calls")
+
+                # Closing the response returns (or discards) its pooled connection,
+                # also when the status check raises
+                with response:
+                    self._check_catalog_response(response, query)
+                    watchdog = deadline.watch(response)
+                    # Parse time is what's left after excluding time spent reading from
+                    # the network, decompressing, and waiting on the consumer of records
+                    io_time = stats.timers["http_read"] + stats.timers["decompress"]
+                    start = monotonic()
+                    idle = 0.0
+                    try:
+                        chunks = iter_response_chunks(response, self.stream_chunk_size, stats,
+                                                      deadline)
+                        stream = JSONRecordStream(chunks, raw=True)
+                        for n, item in enumerate(stream, 1):
+                            if n > delivered:
+                                delivered = n
+                                suspended = monotonic()
+                                yield item
+                                idle += monotonic() - suspended
+                    finally:
+                        watchdog.cancel()
+                        io_time = stats.timers["http_read"] + stats.timers["decompress"] - io_time
+                        stats.add_time("parse", monotonic() - start - idle - io_time)
+                page.meta = stream.meta
+                page.count = stream.count
+                page.bytes = stream.bytes
+                # With stream=True, response.elapsed stops at the headers.  Time the
+                # whole response instead, less time spent waiting on the consumer.
+                page.elapsed = monotonic() - requested - idle
                 return
+            except _transient_errors as e:
+                if deadline.expired():
+                    # Most likely the watchdog cut off this read
+                    logger.debug("QuoLab API request interrupted at deadline:  %s", e)
+                    deadline.check()
+                attempt += 1
+                delay = min(self.retry_backoff_max,
+                            self.retry_backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+                if attempt > self.max_retries or delay >= deadline.remaining():
+                    logger.error("QuoLab API failed due to %s  (attempts=%d)", e, attempt)
+                    raise QuoLabQueryError("QuoLab server connection failed to {}".format(url))
+                logger.warning("QuoLab API request failed due to %s.  Retrying in %0.1f seconds "
+                               "(attempt=%d, records_received=%d)", e, delay, attempt, delivered)
+                stats.incr("retries")
+                time.sleep(delay)
+            except ValueError as e:
+                # Not JSON (an error page from a proxy, for example); sending it again won't help
+                logger.error("QuoLab API returned an invalid response:  %s", e)
+                raise QuoLabQueryError("QuoLab API returned an invalid response from {}"
+                                       .format(url))
 
-            if response.status_code >= 400 and response.status_code < 500:
-                body = response.json()
-                if "status" in body or "message" in body:
-                    status = body.get("status", response.status_code)
-                    message = body.get("message", "")
-                    logger.error("QuoLab API returned unexpected status response from query.  "
-                                 "status=%r message=%r query=%r", status, message, query)
-                    write_error("QuoLab query failed:  {} ({})", message, status)
-                    return
-
-            # When non-success status code without a message/status, then just raise an exception.
-            try:
-                response.raise_for_status()
-                body = response.json()
-            except Exception as e:
-                logger.debug("Body response for %s:   %s", e, response.text)
-                raise
-
-            logger.debug("Response body:   %s", body)
-
-            records = body["records"]
-            for record in records:
-                result = (splunk_dot_notation(record))
-                result["_raw"] = json.dumps(record)
-                # Q:  Are there ever fields that should be returned as _time instead of system clock time?
-                result["_time"] = time.time()
-                yield result
-                i += 1
-                if i >= query_limit:
-                    break
+    @staticmethod
+    def _check_catalog_response(response, query):
+        if response.status_code >= 400 and response.status_code < 500:
+            body = response.json()
+            if "status" in body or "message" in body:
+                status = body.get("status", response.status_code)
+                message = body.get("message", "")
+                logger.error("QuoLab API returned unexpected status response from query.  "
+                             "status=%r message=%r query=%r", status, message, query)
+                raise QuoLabQueryError("QuoLab query failed:  {} ({})".format(message, status))
+
+        if response.status_code >= 500:
+            raise _ServerError("{} Server Error: {}".format(response.status_code, response.reason))
+
+        # When non-success status code without a message/status, then just raise an exception.
+        try:
+            response.raise_for_status()
+        except Exception as e:
+            logger.debug("Body response for %s:   %s", e, response.text)
+            raise
 
-            if monotonic() > expire:
-                logger.warning("Aborting query due to time expiration")
-                break
 
-            if i >= query_limit:
-                break
+class _PageInfo(object):
+    """ Details about a single page of catalog query results """
+
+    def __init__(self):
+        self.meta = {}
+        self.count = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+
+class TimelineCursor(object):
+    """ Position within a timeline buffer download (see
+    :meth:`QuoLabAPI.get_timeline_events`) """
+
+    def __init__(self):
+        # 'ellipsis' of the current page, and how many of its events were returned
+        self.resume = None
+        self.skip = 0
+        self.count = 0
+        self.pages = 0
+        self.retries = 0
+        self.complete = False
 
-            ellipsis = body.get("ellipsis", None)
-            if ellipsis:
-                logger.debug("Query next batch.  i=%d, query_limit=%d, limit=%d, ellipsis=%s",
-                             i, query_limit, query["limit"], ellipsis)
-                query["resume"] = ellipsis
-            else:
-                break
-        logger.info("Query/return efficiency: http_calls=%d, query_limit=%d, per_post_limit=%d duration=%0.3f",
-                    http_calls, query_limit, query["limit"], monotonic()-start)
+
+class _TimelineBinding(object):
+    """ Subscription of one timeline on a websocket """
+
+    def __init__(self, timeline, message_callback, oob_callback, facets=()):
+        self.timeline = timeline
+        self.message_callback = message_callback
+        self.oob_callback = oob_callback
+        self.facets = facets
+        self.cid = "activity-stream-event-{}".format(timeline)
 
 
 class QuoLabWebSocket(object):
+    """ Websocket connection to a QuoLab server carrying one or more timeline
+    bindings.  Messages are routed to the binding named by their 'cid'. """
 
     def __init__(self, url, auth, timeline, message_callback, oob_callback, verify, facets=()):
         self.url = url
         self.auth = auth
-        self.timeline = timeline
-        self.message_callback = message_callback
-        self.oob_callback = oob_callback
         self.verify = verify
-        self.facets = facets
+        self.bindings = OrderedDict()
         self.is_done = Event()
         self.is_setup = Event()
+        self.app = None
+        if timeline:
+            self.add_binding(timeline, message_callback, oob_callback, facets)
+
+    def add_binding(self, timeline, message_callback, oob_callback, facets=()):
+        """ Subscribe to ``timeline`` once the websocket is open """
+        binding = _TimelineBinding(timeline, message_callback, oob_callback, facets)
+        self.bindings[binding.cid] = binding
+        return binding
+
+    def _binding_for(self, msg):
+        binding = self.bindings.get(msg.get("cid"))
+        if binding is None and len(self.bindings) == 1:
+            # Single subscription; no need to rely on the server echoing the cid
+            binding = next(iter(self.bindings.values()))
+        return binding
+
+    def _notify(self, bindings, *args):
+        for binding in bindings:
+            try:
+                binding.oob_callback(*args)
+            except Exception:
+                logger.exception("Failure during callback!  callback=%r", binding.oob_callback)
 
     @staticmethod
     def _convert_request_auth_headers(auth):
@@ -305,28 +851,31 @@ class QuoLabWebSocket(object):
         if self.verify is False:
 
             kw["sslopt"] = {"cert_reqs": ssl.CERT_NONE}
+        self.app = ws
         # Set ping_interval to cause enable_multithread=True in WebSocket() constructor
         ws.run_forever(ping_interval=30, ping_timeout=10, **kw)
 
     def on_message(self, ws, msg):
-        j = json.loads(msg)
-        msg_formatted = json.dumps(j, indent=4)
-        # XXX: Remove the following debug message after initial development
-        logger.debug('[Websocket Message]\n%s', msg_formatted)
+        # Keep the original text of 'body' so events can be written without re-encoding
+        spans = decode_object_spans(msg)
+        j = {key: value for key, (value, _) in spans.items()}
+        if logger.isEnabledFor(DEBUG):
+            # XXX: Remove the following debug message after initial development
+            logger.debug('[Websocket Message]\n%s', json.dumps(j, indent=4))
         event_name = j.get('name')
 
-        if event_name == "event":
-            self.message_callback(j)
-            return
-
-        if event_name == "bound":
+        if event_name in ("event", "bound"):
+            binding = self._binding_for(j)
+            if binding is None:
+                logger.info("Message for unknown binding cid=%s not ingested", j.get("cid"))
+                return
+            if event_name == "event":
+                binding.message_callback(j, spans["body"][1])
+                return
             logger.info("Websocket bound to %s", j["cid"])
-            try:
-                self.oob_callback("bound", j)
-            except Exception:
-                logger.exception("Failure during callback!  callback=%r", self.oob_callback)
+            self._notify([binding], "bound", j)
         else:
-            logger.info("Unknown '%s', message not ingested:  %s", event_name, msg_formatted)
+            logger.info("Unknown '%s', message not ingested:  %s", event_name, msg)
 
         '''
         # Indexing the rest
@@ -345,40 +894,41 @@ class QuoLabWebSocket(object):
         logger.error("[Websocket Error] %s", err)
         # Q:  Does this always/automatically trigger a shutdown?  Should it?
         try:
-            self.oob_callback("error", err)
-        except:
-            logger.exception("Callback error during on_error handling")
+            self._notify(self.bindings.values(), "error", err)
         finally:
             self.is_done.set()
 
-    def _build_bind_request(self):
+    @staticmethod
+    def _build_bind_request(binding):
         doc = {
             "attach": {
                 "ns": "activity-stream",
                 "name": "event",
-                "cid": self.timeline,
+                "cid": binding.timeline,
             },
             "body": {
                 "composition": {
                     "catalog": {
-                        "facets": {facet: True for facet in self.facets},
+                        "facets": {facet: True for facet in binding.facets},
                         "object": "object"
                     }
                 }
             },
-            "cid": "activity-stream-event-{}".format(self.timeline),
+            "cid": binding.cid,
             "name": "bind",
             "ns": "link/binding"
         }
         return doc
 
     def on_open(self, ws):
-        logger.debug("[Websocket Open].   Request timeline=%s", self.timeline)
+        logger.debug("[Websocket Open].   Request timelines=%s",
+                     ",".join(b.timeline for b in self.bindings.values()))
 
         def run(*args):
-            req = self._build_bind_request()   # XXX:  Support facets here!
-            logger.debug("[Websocket Open:run()] Request payload:  %s", req)
-            ws.send(json.dumps(req))
+            for binding in list(self.bindings.values()):
+                req = self._build_bind_request(binding)
+                logger.debug("[Websocket Open:run()] Request payload:  %s", req)
+                ws.send(json.dumps(req))
             self.is_setup.set()
 
         import _thread as thread
@@ -389,8 +939,12 @@ class QuoLabWebSocket(object):
         ws.close()
         logger.info('[Websocket Closed]')
         try:
-            self.oob_callback("close")
-        except:
-            logger.exception("Callback error during on_error handling")
+            self._notify(self.bindings.values(), "close")
         finally:
             self.is_done.set()
+
+    def close(self):
+        """ Close the connection (from any thread) """
+        if self.app is not None:
+            self.app.keep_running = False
+            self.app.close()
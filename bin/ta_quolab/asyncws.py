@@ -0,0 +1,171 @@
+""" QuoLab Add on for Splunk asyncio websocket engine for timeline subscriptions
+
+The default engine (:class:`ta_quolab.api.QuoLabWebSocket`) runs
+websocket-client's ``run_forever()`` in a thread per connection, plus a
+thread to send the bind requests.  This engine instead runs every
+connection as a coroutine on one shared event loop thread, with connect,
+bind, receive and keep-alive pings handled cooperatively.
+
+The websocket protocol itself is handled by the 'websockets' package
+(installed into lib/ from requirements.txt).  It enforces the message size
+limit (``max_message_size``, close code 1009) and closes the connection on
+protocol violations from the server such as reserved bits, unknown
+opcodes, or oversized or fragmented control frames (close code 1002).
+"""
+
+import asyncio
+import json
+import re
+import ssl
+from logging import getLogger
+from threading import Lock, Thread
+
+import websockets
+
+from .api import QuoLabWebSocket
+
+logger = getLogger("quolab.common")
+
+
+class AsyncQuoLabWebSocket(QuoLabWebSocket):
+    """ QuoLabWebSocket that runs as a coroutine (see :meth:`run`).  Received
+    messages are handed to the callbacks on the loop's default executor, so
+    that a slow callback (like a queue spilling to disk) doesn't hold up the
+    other connections sharing the loop. """
+    ping_interval = 30
+    ping_timeout = 10
+    # Overall time limit for connecting, the upgrade handshake, and sending the binds
+    connect_timeout = 15
+    # Time allowed for the closing handshake (also when giving up on a connection attempt)
+    close_timeout = 2
+    # Largest message accepted from the server (after decompression)
+    max_message_size = 16 * 1024 * 1024
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncQuoLabWebSocket, self).__init__(*args, **kwargs)
+        self.ws = None
+        self.loop = None
+        self.task = None
+        self.closing = False
+        self.close_code = None
+
+    def _ssl_context(self):
+        context = ssl.create_default_context()
+        if self.verify is False:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def start(self, loop_thread=None):
+        """ Schedule :meth:`run` on ``loop_thread`` (an :class:`EventLoopThread`),
+        by default the shared one.  Returns a concurrent.futures.Future. """
+        loop_thread = loop_thread or shared_loop()
+        self.loop = loop_thread.loop
+        return loop_thread.submit(self.run())
+
+    async def _setup(self, ws_url):
+        ws = await websockets.connect(
+            ws_url,
+            extra_headers=self._convert_request_auth_headers(self.auth),
+            ssl=self._ssl_context() if ws_url.startswith("wss:") else None,
+            # The caller applies connect_timeout to the setup as a whole
+            open_timeout=None,
+            ping_interval=self.ping_interval,
+            ping_timeout=self.ping_timeout,
+            close_timeout=self.close_timeout,
+            max_size=self.max_message_size)
+        try:
+            for binding in list(self.bindings.values()):
+                req = self._build_bind_request(binding)
+                logger.debug("[Websocket Open] Request payload:  %s", req)
+                await ws.send(json.dumps(req))
+        except BaseException:
+            # Including cancellation (timeout) part way through
+            ws.transport.close()
+            raise
+        return ws
+
+    async def run(self):
+        """ Connect, bind all timelines, and dispatch messages until the
+        connection is closed. """
+        ws_url = "{}/v1/socket".format(re.sub('^http', 'ws', self.url))
+        logger.info("WEB socket URL = %s  (asyncio)", ws_url)
+        self.loop = asyncio.get_event_loop()
+        self.task = asyncio.current_task()
+        ws = None
+        try:
+            if self.closing:
+                # Closed before it got started
+                return
+            try:
+                self.ws = ws = await asyncio.wait_for(self._setup(ws_url), self.connect_timeout)
+            except (OSError, websockets.WebSocketException, asyncio.TimeoutError) as e:
+                self.on_error(None, e)
+                return
+            self.is_setup.set()
+
+            async for msg in ws:
+                await self.loop.run_in_executor(None, self.on_message, ws, msg)
+        except websockets.ConnectionClosedError as e:
+            # Includes protocol errors, oversized messages, and ping timeouts
+            logger.warning("[Websocket Closed] %s", e)
+        except asyncio.CancelledError:
+            logger.info("[Websocket Closed] Closed by client")
+        except Exception as e:
+            logger.exception("Unhandled exception while reading from the websocket")
+            self.on_error(ws, e)
+        finally:
+            if ws is not None:
+                await ws.close()
+                # The code this side closed with (1002, 1009, 1011 ...), else the server's
+                close = ws.close_sent or ws.close_rcvd
+                self.close_code = close.code if close else ws.close_code
+                logger.info("[Websocket Closed] code=%s reason=%r", self.close_code,
+                            close.reason if close else "")
+            # Setup failures were already reported by on_error()
+            if ws is not None or not self.is_done.is_set():
+                try:
+                    self._notify(self.bindings.values(), "close")
+                finally:
+                    self.is_done.set()
+
+    def _cancel(self):
+        self.closing = True
+        if self.task is not None:
+            self.task.cancel()
+
+    def close(self):
+        """ Close the connection, or give up connecting, from another thread """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._cancel)
+
+
+class EventLoopThread(object):
+    """ An asyncio event loop running in a daemon thread """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self._run, name="asyncio-websockets")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """ Schedule ``coro`` on the loop; returns a concurrent.futures.Future """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+_shared_loop = None
+_shared_loop_lock = Lock()
+
+
+def shared_loop():
+    """ Return the process-wide :class:`EventLoopThread`, starting it if needed """
+    global _shared_loop
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = EventLoopThread()
+        return _shared_loop
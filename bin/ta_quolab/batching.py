@@ -0,0 +1,44 @@
+""" QuoLab Add on for Splunk adaptive batch sizing for paginated API calls
+"""
+
+
+class AdaptiveBatchSize(object):
+    """ Pick the number of records to request per HTTP call based on how long
+    previous calls took and how large their responses were.
+
+    Start small (``floor``) so the first results are returned quickly, then
+    grow (at most doubling per call) toward ``ceiling`` as long as responses
+    stay within ``target_time`` seconds and ``target_bytes``.  Slow or heavy
+    responses (for example, large 'document' facets) shrink the batch size
+    right away.
+    """
+
+    def __init__(self, floor, ceiling, target_time, target_bytes=8 * 1024 * 1024):
+        self.floor = max(1, min(floor, ceiling))
+        self.ceiling = ceiling
+        self.target_time = target_time
+        self.target_bytes = target_bytes
+        self.size = self.floor
+        self.history = []
+
+    def update(self, requested, records, elapsed, size_bytes):
+        """ Record the outcome of a call that asked for ``requested`` records and
+        got back ``records`` records (``size_bytes`` long) in ``elapsed`` seconds.
+        Returns the batch size to use for the next call. """
+        self.history.append(requested)
+        if records <= 0:
+            return self.size
+        ideal = self.ceiling
+        if elapsed > 0 and self.target_time:
+            ideal = min(ideal, self.target_time * records / elapsed)
+        if size_bytes > 0 and self.target_bytes:
+            ideal = min(ideal, self.target_bytes * records / size_bytes)
+        if records < requested:
+            # Short page; there's nothing to learn about larger batches
+            ideal = min(ideal, self.size)
+        size = min(int(ideal), self.size * 2)
+        self.size = max(self.floor, min(self.ceiling, size))
+        return self.size
+
+    def __str__(self):
+        return ",".join(str(size) for size in self.history)
@@ -2,7 +2,7 @@
 import sys
 import json
 
-from .const import quolab_classes, facets
+from .const import quolab_classes, facets, resolve_override
 
 
 def build_searchbnf(stream=sys.stdout):
@@ -22,6 +22,21 @@ def build_searchbnf(stream=sys.stdout):
     stream.write("syntax = ({})\n".format("|".join(sorted(facets))))
 
 
+def build_class_from_type(classes=quolab_classes, overrides=resolve_override):
+    """ Build the type to class lookup table (const.quolab_class_from_type).
+    Types that belong to more than one class must be listed in ``overrides``. """
+    class_from_type = {}
+    for class_, types in classes.items():
+        for type_ in types:
+            if type_ in class_from_type:
+                if type_ not in overrides:
+                    raise AssertionError("Duplicate entry for {}:  {} vs {}".format(
+                        type_, class_from_type[type_], class_))
+                class_ = overrides[type_]
+            class_from_type[type_] = class_
+    return class_from_type
+
+
 def build_facets(data):
     """ Data from facets-serves.json
 
@@ -74,6 +89,10 @@ def build_from_json(output=sys.stdout):
     pprint(qlc, stream=output, **pp_args)
     output.write("\n\n")
 
+    output.write("quolab_class_from_type = ")
+    pprint(build_class_from_type(qlc), stream=output, **pp_args)
+    output.write("\n\n")
+
     data = json.load(open("facet-services.json"))
     facets = build_facets(data)
     output.write("facets = ")
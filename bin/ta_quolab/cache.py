@@ -0,0 +1,264 @@
+""" QuoLab Add on for Splunk on-disk cache for catalog query results
+
+Each cache entry is made up of two files:
+
+    <key>.<id>.jsonl    One JSON encoded result per line
+    <key>.meta          Small JSON document describing the entry, including
+                        the name of its data file
+
+Every store writes a new data file, and commits the entry by atomically
+replacing the '.meta' file.  So the '.meta' file always names the data file
+it describes; a replaced data file is removed afterwards.  An entry is only
+considered valid once its '.meta' file exists.  The modification time of the
+'.meta' file is updated on every hit, which allows least-recently-used entries
+to be evicted first when the cache grows beyond its size limit.
+
+:class:`LRUCache` is a small in-memory cache for lookups within a single
+search process.
+"""
+
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from logging import getLogger
+
+from .fileutil import replace_file
+
+logger = getLogger("quolab.common")
+
+
+class CatalogCache(object):
+    data_suffix = ".jsonl"
+    meta_suffix = ".meta"
+
+    def __init__(self, directory, ttl, max_bytes, stats=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stats = stats
+
+    @staticmethod
+    def make_key(server, query, **options):
+        """ Build a cache key from the server stanza and the (normalized) query
+        document.  Transient keys that are set during pagination are ignored.
+        Any ``options`` that change the cached output (when set) are included. """
+        query = {k: v for k, v in query.items() if k not in ("limit", "resume")}
+        doc = {"server": server, "query": query}
+        options = {k: v for k, v in options.items() if v}
+        if options:
+            doc["options"] = options
+        doc = json.dumps(doc, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(doc.encode("utf-8")).hexdigest()
+
+    def _incr(self, name, value=1):
+        if self.stats is not None:
+            self.stats.incr(name, value)
+
+    def _meta_path(self, key):
+        return os.path.join(self.directory, key + self.meta_suffix)
+
+    def _new_data_path(self, key):
+        name = "{}.{}-{}{}".format(key, os.getpid(), int(time.time() * 1e6), self.data_suffix)
+        return os.path.join(self.directory, name)
+
+    def _load_meta(self, key):
+        """ Return the meta document of an entry, or None """
+        try:
+            with open(self._meta_path(key)) as fp:
+                meta = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+        # Entries from before data files were named by the meta aren't usable
+        return meta if "data" in meta else None
+
+    def get(self, key, query_limit):
+        """ Return an iterator of cached results if a fresh entry exists that
+        can satisfy ``query_limit``, otherwise return None. """
+        meta_path = self._meta_path(key)
+        meta = self._load_meta(key)
+        if meta is None:
+            self._incr("cache_miss")
+            return None
+
+        if time.time() - meta["created"] > self.ttl:
+            logger.debug("Cache entry %s has expired", key)
+            self._incr("cache_expired")
+            return None
+        if not meta["complete"] and meta["count"] < query_limit:
+            logger.debug("Cache entry %s only has %d of the %d requested results",
+                         key, meta["count"], query_limit)
+            self._incr("cache_miss")
+            return None
+
+        try:
+            fp = open(os.path.join(self.directory, meta["data"]))
+        except (IOError, OSError):
+            # Replaced (and removed) since the meta was read
+            self._incr("cache_miss")
+            return None
+        # Record use for LRU eviction
+        os.utime(meta_path, None)
+        self._incr("cache_hit")
+        return self._read(fp, query_limit)
+
+    def _read(self, fp, query_limit):
+        with fp:
+            for i, line in enumerate(fp):
+                if i >= query_limit:
+                    break
+                self._incr("cache_bytes_read", len(line))
+                yield json.loads(line)
+
+    def store(self, key, results, query_limit, valid=None):
+        """ Pass ``results`` through while writing them to the cache.  The entry
+        is only committed once ``results`` is exhausted and ``valid()`` (if
+        given) returns True.  Abandoned or failed queries are never cached.
+        """
+        data_path = self._new_data_path(key)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fp = open(data_path, "w")
+        except (IOError, OSError) as e:
+            logger.warning("Unable to write to catalog cache %s:  %s", self.directory, e)
+            for result in results:
+                yield result
+            return
+
+        count = 0
+        committed = False
+        try:
+            with fp:
+                for result in results:
+                    fp.write(json.dumps(result, separators=(",", ":")))
+                    fp.write("\n")
+                    count += 1
+                    yield result
+                size = fp.tell()
+            if valid is None or valid():
+                self._commit(key, data_path, count, size, complete=count < query_limit)
+                committed = True
+        finally:
+            if not committed and os.path.exists(data_path):
+                os.unlink(data_path)
+
+    def _commit(self, key, data_path, count, size, complete):
+        meta = {
+            "created": time.time(),
+            "count": count,
+            "complete": complete,
+            "bytes": size,
+            "data": os.path.basename(data_path),
+        }
+        meta_path = self._meta_path(key)
+        old_meta = self._load_meta(key)
+        tmp_meta = "{}.tmp-{}".format(meta_path, os.getpid())
+        with open(tmp_meta, "w") as fp:
+            json.dump(meta, fp)
+        # The entry switches to the new data file in one step
+        replace_file(tmp_meta, meta_path)
+        if old_meta is not None and old_meta["data"] != meta["data"]:
+            self._unlink(os.path.join(self.directory, old_meta["data"]))
+        self._incr("cache_bytes_written", size)
+        logger.debug("Cache entry saved:  %s count=%d bytes=%d", data_path, count, size)
+        self.evict()
+
+    def evict(self):
+        """ Remove expired entries and then the least recently used entries
+        until the total cache size is below ``max_bytes``. """
+        entries = []
+        total = 0
+        now = time.time()
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        in_use = set()
+        for name in names:
+            if not name.endswith(self.meta_suffix):
+                continue
+            key = name[:-len(self.meta_suffix)]
+            meta_path = self._meta_path(key)
+            meta = self._load_meta(key)
+            try:
+                last_used = os.path.getmtime(meta_path)
+            except OSError:
+                continue
+            if meta is None:
+                # Unreadable, or written by an older version
+                if now - last_used > self.ttl:
+                    self._unlink(meta_path)
+                continue
+            in_use.add(meta["data"])
+            try:
+                size = os.path.getsize(os.path.join(self.directory, meta["data"]))
+            except OSError:
+                continue
+            if now - last_used > self.ttl:
+                self._remove(key)
+                continue
+            entries.append((last_used, size, key))
+            total += size
+
+        # Data files left behind by a crash, or replaced by a concurrent store.
+        # Recent ones may still be being written.
+        for name in names:
+            if name.endswith(self.data_suffix) and name not in in_use:
+                path = os.path.join(self.directory, name)
+                try:
+                    if now - os.path.getmtime(path) > self.ttl:
+                        self._unlink(path)
+                except OSError:
+                    pass
+
+        entries.sort()
+        for last_used, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(key)
+            total -= size
+
+    def _remove(self, key):
+        self._incr("cache_evicted")
+        meta = self._load_meta(key)
+        self._unlink(self._meta_path(key))
+        if meta is not None:
+            self._unlink(os.path.join(self.directory, meta["data"]))
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class LRUCache(object):
+    """ Small in-memory least-recently-used mapping with at most ``maxsize`` entries """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        # Move to the most recently used position
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
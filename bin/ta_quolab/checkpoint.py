@@ -0,0 +1,119 @@
+""" QuoLab Add on for Splunk append-only checkpoint of ingested event ids
+
+Rather than rewriting the whole id history on every save (which is what a
+JSON checkpoint does), new ids are appended to a log file, one per line:
+
+    <input>.ids     Ids in the order they were ingested, oldest first
+
+Once the log holds ``compact_ratio`` times as many ids as are being kept, it
+is compacted by atomically replacing it with just the ids still in use.  On
+load, a partially written last line (from a crash mid-write) is ignored, so at
+most the ids appended since the last :meth:`EventIdJournal.flush` are lost.
+
+The ``fsync`` policy controls durability vs cost:
+
+    always      Flush and fsync after every id
+    batch       fsync on each call to flush() (default)
+    never       Flush to the OS but leave syncing to it
+"""
+
+import os
+from logging import getLogger
+
+from six.moves.urllib.parse import quote
+
+from .fileutil import replace_file
+
+logger = getLogger("quolab.common")
+
+fsync_policies = ("always", "batch", "never")
+
+
+class EventIdJournal(object):
+    suffix = ".ids"
+
+    def __init__(self, checkpoint_dir, input_name, fsync="batch", compact_ratio=2):
+        if fsync not in fsync_policies:
+            raise ValueError("Unknown fsync policy '{}'.  Pick from {}"
+                             .format(fsync, ", ".join(fsync_policies)))
+        self.checkpoint_dir = checkpoint_dir
+        self.input_name = input_name
+        self.fsync = fsync
+        self.compact_ratio = compact_ratio
+        name = quote(input_name.replace("://", "__"), safe="")
+        self.path = os.path.join(checkpoint_dir, name + self.suffix)
+        self.lines = 0
+        self._pending = []
+        self._fp = None
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def load(self, index):
+        """ Add all ids from the journal to ``index`` (oldest first).  Returns
+        the number of ids read. """
+        self.lines = 0
+        try:
+            fp = open(self.path, "rb+")
+        except (IOError, OSError):
+            return 0
+        with fp:
+            data = fp.read()
+            complete = data.rfind(b"\n") + 1
+            if complete < len(data):
+                # Drop it, so the next append doesn't get glued onto it
+                logger.warning("Ignoring incomplete last entry in %s", self.path)
+                fp.truncate(complete)
+        event_ids = data[:complete].decode("utf-8").split("\n")[:-1]
+        index.extend(event_ids)
+        self.lines = len(event_ids)
+        logger.debug("Loaded %d event ids from %s", self.lines, self.path)
+        return self.lines
+
+    def append(self, event_id):
+        self._pending.append(event_id)
+        if self.fsync == "always":
+            self.flush()
+
+    def extend(self, event_ids):
+        self._pending.extend(event_ids)
+        if self.fsync == "always":
+            self.flush()
+
+    def flush(self):
+        """ Write out appended ids, and sync them to disk per the fsync policy """
+        if not self._pending:
+            return
+        if self._fp is None:
+            self._fp = open(self.path, "a")
+        self._fp.write("".join(event_id + "\n" for event_id in self._pending))
+        self._fp.flush()
+        if self.fsync != "never":
+            os.fsync(self._fp.fileno())
+        self.lines += len(self._pending)
+        self._pending = []
+
+    def needs_compaction(self, keep):
+        return self.lines + len(self._pending) > keep * self.compact_ratio
+
+    def compact(self, event_ids):
+        """ Replace the contents of the journal with ``event_ids`` """
+        self.close()
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        tmp_path = "{}.tmp-{}".format(self.path, os.getpid())
+        with open(tmp_path, "w") as fp:
+            fp.write("".join(event_id + "\n" for event_id in event_ids))
+            fp.flush()
+            if self.fsync != "never":
+                os.fsync(fp.fileno())
+        replace_file(tmp_path, self.path)
+        logger.info("Compacted event id journal %s from %d to %d entries",
+                    self.path, self.lines, len(event_ids))
+        self.lines = len(event_ids)
+
+    def close(self):
+        self.flush()
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
@@ -102,26 +102,85 @@ facets = [
     'tagged',
 ]
 
-quolab_types = set()
-quolab_class_from_type = {}
-
 resolve_override = {
     "text": "sysfact",
 }
 
+# Class of each type in quolab_classes, with conflicts settled by resolve_override.
+# This is precomputed (see build.build_class_from_type()) to keep it out of the
+# import time of every search command invocation.
+quolab_class_from_type = {
+    'accesses': 'reference',
+    'associated-with': 'sysref',
+    'attribute': 'annotation',
+    'authorizes': 'sysref',
+    'autonomous-system': 'fact',
+    'blob': 'fact',
+    'canceled': 'sysref',
+    'case': 'sysfact',
+    'certificate': 'fact',
+    'commented-by': 'sysref',
+    'connector': 'sysfact',
+    'contains': 'reference',
+    'creates': 'reference',
+    'delivered': 'reference',
+    'domain': 'fact',
+    'email': 'fact',
+    'encases': 'sysref',
+    'endpoint': 'sysfact',
+    'envelope': 'fact',
+    'executed': 'sysref',
+    'export-table': 'fact',
+    'failed': 'sysref',
+    'file': 'fact',
+    'function': 'fact',
+    'geodata': 'annotation',
+    'group': 'sysfact',
+    'hostname': 'fact',
+    'identified-as': 'reference',
+    'implies': 'sysref',
+    'import-table': 'fact',
+    'interpreted-as': 'annotation',
+    'ip-address': 'fact',
+    'known-as': 'annotation',
+    'loads': 'reference',
+    'malware': 'fact',
+    'matches': 'reference',
+    'member-of': 'sysref',
+    'monitors': 'sysref',
+    'mutex': 'fact',
+    'observed-by': 'sysref',
+    'organization': 'fact',
+    'persona': 'fact',
+    'process': 'fact',
+    'produced': 'sysref',
+    'queued': 'sysref',
+    'receives-from': 'reference',
+    'region': 'fact',
+    'registry-key': 'fact',
+    'regulator': 'sysfact',
+    'relates-to': 'reference',
+    'report': 'annotation',
+    'resolved-to': 'reference',
+    'resource': 'sysfact',
+    'scheduled': 'sysref',
+    'script': 'sysfact',
+    'sends-to': 'reference',
+    'signed-by': 'reference',
+    'subscription': 'sysfact',
+    'synchronized-with': 'sysref',
+    'tag': 'sysfact',
+    'tagged': 'sysref',
+    'text': 'sysfact',
+    'timeline': 'sysfact',
+    'tor-descriptor': 'fact',
+    'transaction': 'fact',
+    'ttp': 'fact',
+    'url': 'fact',
+    'user': 'sysfact',
+    'uses': 'sysref',
+    'wallet': 'fact',
+    'yara-rule': 'fact',
+}
 
-def init():
-    for class_, types in quolab_classes.items():
-        for type_ in types:
-            if type_ in quolab_types:
-                if type_ in resolve_override:
-                    class_ = resolve_override[type_]
-                else:
-                    # XXX: This assertion would be better as a unittest
-                    raise AssertionError("Duplicate entry for {}:  {} vs {}".format(
-                        type_, quolab_class_from_type[type_], class_))
-            quolab_types.add(type_)
-            quolab_class_from_type[type_] = class_
-
-
-init()
+quolab_types = frozenset(quolab_class_from_type)
@@ -0,0 +1,72 @@
+""" QuoLab Add on for Splunk overall time budget tracking for API calls
+"""
+
+import socket
+from logging import getLogger
+from threading import Timer
+
+from .stats import monotonic
+
+logger = getLogger("quolab.common")
+
+
+class DeadlineExceeded(Exception):
+    """ The time budget for an operation has been used up """
+    pass
+
+
+class Deadline(object):
+    """ Track the remaining time budget of an operation made up of several HTTP
+    calls, and derive per-request timeouts from it.
+
+    ``connect_timeout`` and ``read_timeout`` are upper limits for individual
+    requests; they are reduced as the deadline approaches.
+    """
+
+    def __init__(self, seconds, connect_timeout=10, read_timeout=None):
+        self.seconds = seconds
+        self.expires = monotonic() + seconds
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def remaining(self):
+        return max(0.0, self.expires - monotonic())
+
+    def expired(self):
+        return monotonic() >= self.expires
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded("Time limit of {} seconds exceeded".format(self.seconds))
+
+    def timeout(self):
+        """ Return a (connect, read) timeout tuple suitable for requests """
+        remaining = self.remaining()
+        if remaining <= 0:
+            self.check()
+        read_timeout = remaining
+        if self.read_timeout:
+            read_timeout = min(self.read_timeout, remaining)
+        return (min(self.connect_timeout, remaining), read_timeout)
+
+    def watch(self, response):
+        """ Return a (started) watchdog timer that aborts the in-flight read of
+        ``response`` once the deadline expires.  Cancel it when done reading. """
+        timer = Timer(self.remaining(), _abort_response, (response,))
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+def _abort_response(response):
+    """ Interrupt any blocking read of a streaming response (best effort).
+    Shutting down the socket wakes up a thread blocked in recv(). """
+    logger.warning("Deadline reached.  Aborting in-flight read from %s", response.url)
+    connection = getattr(response.raw, "connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+    response.close()
@@ -0,0 +1,119 @@
+""" QuoLab Add on for Splunk bounded index of recently seen event ids
+
+:class:`DedupeIndex` remembers the most recent ``maxsize`` ids.  Membership
+is a hash set lookup and the insertion order is kept in a ring buffer so the
+oldest ids are evicted first.  Both operations are constant time, regardless
+of the history size.
+
+For very large histories, an optional :class:`BloomFilter` can be placed in
+front of the set.  Ids the filter has never seen are known to be new without
+touching the set; the set still has the final say, so the filter never
+causes an event to be dropped.  Hashing in Python costs more than a set
+lookup (see tests/bench_dedupe.py), so the filter is off by default.
+"""
+
+import hashlib
+import math
+from collections import deque
+
+
+class BloomFilter(object):
+    """ Probabilistic set membership:  no false negatives, and false positives
+    at roughly ``error_rate`` once ``capacity`` items have been added. """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        bits = int(-capacity * math.log(error_rate) / (math.log(2) ** 2)) or 8
+        self.size = bits
+        self.hashes = max(1, int(round(bits / capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((bits + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        # Double hashing:  k positions from two 64 bit hashes
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def add(self, item):
+        bits = self._bits
+        for pos in self._positions(item):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self._bits
+        for pos in self._positions(item):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def clear(self):
+        self._bits = bytearray(len(self._bits))
+        self.count = 0
+
+
+class DedupeIndex(object):
+    """ Remember the last ``maxsize`` ids, evicting the oldest first.
+
+    Set ``prefilter=True`` to check a Bloom filter before the set.  Bloom
+    filters can't forget, so the filter is rebuilt from the ids still held
+    once as many ids have been evicted as the index can hold.
+    """
+
+    def __init__(self, maxsize, ids=(), prefilter=False):
+        self.maxsize = maxsize
+        self._ids = set()
+        self._ring = deque()
+        self._bloom = BloomFilter(maxsize * 2) if prefilter else None
+        self._evicted = 0
+        self.extend(ids)
+
+    def __len__(self):
+        return len(self._ring)
+
+    def __contains__(self, id_):
+        bloom = self._bloom
+        if bloom is not None and id_ not in bloom:
+            return False
+        return id_ in self._ids
+
+    def add(self, id_):
+        """ Remember ``id_``.  Returns False if it was already known. """
+        if id_ in self:
+            return False
+        self._ids.add(id_)
+        self._ring.append(id_)
+        if self._bloom is not None:
+            self._bloom.add(id_)
+        if len(self._ring) > self.maxsize:
+            self._ids.discard(self._ring.popleft())
+            self._evicted += 1
+            if self._evicted >= self.maxsize and self._bloom is not None:
+                self._rebuild_filter()
+        return True
+
+    def extend(self, ids):
+        """ Add many ids, oldest first.  Much faster than add() for loading
+        an empty index. """
+        if self._ring or self._bloom is not None:
+            for id_ in ids:
+                self.add(id_)
+            return
+        # Keeps the first occurrence of each id, in order
+        ids = list(dict.fromkeys(ids))
+        self._ring.extend(ids[-self.maxsize:])
+        self._ids.update(self._ring)
+
+    def _rebuild_filter(self):
+        self._bloom.clear()
+        for id_ in self._ring:
+            self._bloom.add(id_)
+        self._evicted = 0
+
+    def to_list(self):
+        """ Return the remembered ids, oldest first (for checkpointing) """
+        return list(self._ring)
@@ -0,0 +1,121 @@
+""" QuoLab Add on for Splunk batched event output for modular inputs
+
+splunklib's ``EventWriter.write_event()`` builds an ElementTree document and
+flushes the output stream for every single event.  :class:`BatchEventWriter`
+serializes events directly to XML text, buffers them, and writes and flushes
+them together once any of these thresholds is reached:
+
+    max_events      Number of buffered events
+    max_bytes       Size of the buffered XML
+    max_latency     Age (in seconds) of the oldest buffered event
+
+A batch is handed to ``EventWriter.write_event()`` as a single object with
+Event's ``write_to()`` interface, so the ``EventWriter`` still owns the output
+stream and the ``<stream>`` header.  Several writers (for example, one per
+input) can share one ``EventWriter`` by passing the same ``lock``.
+"""
+
+from xml.sax.saxutils import escape
+
+from .stats import monotonic
+
+
+class _EventBatch(object):
+    """ Serialized events, written to the stream in one go (like an Event) """
+
+    def __init__(self, text):
+        self.text = text
+
+    def write_to(self, stream):
+        stream.write(self.text)
+        stream.flush()
+
+
+class BatchEventWriter(object):
+
+    def __init__(self, ew, max_events=100, max_bytes=1024 * 1024, max_latency=1.0,
+                 counter=None, lock=None):
+        self.ew = ew
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.counter = counter if counter is not None else {}
+        self.lock = lock
+        self._buffer = []
+        self._bytes = 0
+        self._oldest = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def _incr(self, name, value=1):
+        self.counter[name] = self.counter.get(name, 0) + value
+
+    @staticmethod
+    def serialize(data, sourcetype=None, time=None, stanza=None):
+        """ Return ``data`` as an ``<event>`` element, as splunklib's Event
+        would write it (unbroken and done) """
+        parts = ['<event unbroken="1"' if stanza is None else
+                 '<event stanza="{}" unbroken="1"'.format(escape(stanza, {'"': "&quot;"})), ">"]
+        if time is not None:
+            parts.append("<time>{}</time>".format(time))
+        if sourcetype is not None:
+            parts.append("<sourcetype>{}</sourcetype>".format(escape(sourcetype)))
+        parts.append("<data>{}</data><done /></event>".format(escape(data)))
+        return "".join(parts)
+
+    def write(self, data, **kwargs):
+        """ Buffer an event.  Returns True if the buffer was written out. """
+        text = self.serialize(data, **kwargs)
+        if not self._buffer:
+            self._oldest = monotonic()
+        self._buffer.append(text)
+        self._bytes += len(text)
+        if len(self._buffer) >= self.max_events:
+            return self.flush("events")
+        if self._bytes >= self.max_bytes:
+            return self.flush("bytes")
+        return False
+
+    def wait_time(self, default):
+        """ Return how long the caller can wait for more events before the
+        buffer must be written out, at most ``default`` seconds. """
+        if not self._buffer:
+            return default
+        return max(0, min(default, self._oldest + self.max_latency - monotonic()))
+
+    def flush_if_due(self):
+        """ Write out the buffer if its oldest event has waited long enough """
+        if self._buffer and monotonic() - self._oldest >= self.max_latency:
+            return self.flush("latency")
+        return False
+
+    def flush(self, reason="forced"):
+        """ Write all buffered events and flush the output stream.  Returns
+        True if anything was written. """
+        if not self._buffer:
+            return False
+        if self.lock is None:
+            self._write()
+        else:
+            with self.lock:
+                self._write()
+        self._incr("batches_written")
+        self._incr("batch_flush_{}".format(reason))
+        self._incr("batch_events", len(self._buffer))
+        self._incr("batch_bytes", self._bytes)
+        self._buffer = []
+        self._bytes = 0
+        self._oldest = None
+        return True
+
+    def _write(self):
+        self.ew.write_event(_EventBatch("".join(self._buffer)))
+
+    def settings_kv(self):
+        batches = self.counter.get("batches_written", 0)
+        events = self.counter.get("batch_events", 0)
+        return "batch_max_events={} batch_max_bytes={} batch_max_latency={} " \
+               "avg_batch_events={:0.1f}".format(self.max_events, self.max_bytes,
+                                                 self.max_latency,
+                                                 events / batches if batches else 0)
@@ -0,0 +1,7 @@
+""" QuoLab Add on for Splunk file helpers shared by the on-disk cache and checkpoints
+"""
+
+import os
+
+# Atomic rename that overwrites an existing file (on all platforms)
+replace_file = getattr(os, "replace", os.rename)
@@ -0,0 +1,164 @@
+""" QuoLab Add on for Splunk record flattening (JSON to Splunk dot-notation fields)
+
+:class:`Flattener` produces the same output as
+:func:`cypresspoint.spath.splunk_dot_notation` but avoids re-computing
+(sanitizing and joining) the same field names for every record.  Records
+returned from a catalog query generally share the same shape, so a tree of
+compiled field paths is kept per record shape (class and type) and reused
+for all subsequent records of that shape.
+
+A projection (see :func:`build_projection`) limits the output to selected
+fields.  Unselected keys are remembered in the same tree, so they're skipped
+without being sanitized or traversed.
+"""
+
+from cypresspoint.spath import sanitize_fieldname
+from six import integer_types, string_types
+
+_scalar_types = string_types + integer_types + (float,)
+
+
+def build_projection(fields):
+    """ Build a projection tree from a list of Splunk dot-notation field names.
+
+    The tree is a nested dictionary of sanitized field name segments where a
+    value of None selects everything below that point.  Lists are implied, so
+    'tagged{}.name' and 'tagged.name' are equivalent.  A trailing '.*' (as in
+    'document.*') selects an entire subtree.
+    """
+    tree = {}
+    for field in fields:
+        parts = field.replace("{}", "").split(".")
+        if parts[-1] == "*":
+            parts.pop()
+        node = tree
+        for part in parts[:-1]:
+            child = node.get(part, {})
+            if child is None:
+                # Parent is already fully selected
+                break
+            node[part] = child
+            node = child
+        else:
+            node[parts[-1]] = None
+    return tree
+
+
+def projection_covers(tree, field):
+    """ Return True if any part of the dot-notation ``field`` is selected by
+    the projection ``tree`` """
+    node = tree
+    for part in field.replace("{}", "").split("."):
+        if part not in node:
+            return False
+        node = node[part]
+        if node is None:
+            return True
+    return True
+
+
+# Placeholder for keys excluded by a projection
+_SKIP = object()
+
+
+class _PathNode(object):
+    """ Compiled field path.  ``name`` is the final Splunk field name.
+    ``projection`` is the projection subtree for this path (None for all). """
+    __slots__ = ("name", "children", "list_node", "projection")
+
+    def __init__(self, name, projection=None):
+        self.name = name
+        self.children = {}
+        self.list_node = None
+        self.projection = projection
+
+
+class Flattener(object):
+    """ Convert records (dictionaries) into Splunk dot-notation fields.
+
+    The number of compiled paths is bounded by ``max_paths``; once exceeded,
+    all compiled paths are discarded and rebuilt as needed.  If a
+    ``projection`` tree is given, only the selected fields are returned.
+    """
+
+    def __init__(self, max_paths=50000, projection=None):
+        self.max_paths = max_paths
+        self.projection = projection
+        self._plans = {}
+        self._paths = 0
+
+    @staticmethod
+    def shape(record):
+        return (record.get("class"), record.get("type"))
+
+    def _child(self, node, key):
+        if self._paths >= self.max_paths:
+            self.clear()
+        field = sanitize_fieldname(key)
+        projection = None
+        if node.projection is not None:
+            if field not in node.projection:
+                node.children[key] = _SKIP
+                self._paths += 1
+                return _SKIP
+            projection = node.projection[field]
+        child = _PathNode(field if node.name is None else node.name + "." + field, projection)
+        node.children[key] = child
+        self._paths += 1
+        return child
+
+    def _list_node(self, node):
+        list_node = node.list_node = _PathNode(node.name + "{}", node.projection)
+        self._paths += 1
+        return list_node
+
+    def clear(self):
+        self._plans = {}
+        self._paths = 0
+
+    def flatten(self, record):
+        """ Return a dictionary of Splunk dot-notation fields for ``record`` """
+        if not isinstance(record, dict):
+            raise ValueError("Expected obj to be a dictionary, received {}"
+                             .format(type(record)))
+        shape = self.shape(record)
+        root = self._plans.get(shape)
+        if root is None:
+            root = self._plans[shape] = _PathNode(None, self.projection)
+        output = {}
+        self._flatten_dict(record, root, output)
+        return output
+
+    __call__ = flatten
+
+    def _flatten_dict(self, obj, node, output):
+        children = node.children
+        for key, value in obj.items():
+            child = children.get(key)
+            if child is None:
+                child = self._child(node, key)
+            if child is _SKIP:
+                continue
+            self._flatten_value(value, child, output)
+
+    def _flatten_value(self, value, node, output):
+        if isinstance(value, dict):
+            self._flatten_dict(value, node, output)
+        elif isinstance(value, list):
+            list_node = node.list_node or self._list_node(node)
+            for item in value:
+                self._flatten_value(item, list_node, output)
+        else:
+            if isinstance(value, bool):
+                value = "true" if value else "false"
+            elif not (value is None or isinstance(value, _scalar_types)):
+                raise TypeError("Unsupported datatype {}".format(type(value)))
+            name = node.name
+            if name in output:
+                existing = output[name]
+                if isinstance(existing, list):
+                    existing.append(value)
+                else:
+                    output[name] = [existing, value]
+            else:
+                output[name] = value
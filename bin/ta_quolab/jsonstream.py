@@ -0,0 +1,196 @@
+""" QuoLab Add on for Splunk incremental JSON parsing for QuoLab API responses
+
+QuoLab API responses are JSON objects with a (potentially very large) list of
+records along with a few small top-level values.  For example:
+
+    {"status": "OK", "records": [{...}, {...}, ...], "ellipsis": "..."}
+
+Rather than loading the entire response into memory before processing the
+first record, :class:`JSONRecordStream` reads the response body one chunk at
+a time and yields each element of 'records' as soon as it is complete.  All
+other top-level values are collected into the ``meta`` dictionary, which is
+complete once iteration finishes.
+
+When ``raw`` is enabled, each record is yielded along with its original JSON
+text (as sent by the server) so that it can be passed along as-is instead of
+being re-serialized.
+"""
+
+import codecs
+import json
+import re
+
+_whitespace = re.compile(r"[ \t\n\r]*")
+_partial_number = re.compile(r"[-+.0-9eE]*$")
+
+
+class TruncatedResponse(ValueError):
+    """ The input ended part way through the JSON document """
+    pass
+
+
+def _is_truncated(error, text):
+    """ Did decoding ``text`` fail with ``error`` only because the input ended too soon? """
+    if error.msg.startswith("Unterminated string"):
+        return True
+    tail = text[error.pos:]
+    if error.msg.startswith("Invalid \\uXXXX escape"):
+        return len(tail) < 6
+    return bool(_partial_number.match(tail)) or \
+        any(literal.startswith(tail) for literal in ("true", "false", "null"))
+
+
+class JSONRecordStream(object):
+    # Minimum number of characters to request from the source when a value is incomplete
+    min_fill = 64 * 1024
+
+    def __init__(self, chunks, array_key="records", raw=False):
+        """ ``chunks`` is an iterable of bytes, such as ``response.iter_content()``. """
+        self.array_key = array_key
+        self.raw = raw
+        self.meta = {}
+        self.count = 0
+        self.bytes = 0
+        self.complete = False
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json_decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, min_chars):
+        """ Read from the source until at least ``min_chars`` have been added to
+        the buffer or the end of the input is reached.  Returns False at EOF. """
+        if self._pos:
+            # Drop data that has already been processed
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        parts = [self._buf]
+        added = 0
+        while added < min_chars:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                parts.append(self._text_decoder.decode(b"", final=True))
+                self._eof = True
+                break
+            self.bytes += len(chunk)
+            text = self._text_decoder.decode(chunk)
+            parts.append(text)
+            added += len(text)
+        self._buf = "".join(parts)
+        return not self._eof
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = _whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or self._eof:
+                return
+            self._fill(1)
+
+    def _peek(self):
+        self._skip_whitespace()
+        return self._buf[self._pos:self._pos + 1]
+
+    def _expect(self, chars):
+        c = self._peek()
+        if not c:
+            raise TruncatedResponse("Expected one of {!r} but found EOF in JSON stream"
+                                    .format(chars))
+        if c not in chars:
+            raise ValueError("Expected one of {!r} but found {!r} in JSON stream"
+                             .format(chars, c))
+        self._pos += 1
+        return c
+
+    def _decode_value(self, raw=False):
+        """ Decode the next complete JSON value from the stream.  If ``raw`` is
+        True, return a tuple of the value and its original JSON text. """
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError as e:
+                if self._eof:
+                    if _is_truncated(e, self._buf):
+                        raise TruncatedResponse("{} (truncated JSON stream)".format(e))
+                    raise
+            else:
+                # A value ending exactly at the end of the buffer (like a number) may be truncated
+                if end < len(self._buf) or self._eof:
+                    start, self._pos = self._pos, end
+                    if raw:
+                        return value, self._buf[start:end]
+                    return value
+            # Incomplete value.  Wait for at least double the amount of pending
+            # data before trying again to keep the re-parsing cost linear.
+            self._fill(max(len(self._buf) - self._pos, self.min_fill))
+
+    def __iter__(self):
+        self._expect("{")
+        if self._peek() == "}":
+            self._pos += 1
+            self.complete = True
+            return
+        while True:
+            key = self._decode_value()
+            self._expect(":")
+            if key == self.array_key and self._peek() == "[":
+                self._pos += 1
+                if self._peek() == "]":
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._decode_value(self.raw)
+                        self.count += 1
+                        if self._expect(",]") == "]":
+                            break
+            else:
+                self.meta[key] = self._decode_value()
+            if self._expect(",}") == "}":
+                break
+        self.complete = True
+
+
+def decode_object_spans(text):
+    """ Decode a JSON object and return a dictionary mapping each top-level key
+    to a tuple of the decoded value and its original JSON text. """
+    if isinstance(text, bytes):
+        text = text.decode("utf-8")
+    decoder = json.JSONDecoder()
+    match = _whitespace.match
+    output = {}
+    pos = match(text).end()
+    if text[pos:pos + 1] != "{":
+        raise ValueError("Expected a JSON object")
+    pos = match(text, pos + 1).end()
+    if text[pos:pos + 1] == "}":
+        return output
+    while True:
+        key, pos = decoder.raw_decode(text, pos)
+        pos = match(text, pos).end()
+        if text[pos:pos + 1] != ":":
+            raise ValueError("Expected ':' at position {}".format(pos))
+        start = match(text, pos + 1).end()
+        value, pos = decoder.raw_decode(text, start)
+        output[key] = (value, text[start:pos])
+        pos = match(text, pos).end()
+        c = text[pos:pos + 1]
+        pos = match(text, pos + 1).end()
+        if c == "}":
+            return output
+        if c != ",":
+            raise ValueError("Expected ',' or '}}' at position {}".format(pos))
+
+
+def append_fields(raw, fields):
+    """ Add ``fields`` to the end of ``raw`` (the JSON text of an object)
+    without decoding and re-encoding the original content. """
+    if not fields:
+        return raw
+    extra = json.dumps(fields, separators=(",", ":"))[1:-1]
+    head = raw[:raw.rindex("}")].rstrip()
+    if head.endswith("{"):
+        return head + extra + "}"
+    return head + "," + extra + "}"
@@ -0,0 +1,82 @@
+""" QuoLab Add on for Splunk shared code for QuoLab search commands
+"""
+
+from cypresspoint.datatype import as_bool
+from splunklib.client import Entity, HTTPError
+
+from .const import facets
+from .flatten import build_projection, projection_covers
+
+# Dot-notation field names accepted by the 'fields' option of search commands
+field_param_regex = r'^[A-Za-z0-9_{}-]+(?:\.[A-Za-z0-9_{}-]+)*(?:\.\*)?$'
+
+
+def apply_projection(query, fields):
+    """ Update the catalog ``query`` to request only the facets needed to
+    produce ``fields`` """
+    projection = build_projection(fields)
+    query_facets = query.get("facets", {})
+    for facet in facets:
+        if projection_covers(projection, facet):
+            query_facets[facet] = 1
+        else:
+            query_facets.pop(facet, None)
+    if query_facets:
+        query["facets"] = query_facets
+    else:
+        query.pop("facets", None)
+
+
+class QuoLabServerMixin(object):
+    """ Load the quolab_servers.conf stanza named by the command's 'server'
+    option and set up ``self.quolab_api`` for it.
+
+    Meant for splunklib search commands; call :meth:`load_server` from
+    ``prepare()`` once the search is known to execute.
+    """
+
+    def load_server(self):
+        """ Configure the QuoLab API and return the server's configuration entity """
+        # Imported here to keep the HTTP stack out of parse-only runs
+        from .api import QuoLabAPI
+        from .transport import transport_options
+
+        self.logger.debug("Fetching API endpoint configurations from Splunkd (quolab_servers.conf)")
+
+        # Determine name of stanza to load
+        try:
+            api = Entity(self.service, "quolab/quolab_servers/{}/full".format(self.server))
+        except HTTPError:
+            self.error_exit(
+                "No known server named '{}', check quolab_servers.conf".format(self.server),
+                "Unknown server named '{}'.  Please update 'server=' option.".format(self.server))
+        except Exception as e:
+            self.logger.exception("Unhandled exception: ")
+            self.write_error("Aborting due to internal error:  {}", e)
+
+        self.api_url = api["url"]
+        self.api_username = api["username"]
+        self.api_fetch_count = int(api["max_batch_size"])
+        self.api_min_fetch_count = int(api.content.get("min_batch_size", self.api_fetch_count))
+        self.api_timeout = int(api["max_execution_time"])
+        self.api_max_concurrency = int(api.content.get("max_concurrency", 1))
+        self.verify = as_bool(api["verify"])
+        if not self.verify:
+            import urllib3
+            urllib3.disable_warnings()
+        self.logger.debug("Entity api: %r", self.api_url)
+        self.api_secret = api["secret"]
+        if not self.api_secret:
+            self.error_exit("Check the configuration.  Unable to fetch data "
+                            "from {} without secret.".format(self.api_url),
+                            "Missing secret.  Did you run setup?")
+
+        # Setup quolab interface
+        self.quolab_api = QuoLabAPI(self.api_url, verify=self.verify)
+        self.quolab_api.configure_transport(**transport_options(api.content))
+        self.quolab_api.max_retries = int(api.content.get("max_retries", QuoLabAPI.max_retries))
+        if self.api_username == "<TOKEN>":
+            self.quolab_api.login_token(self.api_secret)
+        else:
+            self.quolab_api.login(self.api_username, self.api_secret)
+        return api
@@ -0,0 +1,213 @@
+""" QuoLab Add on for Splunk queue that spills to disk instead of blocking
+
+:class:`SpillQueue` holds up to ``maxsize`` items in memory.  Once that's
+full, :meth:`SpillQueue.put` appends items to segment files on disk rather
+than waiting for the consumer, so a producer such as a websocket receive
+callback is never held up by a slow consumer.  Items come back out in the
+order they were put:  memory first, then the segments, oldest first.
+
+    <name>.spill.<n>    One JSON encoded item per line
+
+A segment is deleted once it has been read.  Segments left behind by a
+previous process are picked up when the queue is created, and come out
+first.  Once ``max_spill_bytes`` are waiting on disk, put() blocks
+as a plain queue would.  A ``max_spill_bytes`` of 0 disables spilling.
+"""
+
+import json
+import os
+import re
+import threading
+from collections import deque
+from logging import getLogger
+from queue import Empty
+
+from six.moves.urllib.parse import quote
+
+from .stats import monotonic
+
+logger = getLogger("quolab.common")
+
+
+class SpillQueue(object):
+    segment_bytes = 16 * 1024 * 1024
+
+    def __init__(self, maxsize, spill_dir, name, max_spill_bytes=1024 ** 3, counter=None):
+        self.maxsize = maxsize
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.counter = counter if counter is not None else {}
+        self.prefix = quote(name.replace("://", "__"), safe="") + ".spill."
+        self._memory = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        # Disk state:  items and bytes not yet read back
+        self._disk_items = 0
+        self._disk_bytes = 0
+        self._read_seg = self._write_seg = 0
+        self._rfp = self._wfp = None
+        self._recover()
+        # Segments before this one were written by an earlier process
+        self._live_seg = self._write_seg
+
+    def _incr(self, name, value=1):
+        self.counter[name] = self.counter.get(name, 0) + value
+
+    def _segment_path(self, n):
+        return os.path.join(self.spill_dir, "{}{}".format(self.prefix, n))
+
+    def _recover(self):
+        """ Queue up segments left behind by an earlier process """
+        if not self.spill_dir or not os.path.isdir(self.spill_dir):
+            return
+        pattern = re.compile(r"^{}(\d+)$".format(re.escape(self.prefix)))
+        segments = sorted(int(m.group(1)) for m in map(pattern.match, os.listdir(self.spill_dir))
+                          if m)
+        if not segments:
+            return
+        for n in segments:
+            with open(self._segment_path(n), "rb") as fp:
+                data = fp.read()
+            self._disk_items += data.count(b"\n")
+            self._disk_bytes += len(data)
+        self._read_seg = segments[0]
+        # Don't append to a segment that may end with a partially written line
+        self._write_seg = segments[-1] + 1
+        logger.info("Recovered %d queued items (%d bytes) from %d spill segment(s) in %s",
+                    self._disk_items, self._disk_bytes, len(segments), self.spill_dir)
+
+    def qsize(self):
+        with self._lock:
+            return len(self._memory) + self._disk_items
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def put(self, item):
+        """ Add ``item``.  Only blocks if memory and the spill limit are full. """
+        with self._lock:
+            if not self._disk_items and len(self._memory) < self.maxsize:
+                self._memory.append(item)
+                self._not_empty.notify()
+                return
+            if not self.max_spill_bytes:
+                while len(self._memory) >= self.maxsize:
+                    self._not_full.wait()
+                self._memory.append(item)
+                self._not_empty.notify()
+                return
+            if self._disk_bytes >= self.max_spill_bytes:
+                self._incr("spill_blocked")
+                logger.warning("Spill limit of %d bytes reached.  Waiting for the queue to drain",
+                               self.max_spill_bytes)
+                while self._disk_bytes >= self.max_spill_bytes:
+                    self._not_full.wait()
+            self._spill(item)
+            self._not_empty.notify()
+
+    def _spill(self, item):
+        line = json.dumps([monotonic()] + list(item)) + "\n"
+        data = line.encode("utf-8")
+        if self._wfp is None:
+            if not os.path.isdir(self.spill_dir):
+                os.makedirs(self.spill_dir)
+            self._wfp = open(self._segment_path(self._write_seg), "ab")
+        self._wfp.write(data)
+        self._disk_items += 1
+        self._disk_bytes += len(data)
+        self._incr("spill_events")
+        self._incr("spill_bytes", len(data))
+        if self._wfp.tell() >= self.segment_bytes:
+            self._wfp.close()
+            self._wfp = None
+            self._write_seg += 1
+
+    def _unspill(self):
+        """ Return the oldest item on disk """
+        while self._disk_items:
+            if self._wfp is not None and self._read_seg == self._write_seg:
+                # Reading the segment being written
+                self._wfp.flush()
+            if self._rfp is None:
+                self._rfp = open(self._segment_path(self._read_seg), "rb")
+            data = self._rfp.readline()
+            if not data.endswith(b"\n"):
+                # End of a segment, possibly with a partial line left by a crash
+                self._disk_bytes -= len(data)
+                self._rfp.close()
+                self._rfp = None
+                os.remove(self._segment_path(self._read_seg))
+                self._read_seg += 1
+                continue
+            self._disk_items -= 1
+            self._disk_bytes -= len(data)
+            try:
+                record = json.loads(data.decode("utf-8"))
+            except ValueError:
+                logger.warning("Dropping corrupt entry from spill segment %s", self._rfp.name)
+                self._incr("spill_corrupt")
+                continue
+            live = self._read_seg >= self._live_seg
+            if not self._disk_items:
+                self._drop_segments()
+            if live:
+                self._incr("spill_latency_ms", int((monotonic() - record[0]) * 1000))
+                self._incr("spill_read_events")
+            return tuple(record[1:])
+        self._drop_segments()
+        raise Empty
+
+    def _drop_segments(self):
+        """ Everything on disk has been read; remove it """
+        for fp in (self._rfp, self._wfp):
+            if fp is not None:
+                fp.close()
+        self._rfp = self._wfp = None
+        for n in range(self._read_seg, self._write_seg + 1):
+            path = self._segment_path(n)
+            if os.path.exists(path):
+                os.remove(path)
+        self._write_seg += 1
+        self._read_seg = self._write_seg
+        self._disk_items = self._disk_bytes = 0
+
+    def _get(self):
+        item = self._memory.popleft() if self._memory else self._unspill()
+        self._not_full.notify_all()
+        return item
+
+    def get(self, block=True, timeout=None):
+        with self._lock:
+            if block:
+                end = None if timeout is None else monotonic() + timeout
+                while not (self._memory or self._disk_items):
+                    remaining = None if end is None else end - monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise Empty
+                    self._not_empty.wait(remaining)
+            elif not (self._memory or self._disk_items):
+                raise Empty
+            return self._get()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def close(self):
+        """ Close open segments.  Items still on disk are kept for next time. """
+        with self._lock:
+            for fp in (self._rfp, self._wfp):
+                if fp is not None:
+                    fp.close()
+            self._rfp = self._wfp = None
+
+    def stats_kv(self):
+        with self._lock:
+            memory = len(self._memory)
+            disk_items = self._disk_items
+            disk_bytes = self._disk_bytes
+        reads = self.counter.get("spill_read_events", 0)
+        return "queue_depth={} queue_memory={} queue_spilled={} queue_spill_bytes={} " \
+               "avg_spill_latency_ms={:0.1f}".format(
+                   memory + disk_items, memory, disk_items, disk_bytes,
+                   self.counter.get("spill_latency_ms", 0) / reads if reads else 0)
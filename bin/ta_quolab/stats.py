@@ -0,0 +1,86 @@
+""" QuoLab Add on for Splunk counters and timers for tracking API performance
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    from time import monotonic
+except ImportError:
+    # Good-enough fallback for PY2 users
+    from time import time as monotonic
+
+
+class QueryStats(object):
+    """ Simple collection of counters and (cumulative) timers for a single query.
+
+    Counters and timers are kept separate so that timers can be reported with
+    a consistent precision.  Note that updating the same key from multiple
+    threads is not safe; each thread should update its own keys.
+    """
+
+    def __init__(self):
+        self.counters = Counter()
+        self.timers = Counter()
+        self.start = monotonic()
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def add_time(self, name, seconds):
+        self.timers[name] += seconds
+
+    @contextmanager
+    def timer(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.timers[name] += monotonic() - start
+
+    def merge(self, other):
+        """ Combine counters and timers from another (completed) QueryStats """
+        self.counters.update(other.counters)
+        self.timers.update(other.timers)
+
+    @property
+    def duration(self):
+        return monotonic() - self.start
+
+    def to_kv(self):
+        parts = ["{}={}".format(k, v) for k, v in sorted(self.counters.items())]
+        parts.extend("{}={:0.3f}".format(k, v) for k, v in sorted(self.timers.items()))
+        return " ".join(parts)
+
+
+def time_producer(iterable, stats, name):
+    """ Pass items through from ``iterable`` while adding the time spent
+    producing them to the ``name`` timer. """
+    it = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            start = monotonic()
+            try:
+                item = next(it)
+            finally:
+                elapsed += monotonic() - start
+            yield item
+    except StopIteration:
+        return
+    finally:
+        stats.add_time(name, elapsed)
+
+
+def time_consumer(iterable, stats, name):
+    """ Pass items through from ``iterable`` while adding the time the caller
+    spends processing each item (the time between requests for the next item)
+    to the ``name`` timer. """
+    elapsed = 0.0
+    try:
+        for item in iterable:
+            start = monotonic()
+            yield item
+            elapsed += monotonic() - start
+    finally:
+        stats.add_time(name, elapsed)
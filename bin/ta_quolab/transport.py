@@ -0,0 +1,116 @@
+""" QuoLab Add on for Splunk HTTP transport tuning for QuoLab API access
+"""
+
+import socket
+import zlib
+from logging import getLogger
+
+from cypresspoint.datatype import as_bool
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+from .stats import monotonic
+
+logger = getLogger("quolab.common")
+
+
+# Mapping of quolab_servers.conf settings to QuoLabAPI.configure_transport() arguments
+TRANSPORT_SETTINGS = {
+    "http_pool_connections": ("pool_connections", int),
+    "http_pool_maxsize": ("pool_maxsize", int),
+    "http_keep_alive": ("keep_alive", as_bool),
+    "http_compression": ("compression", as_bool),
+    "tcp_nodelay": ("tcp_nodelay", as_bool),
+    "tcp_keepalive": ("tcp_keepalive", as_bool),
+}
+
+
+def transport_options(conf):
+    """ Build keyword arguments for :meth:`QuoLabAPI.configure_transport` from
+    a quolab_servers.conf stanza.  Settings that aren't present are skipped. """
+    options = {}
+    for setting, (name, convert) in TRANSPORT_SETTINGS.items():
+        value = conf.get(setting)
+        if value not in (None, ""):
+            options[name] = convert(value)
+    return options
+
+
+def build_socket_options(tcp_nodelay=True, tcp_keepalive=False):
+    options = [opt for opt in HTTPConnection.default_socket_options
+               if opt[:2] != (socket.IPPROTO_TCP, socket.TCP_NODELAY)]
+    if tcp_nodelay:
+        options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+    if tcp_keepalive:
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    return options
+
+
+class TunedHTTPAdapter(HTTPAdapter):
+    """ HTTPAdapter that applies custom socket options to new connections """
+
+    def __init__(self, socket_options=None, **kwargs):
+        self.socket_options = socket_options
+        super(TunedHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options is not None:
+            kwargs["socket_options"] = self.socket_options
+        super(TunedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+class _Decompressor(object):
+    def __init__(self, encoding):
+        if encoding == "gzip":
+            self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._obj = zlib.decompressobj()
+        # Some servers send raw deflate data without the zlib header
+        self._raw_deflate_fallback = encoding == "deflate"
+
+    def decompress(self, data):
+        try:
+            return self._obj.decompress(data)
+        except zlib.error:
+            if not self._raw_deflate_fallback:
+                raise
+            self._raw_deflate_fallback = False
+            self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._obj.decompress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+
+def iter_response_chunks(response, chunk_size, stats=None, deadline=None):
+    """ Iterate over the (decoded) body of a streaming ``response``.  Unlike
+    ``response.iter_content()``, this keeps track of the number of bytes
+    received on the wire, the time spent waiting on reads ('http_read'), and
+    the time spent decompressing the content.
+    If a ``deadline`` is given, it's checked before each read. """
+    raw = response.raw
+    encoding = response.headers.get("content-encoding", "").lower()
+    decoder = _Decompressor(encoding) if encoding in ("gzip", "deflate") else None
+    while True:
+        if deadline is not None:
+            deadline.check()
+        start = monotonic()
+        chunk = raw.read(chunk_size, decode_content=False)
+        if stats is not None:
+            # Updated per chunk so totals are complete even if iteration stops early
+            stats.add_time("http_read", monotonic() - start)
+            stats.incr("wire_bytes", len(chunk))
+        if not chunk:
+            break
+        if decoder:
+            start = monotonic()
+            chunk = decoder.decompress(chunk)
+            if stats is not None:
+                stats.add_time("decompress", monotonic() - start)
+            if not chunk:
+                continue
+        yield chunk
+    if decoder:
+        tail = decoder.flush()
+        if tail:
+            yield tail
@@ -0,0 +1,140 @@
+""" QuoLab Add on for Splunk background worker helpers
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from threading import Event, Thread
+
+try:
+    from queue import Empty, Full, Queue
+except ImportError:
+    from Queue import Empty, Full, Queue
+
+from .deadline import DeadlineExceeded
+from .stats import monotonic
+
+logger = getLogger("quolab.common")
+
+_ITEM, _DONE, _ERROR = range(3)
+
+
+def prefetch(iterable, depth, deadline=None, grace=5.0):
+    """ Iterate over ``iterable`` from a background thread, keeping up to
+    ``depth`` items ready ahead of the consumer.  This allows slow producers
+    (like paginated HTTP calls) to overlap with the consumer's processing.
+
+    The worker starts right away, not on the first ``next()``, so several
+    prefetched iterables make progress at the same time.  Exceptions raised by
+    the producer are re-raised in the consumer's thread.  Closing the returned
+    iterator (or abandoning it early) stops the worker after its current item.
+
+    The consumer never waits on a worker that has died, or (if a
+    ``deadline`` is given) for more than ``grace`` seconds past the
+    deadline; :class:`DeadlineExceeded` is raised instead.
+    """
+    queue = Queue(depth)
+    stop = Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put((_ITEM, item)):
+                    break
+            else:
+                put((_DONE, None))
+        except Exception as e:
+            put((_ERROR, e))
+        finally:
+            close = getattr(iterable, "close", None)
+            if close:
+                close()
+
+    t = Thread(target=worker, name="prefetch")
+    t.daemon = True
+    t.start()
+    return _Prefetched(_consume(queue, stop, t, deadline, grace), stop)
+
+
+class _Prefetched(object):
+    """ Iterator returned by :func:`prefetch`.  Unlike a plain generator, its
+    worker is also stopped when it's closed before the first item is read. """
+
+    def __init__(self, items, stop):
+        self._items = items
+        self._stop = stop
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._items)
+
+    next = __next__
+
+    def close(self):
+        self._stop.set()
+        self._items.close()
+
+
+def _consume(queue, stop, t, deadline, grace):
+    try:
+        while True:
+            try:
+                kind, value = queue.get(timeout=0.5)
+            except Empty:
+                if not t.is_alive() and queue.empty():
+                    raise RuntimeError("Prefetch worker stopped without a result")
+                if deadline is not None and deadline.remaining() <= 0:
+                    if deadline.expires + grace <= monotonic():
+                        raise DeadlineExceeded("Prefetch worker did not finish within {} seconds "
+                                               "of the deadline".format(grace))
+                continue
+            if kind == _DONE:
+                return
+            if kind == _ERROR:
+                raise value
+            yield value
+    finally:
+        stop.set()
+        # Let the producer wind down (and run its cleanup) before returning
+        t.join(1.0)
+
+
+def throttle(iterable, slots):
+    """ Pass items through from ``iterable``, holding one of ``slots`` (a
+    Semaphore) while each item is produced.  This limits how many producers
+    sharing the same ``slots`` do work at the same time. """
+    it = iter(iterable)
+    try:
+        while True:
+            with slots:
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+    finally:
+        close = getattr(it, "close", None)
+        if close:
+            close()
+
+
+def fan_out(func, items, max_workers):
+    """ Call ``func(item)`` for each item on a bounded pool of worker threads.
+    Returns a list of results in the same order as ``items``.  The first
+    exception raised by any call is re-raised in the caller's thread.
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(min(max_workers, len(items))) as executor:
+        return list(executor.map(func, items))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+""" Micro-benchmark: timeline event id checkpoint load and save costs
+
+Compares the JSON checkpoint (the whole id list rewritten every 50 events)
+with the append-only EventIdJournal (only new ids written every 50 events).
+
+Usage:  python tests/bench_checkpoint.py [events]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from cypresspoint.checkpoint import ModInputCheckpoint
+from ta_quolab.checkpoint import EventIdJournal
+from ta_quolab.dedupe import DedupeIndex
+
+SIZES = (10000, 100000, 1000000)
+BATCH = 50
+
+
+def bench_json(directory, history, stream):
+    cp = ModInputCheckpoint(directory, "json")
+    cp.load()
+    cp.dump_after_updates = BATCH
+    index = DedupeIndex(len(history), history)
+    cp["event_ids"] = index.to_list()
+    cp.dump()
+
+    start = timeit.default_timer()
+    for i, event_id in enumerate(stream, 1):
+        index.add(event_id)
+        if i % BATCH == 0:
+            cp["event_ids"] = index.to_list()
+            cp.dump()
+    save = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    cp = ModInputCheckpoint(directory, "json")
+    cp.load()
+    DedupeIndex(len(history), cp["event_ids"])
+    load = timeit.default_timer() - start
+    return save, load
+
+
+def bench_journal(directory, history, stream, fsync):
+    journal = EventIdJournal(directory, "journal-" + fsync, fsync=fsync)
+    index = DedupeIndex(len(history), history)
+    journal.compact(index.to_list())
+
+    start = timeit.default_timer()
+    for i, event_id in enumerate(stream, 1):
+        index.add(event_id)
+        journal.append(event_id)
+        if i % BATCH == 0:
+            journal.flush()
+    journal.close()
+    save = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    journal = EventIdJournal(directory, "journal-" + fsync, fsync=fsync)
+    journal.load(DedupeIndex(len(history)))
+    load = timeit.default_timer() - start
+    return save, load
+
+
+def main(events=1000):
+    directory = tempfile.mkdtemp()
+    try:
+        print("{:>9} {:<14} {:>14} {:>10}".format("history", "format", "save us/event", "load ms"))
+        for size in SIZES:
+            history = ["{:032x}".format(i) for i in range(size)]
+            stream = ["{:032x}".format(i) for i in range(size, size + events)]
+            for name, bench in [
+                ("json", lambda: bench_json(directory, history, stream)),
+                ("journal/batch", lambda: bench_journal(directory, history, stream, "batch")),
+                ("journal/never", lambda: bench_journal(directory, history, stream, "never")),
+            ]:
+                save, load = bench()
+                print("{:>9} {:<14} {:>14.1f} {:>10.1f}".format(
+                    size, name, save / events * 1e6, load * 1e3))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
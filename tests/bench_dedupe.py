@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+""" Micro-benchmark: per-event cost of timeline event id dedupe
+
+Compares the original list based history (only at the smallest size; it's
+O(n) per event) with DedupeIndex, with and without the Bloom pre-filter.
+Half of the events are duplicates of recent ids.
+
+Usage:  python tests/bench_dedupe.py [events]
+"""
+import os
+import sys
+import timeit
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from ta_quolab.dedupe import DedupeIndex
+
+SIZES = (10000, 100000, 1000000)
+
+
+def make_ids(history, events):
+    ids = ["{:032x}".format(i) for i in range(history + events)]
+    stream = []
+    for i in range(events):
+        # Alternate new ids with recently seen ones
+        stream.append(ids[history + i] if i % 2 else ids[history + i - 100])
+    return ids[:history], stream
+
+
+def run_list(history, stream, size):
+    known_ids = list(history)
+    for event_id in stream:
+        if event_id in known_ids:
+            continue
+        known_ids.append(event_id)
+        if len(known_ids) > size:
+            del known_ids[0]
+
+
+def time_index(history, stream, size, prefilter, repeat=3):
+    """ Time adding ``stream`` to a freshly loaded index (load time excluded) """
+    best = None
+    for _ in range(repeat):
+        index = DedupeIndex(size, history, prefilter=prefilter)
+        start = timeit.default_timer()
+        for event_id in stream:
+            index.add(event_id)
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(events=20000):
+    print("{:>9} {:>12} {:>12} {:>14}".format("history", "list us/ev", "index us/ev",
+                                              "prefilter us/ev"))
+    for size in SIZES:
+        history, stream = make_ids(size, events)
+        if size <= 10000:
+            base = min(timeit.repeat(lambda: run_list(history, stream, size), number=1, repeat=3))
+            base = "{:12.2f}".format(base / events * 1e6)
+        else:
+            base = "{:>12}".format("-")
+        plain = time_index(history, stream, size, False)
+        bloom = time_index(history, stream, size, True)
+        print("{:>9} {} {:12.2f} {:14.2f}".format(size, base, plain / events * 1e6,
+                                                  bloom / events * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
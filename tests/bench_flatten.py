@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+""" Micro-benchmark: compare Flattener against cypresspoint's splunk_dot_notation
+
+Usage:  python tests/bench_flatten.py [record_count]
+"""
+import os
+import sys
+import timeit
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from catalog_samples import make_records
+from cypresspoint.spath import splunk_dot_notation
+from ta_quolab.flatten import Flattener
+
+PAYLOADS = [
+    ("ids-only", ()),
+    ("display", ("display",)),
+    ("display,refcount,tagged", ("display", "refcount", "tagged")),
+    ("document", ("document",)),
+    ("all", ("display", "refcount", "tagged", "document")),
+]
+
+
+def main(count=5000):
+    print("{:<26} {:>12} {:>12} {:>8}".format("payload", "spath us/rec", "plan us/rec", "speedup"))
+    for name, facets in PAYLOADS:
+        records = make_records(count, facets=facets)
+        flattener = Flattener()
+        assert [flattener.flatten(r) for r in records] == [splunk_dot_notation(r) for r in records]
+
+        base = min(timeit.repeat(lambda: [splunk_dot_notation(r) for r in records],
+                                 number=1, repeat=5))
+        plan = min(timeit.repeat(lambda: [flattener.flatten(r) for r in records],
+                                 number=1, repeat=5))
+        print("{:<26} {:>12.2f} {:>12.2f} {:>7.2f}x".format(
+            name, base / count * 1e6, plan / count * 1e6, base / plan))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
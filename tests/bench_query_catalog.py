@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+""" Benchmark: QuoLabAPI.query_catalog() against a local mock QuoLab server
+
+The mock server (mock_quolab.py) runs in a separate process so that its CPU
+and memory use don't skew the client side measurements.
+
+Usage:  python tests/bench_query_catalog.py [--records N] [--facets a,b] [--latency SECS] ...
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from ta_quolab.api import QuoLabAPI
+from ta_quolab.stats import QueryStats
+
+SCENARIOS = [
+    # name, facets, doc_size
+    ("ids-only", "", 0),
+    ("display,refcount,tagged", "display,refcount,tagged", 0),
+    ("document", "document", 20),
+]
+
+
+def start_server(records, facets, doc_size, latency, compress=True):
+    cmd = [sys.executable, os.path.join(os.path.dirname(__file__), "mock_quolab.py"),
+           "--records", str(records), "--facets", facets, "--doc-size", str(doc_size),
+           "--latency", str(latency)]
+    if not compress:
+        cmd.append("--no-compress")
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    url = proc.stdout.readline().strip()
+    return proc, url
+
+
+def run_query(url, limit, facets, fetch_count, min_fetch_count, prefetch_depth, compress):
+    api = QuoLabAPI(url)
+    api.configure_transport(compression=compress)
+    api.login_token("benchmark")
+    query = {"query": {"class": "fact", "type": "domain"},
+             "facets": {f: True for f in facets.split(",") if f}}
+    stats = QueryStats()
+
+    tracemalloc.start()
+    start = time.time()
+    first = None
+    count = 0
+    for _ in api.query_catalog(query, limit, timeout=300, fetch_count=fetch_count,
+                               min_fetch_count=min_fetch_count,
+                               prefetch_depth=prefetch_depth, stats=stats):
+        if first is None:
+            first = time.time() - start
+        count += 1
+    duration = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "records": count,
+        "duration": duration,
+        "first": first or 0.0,
+        "bytes": stats.counters["bytes"],
+        "wire_bytes": stats.counters["wire_bytes"],
+        "http_calls": stats.counters["http_calls"],
+        "peak": peak,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--facets", help="Run a single scenario with these facets")
+    parser.add_argument("--doc-size", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="Server delay (in seconds) before each response")
+    parser.add_argument("--fetch-count", type=int, default=1000)
+    parser.add_argument("--min-fetch-count", type=int, default=None)
+    parser.add_argument("--prefetch", type=int, default=2)
+    parser.add_argument("--no-compress", action="store_false", dest="compress")
+    args = parser.parse_args(argv)
+
+    scenarios = SCENARIOS
+    if args.facets is not None:
+        scenarios = [(args.facets or "ids-only", args.facets, args.doc_size)]
+
+    print("records={} latency={} fetch_count={} prefetch={} compress={}".format(
+        args.records, args.latency, args.fetch_count, args.prefetch, args.compress))
+    print("{:<26} {:>9} {:>11} {:>10} {:>10} {:>9} {:>9}".format(
+        "payload", "records/s", "MB/s", "wire MB/s", "first ms", "peak MB", "calls"))
+    for name, facets, doc_size in scenarios:
+        proc, url = start_server(args.records, facets, doc_size, args.latency, args.compress)
+        try:
+            # Warm up the server's record cache (and the client's imports)
+            run_query(url, args.records, facets, args.fetch_count, None, 0, args.compress)
+            r = run_query(url, args.records, facets, args.fetch_count, args.min_fetch_count,
+                          args.prefetch, args.compress)
+        finally:
+            proc.terminate()
+            proc.wait()
+        mb = 1024.0 * 1024
+        print("{:<26} {:>9.0f} {:>11.2f} {:>10.2f} {:>10.1f} {:>9.2f} {:>9d}".format(
+            name, r["records"] / r["duration"], r["bytes"] / r["duration"] / mb,
+            r["wire_bytes"] / r["duration"] / mb, r["first"] * 1000, r["peak"] / mb,
+            r["http_calls"]))
+
+
+if __name__ == '__main__':
+    main()
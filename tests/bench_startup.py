@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+""" Benchmark: cold start latency of the quolabquery search command
+
+Each measurement runs in a fresh interpreter (like Splunk does for each
+search) and reports the median wall clock time in milliseconds.
+
+Usage:  python tests/bench_startup.py [runs]
+"""
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import time
+
+BIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin")
+
+PARSE_ONLY_PREPARE = """
+import quolab_query
+from splunklib.searchcommands.internals import ObjectView
+command = quolab_query.QuoLabQueryCommand()
+command._metadata = ObjectView({"searchinfo": ObjectView({"sid": "searchparsetmp_1"})})
+command._fieldnames = []
+command.type = "domain"
+command.prepare()
+"""
+
+SCENARIOS = [
+    ("interpreter", "pass"),
+    ("import quolab_query", "import quolab_query"),
+    ("parse-only prepare()", PARSE_ONLY_PREPARE),
+    ("+ deferred API imports", "import quolab_query, ta_quolab.api, ta_quolab.transport"),
+]
+
+
+def time_python(code, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", code], cwd=BIN)
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main(runs=11):
+    print("{:<26} {:>10}".format("scenario", "median ms"))
+    for name, code in SCENARIOS:
+        print("{:<26} {:>10.1f}".format(name, time_python(code, runs) * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
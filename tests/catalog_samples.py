@@ -0,0 +1,37 @@
+""" Representative QuoLab catalog records used by tests and benchmarks """
+
+import random
+
+
+def make_record(n, facets=("display", "refcount", "tagged"), doc_size=4, rng=None):
+    """ Build a synthetic catalog record similar to those returned from
+    /v1/catalog/query with the given facets enabled. """
+    rng = rng or random.Random(n)
+    record = {
+        "class": "fact",
+        "type": "domain",
+        "id": "host{:06d}.example.com".format(n),
+    }
+    if "display" in facets:
+        record["display"] = {"label": record["id"], "icon": "domain", "color": None}
+    if "refcount" in facets:
+        record["refcount"] = {"fact": rng.randint(0, 50), "sysfact": rng.randint(0, 5),
+                              "reference": rng.randint(0, 100)}
+    if "tagged" in facets:
+        record["tagged"] = [{"id": "tag-{}".format(rng.randint(0, 20)), "name": "Tag #{}".format(i),
+                             "flagged": bool(i % 2)} for i in range(rng.randint(0, 3))]
+    if "document" in facets:
+        record["document"] = {
+            "first:Min": 1600000000.5 + n,
+            "last:Max": 1600100000.25 + n,
+            "match": {"type": "virtual", "score": rng.random()},
+            "names": ["name-{}".format(i) for i in range(doc_size)],
+            "attributes": [{"key": "k{}".format(i), "value": "v" * (i * 10)}
+                           for i in range(doc_size)],
+            "description": "Synthetic record number {} with some text".format(n),
+        }
+    return record
+
+
+def make_records(count, **kwargs):
+    return [make_record(n, **kwargs) for n in range(count)]
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+""" Local stand-in for the QuoLab HTTP API, used by tests and benchmarks
+
+Serves synthetic records (see catalog_samples.py) from:
+
+    POST /v1/catalog/query              honors 'limit', 'resume' and query 'id' lists,
+                                        returning an 'ellipsis' when more records remain
+    GET  /v1/timeline/<id>/event        returns the timeline's buffer of events
+
+MockTimelineSocket is a websocket stand-in for /v1/socket timeline bindings.
+
+Usage:  python tests/mock_quolab.py [--port N] [--records N] [--latency SECS] ...
+
+When run as a script the server's URL is printed on the first line of output.
+"""
+from __future__ import print_function
+
+import argparse
+import gzip
+import io
+import json
+import re
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:     # pragma: no cover  (py2)
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from catalog_samples import make_record
+
+DEFAULT_FACETS = ("display", "refcount", "tagged")
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    _timeline_path = re.compile(r"^/v1/timeline/([^/]+)/event")
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if self.path.split("?")[0] != "/v1/catalog/query":
+            return self._send(404, {"status": "NotFound", "message": "Unknown path"})
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            query = json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError:
+            return self._send(400, {"status": "BadRequest", "message": "Invalid JSON"})
+        self.server.mock.handle_catalog_query(self, query)
+
+    def do_GET(self):
+        match = self._timeline_path.match(self.path)
+        if not match:
+            return self._send(404, {"status": "NotFound", "message": "Unknown path"})
+        self.server.mock.handle_timeline_events(self, match.group(1))
+
+    def _send(self, status, body):
+        self.server.mock.send_json(self, status, body)
+
+
+class MockQuoLabServer(object):
+    """ Threaded HTTP server that imitates the parts of the QuoLab API used by
+    this add-on.
+
+    ``records`` is the number of catalog records available, each with the
+    given ``facets`` (and ``doc_size`` when the 'document' facet is enabled).
+    Each response is delayed by ``latency`` seconds.  Responses are gzip
+    compressed when the client asks for it, unless ``compress`` is False.
+    """
+
+    def __init__(self, records=1000, facets=DEFAULT_FACETS, doc_size=4, latency=0.0,
+                 timeline_events=100, compress=True, host="127.0.0.1", port=0):
+        self.records = records
+        self.facets = tuple(facets)
+        self.doc_size = doc_size
+        self.latency = latency
+        self.timeline_events = timeline_events
+        self.compress = compress
+        self.requests = []
+        # Catalog queries in progress, and the most seen at once
+        self.active = 0
+        self.max_active = 0
+        self._encoded = {}
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-quolab")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def record_json(self, n):
+        """ Serialized record number ``n``.  Records are generated once and
+        reused, so serving them doesn't skew client side measurements. """
+        text = self._encoded.get(n)
+        if text is None:
+            text = json.dumps(make_record(n, facets=self.facets, doc_size=self.doc_size))
+            self._encoded[n] = text
+        return text
+
+    def handle_catalog_query(self, handler, query):
+        with self._lock:
+            self.requests.append(query)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            self._catalog_query(handler, query)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def _catalog_query(self, handler, query):
+        if handler.headers.get("Authorization") is None:
+            return self.send_json(handler, 401, {"status": "Unauthorized", "message": "No token"})
+        numbers = range(self.records)
+        ids = query.get("query", {}).get("id")
+        if ids:
+            numbers = sorted(int(i.rsplit("host", 1)[-1].split(".")[0]) for i in ids
+                             if i.startswith("host"))
+            numbers = [n for n in numbers if n < self.records]
+        offset = int(query.get("resume", 0))
+        limit = int(query.get("limit", 100))
+        end = min(offset + limit, len(numbers))
+        parts = ['{"status": "OK", "records": [',
+                 ", ".join(self.record_json(n) for n in numbers[offset:end]),
+                 ']']
+        if end < len(numbers):
+            parts.append(', "ellipsis": "{}"'.format(end))
+        parts.append("}")
+        self.send_body(handler, 200, "".join(parts))
+
+    def handle_timeline_events(self, handler, timeline_id):
+        records = ", ".join(self.record_json(n) for n in range(self.timeline_events))
+        self.send_body(handler, 200, '{"status": "OK", "records": [' + records + ']}')
+
+    def send_json(self, handler, status, body):
+        self.send_body(handler, status, json.dumps(body))
+
+    def send_body(self, handler, status, text):
+        if self.latency:
+            time.sleep(self.latency)
+        body = text.encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        if self.compress and "gzip" in handler.headers.get("Accept-Encoding", ""):
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=1) as f:
+                f.write(body)
+            body = buf.getvalue()
+            handler.send_header("Content-Encoding", "gzip")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+class MockTimelineSocket(object):
+    """ Websocket server (on an asyncio loop in its own thread) that imitates
+    QuoLab timeline bindings.  Each bind request is answered with a 'bound'
+    message followed by ``events`` events for that timeline.  More events can
+    be sent with :meth:`push`, or arbitrary bytes with :meth:`send_raw`.  Set
+    ``answer_pings`` to False to simulate a hung connection. """
+
+    def __init__(self, events=10, host="127.0.0.1", port=0):
+        import asyncio
+        import websockets
+        self.events = events
+        self.answer_pings = True
+        self.binds = []
+        self._connections = {}
+        self._loop = asyncio.new_event_loop()
+
+        async def serve():
+            return await websockets.serve(self._handle, host, port, ping_interval=None,
+                                          close_timeout=0.5, process_request=self._check_request)
+        self._server = self._loop.run_until_complete(serve())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop.run_forever, name="mock-socket")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        import asyncio
+
+        async def shutdown():
+            self._server.close()
+            # Finish open connections now, rather than when the stopped loop is collected
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self._thread:
+            asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @staticmethod
+    def event_message(cid, event_id):
+        return json.dumps({"name": "event", "cid": cid,
+                           "body": {"id": event_id, "type": "test"}})
+
+    def _call(self, func):
+        """ Run ``func`` for each open connection on the server's loop """
+        def call():
+            for connections in self._connections.values():
+                for ws in connections:
+                    func(ws)
+        self._loop.call_soon_threadsafe(call)
+
+    def push(self, timeline, event_id):
+        """ Send an event to every connection bound to ``timeline`` """
+        cid = "activity-stream-event-{}".format(timeline)
+
+        def send():
+            for ws in self._connections.get(cid, []):
+                self._loop.create_task(ws.send(self.event_message(cid, event_id)))
+        self._loop.call_soon_threadsafe(send)
+
+    def send_raw(self, data):
+        """ Write ``data`` (bytes, such as a malformed frame) to every connection """
+        self._call(lambda ws: ws.transport.write(data))
+
+    def disconnect(self):
+        """ Drop all connections (without a closing handshake) """
+        self._call(lambda ws: ws.transport.close())
+
+    @staticmethod
+    async def _check_request(path, headers):
+        if path != "/v1/socket" or "Authorization" not in headers:
+            return 403, [], b""
+        return None
+
+    async def _handle(self, ws, path=None):
+        import websockets
+        try:
+            async for message in ws:
+                req = json.loads(message)
+                self.binds.append(req)
+                cid = req["cid"]
+                self._connections.setdefault(cid, []).append(ws)
+                await ws.send(json.dumps({"name": "bound", "cid": cid}))
+                for n in range(self.events):
+                    await ws.send(self.event_message(cid, "{}-{}".format(req["attach"]["cid"], n)))
+                if not self.answer_pings:
+                    # Stop reading, so pings go unanswered
+                    ws.transport.pause_reading()
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for connections in self._connections.values():
+                if ws in connections:
+                    connections.remove(ws)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--facets", default=",".join(DEFAULT_FACETS),
+                        help="Comma separated list of facets to include in each record")
+    parser.add_argument("--doc-size", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Delay (in seconds) before each response")
+    parser.add_argument("--no-compress", action="store_false", dest="compress")
+    args = parser.parse_args(argv)
+    facets = [f for f in args.facets.split(",") if f]
+    server = MockQuoLabServer(args.records, facets, args.doc_size, args.latency,
+                              compress=args.compress, host=args.host, port=args.port)
+    print(server.url)
+    sys.stdout.flush()
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
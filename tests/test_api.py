@@ -0,0 +1,655 @@
+import io
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from datetime import timedelta
+
+import requests
+import urllib3
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from ta_quolab.api import QuoLabAPI, QuoLabWebSocket, TimelineCursor, result_sort_key
+from ta_quolab.deadline import Deadline, DeadlineExceeded
+from ta_quolab.stats import QueryStats
+from ta_quolab.workers import prefetch
+
+from mock_quolab import MockQuoLabServer
+
+
+class FakeRaw(object):
+    def __init__(self, content, max_read):
+        self._fp = io.BytesIO(content)
+        self._max_read = max_read
+
+    def read(self, amt=None, decode_content=None):
+        return self._fp.read(min(amt, self._max_read))
+
+
+class StalledRaw(FakeRaw):
+    """ Return the first part of the content, then block until closed """
+
+    def __init__(self, content, max_read):
+        super(StalledRaw, self).__init__(content[:len(content) // 2], max_read)
+        self.closed = threading.Event()
+
+    def read(self, amt=None, decode_content=None):
+        data = super(StalledRaw, self).read(amt, decode_content)
+        if data:
+            return data
+        if not self.closed.wait(10):
+            raise AssertionError("Stalled read was never aborted")
+        raise urllib3.exceptions.ProtocolError("Connection aborted")
+
+
+class SlowRaw(FakeRaw):
+    """ Take 'delay' seconds for each read """
+
+    def __init__(self, content, max_read, delay):
+        super(SlowRaw, self).__init__(content, max_read)
+        self.delay = delay
+
+    def read(self, amt=None, decode_content=None):
+        time.sleep(self.delay)
+        return super(SlowRaw, self).read(amt, decode_content)
+
+
+class FakeResponse(object):
+    def __init__(self, body, status_code=200):
+        self.status_code = status_code
+        self.elapsed = timedelta(milliseconds=5)
+        self.content = json.dumps(body).encode("utf-8")
+        self.text = self.content.decode("utf-8")
+
+        self.headers = {}
+        self.url = "https://quolab.example"
+        self.reason = "Error"
+        # Use small reads to exercise incremental parsing
+        self.raw = FakeRaw(self.content, 97)
+        self.is_closed = False
+
+    def json(self):
+        return json.loads(self.text)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.is_closed = True
+        closed = getattr(self.raw, "closed", None)
+        if closed is not None:
+            closed.set()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception("HTTP {}".format(self.status_code))
+
+
+class FakeCatalogSession(object):
+    """ Serve 'total' records from /v1/catalog/query honoring limit/resume """
+
+    def __init__(self, total):
+        self.total = total
+        self.requests = []
+        self.timeouts = []
+
+    def request(self, method, url, data=None, **kwargs):
+        query = json.loads(data)
+        self.requests.append(query)
+        self.timeouts.append(kwargs.get("timeout"))
+        offset = int(query.get("resume", 0))
+        numbers = range(self.total)
+        ids = query["query"].get("id")
+        if ids:
+            numbers = sorted(int(i) for i in ids if int(i) < self.total)
+        end = min(offset + query["limit"], len(numbers))
+        body = {
+            "status": "OK",
+            "records": [self.make_record(n) for n in numbers[offset:end]],
+        }
+        if end < len(numbers):
+            body["ellipsis"] = str(end)
+        return FakeResponse(body)
+
+    def make_record(self, n):
+        return {"id": "{:05d}".format(n), "class": "fact", "type": "domain",
+                "document": {"n": n}}
+
+
+class DescendingCatalogSession(FakeCatalogSession):
+    """ Serve records newest first, where 'document.n' is the record's time """
+
+    def make_record(self, n):
+        record = super(DescendingCatalogSession, self).make_record(n)
+        record["document"]["n"] = self.total - 1 - n
+        return record
+
+
+class FlakyCatalogSession(FakeCatalogSession):
+    """ Fail each page once, either before sending a response or part way through it """
+
+    def __init__(self, total, truncate=False):
+        super(FlakyCatalogSession, self).__init__(total)
+        self.truncate = truncate
+        self.failed = set()
+
+    def request(self, method, url, data=None, **kwargs):
+        response = super(FlakyCatalogSession, self).request(method, url, data, **kwargs)
+        resume = json.loads(data).get("resume")
+        if resume in self.failed:
+            return response
+        self.failed.add(resume)
+        if not self.truncate:
+            raise requests.ConnectionError("Connection reset")
+        response.raw = FakeRaw(response.content[:len(response.content) // 2], 97)
+        return response
+
+
+class SlowCatalogSession(FakeCatalogSession):
+    """ Take 'delay' seconds to respond to each request, or stall part way
+    through the response body when 'stall' is set """
+
+    def __init__(self, total, delay=0, stall=False, read_delay=0):
+        super(SlowCatalogSession, self).__init__(total)
+        self.delay = delay
+        self.stall = stall
+        self.read_delay = read_delay
+
+    def request(self, method, url, data=None, **kwargs):
+        response = super(SlowCatalogSession, self).request(method, url, data, **kwargs)
+        time.sleep(self.delay)
+        if self.stall:
+            response.raw = StalledRaw(response.content, 97)
+        elif self.read_delay:
+            response.raw = SlowRaw(response.content, 1024 * 1024, self.read_delay)
+        return response
+
+
+class FakeTimelineSession(object):
+    """ Serve 'total' events from /v1/timeline/<id>/event, 'page_size' at a time
+    (with ellipsis/resume) if given.  With 'flaky', the response for each page
+    is cut short the first time. """
+
+    def __init__(self, total, page_size=None, flaky=False):
+        self.total = total
+        self.page_size = page_size
+        self.flaky = flaky
+        self.failed = set()
+        self.requests = []
+
+    def request(self, method, url, data=None, **kwargs):
+        self.requests.append(dict(data))
+        offset = int(data.get("resume", 0))
+        end = min(offset + (self.page_size or self.total), self.total)
+        body = {"status": "OK",
+                "records": [{"id": "e{:04d}".format(n), "timestamp": n}
+                            for n in range(offset, end)]}
+        if end < self.total:
+            body["ellipsis"] = str(end)
+        response = FakeResponse(body)
+        if self.flaky and offset not in self.failed:
+            self.failed.add(offset)
+            response.raw = FakeRaw(response.content[:len(response.content) // 2], 97)
+        return response
+
+
+def make_api(total, session_class=FakeCatalogSession, **kwargs):
+    api = QuoLabAPI("https://quolab.example")
+    api.retry_backoff = 0
+    api.session = session_class(total, **kwargs)
+    api.login_token("secret")
+    return api
+
+
+class TestPrefetch(unittest.TestCase):
+    def test_order_preserved(self):
+        self.assertEqual(list(prefetch(iter(range(100)), 3)), list(range(100)))
+
+    def test_exception_reraised(self):
+        def gen():
+            yield 1
+            raise ValueError("boom")
+        it = prefetch(gen(), 2)
+        self.assertEqual(next(it), 1)
+        with self.assertRaises(ValueError):
+            next(it)
+
+    def test_worker_died(self):
+        def gen():
+            yield 1
+            # Not caught by the worker, so it never reports back
+            raise SystemExit
+        excepthook = threading.excepthook
+        threading.excepthook = lambda args: None
+        try:
+            it = prefetch(gen(), 2)
+            self.assertEqual(next(it), 1)
+            with self.assertRaises(RuntimeError):
+                next(it)
+        finally:
+            threading.excepthook = excepthook
+
+    def test_stuck_worker(self):
+        release = threading.Event()
+
+        def gen():
+            yield 1
+            release.wait(10)
+            yield 2
+        it = prefetch(gen(), 2, deadline=Deadline(0.1), grace=0.1)
+        self.assertEqual(next(it), 1)
+        with self.assertRaises(DeadlineExceeded):
+            next(it)
+        release.set()
+
+
+class TestQueryCatalog(unittest.TestCase):
+    def run_query(self, total, limit, fetch_count, prefetch_depth=0):
+        api = make_api(total)
+        stats = QueryStats()
+        query = {"query": {"class": "fact", "type": "domain"}}
+        results = list(api.query_catalog(query, limit, fetch_count=fetch_count,
+                                         prefetch_depth=prefetch_depth, stats=stats))
+        return api, stats, results
+
+    def test_pagination(self):
+        api, stats, results = self.run_query(250, 1000, 100)
+        self.assertEqual(len(results), 250)
+        self.assertEqual(stats.counters["http_calls"], 3)
+        self.assertEqual(results[0]["document.n"], 0)
+        self.assertEqual(json.loads(results[-1]["_raw"])["id"], "00249")
+
+    def test_limit(self):
+        api, stats, results = self.run_query(250, 150, 100)
+        self.assertEqual(len(results), 150)
+        self.assertEqual(stats.counters["http_calls"], 2)
+
+    def test_prefetch_same_results(self):
+        _, _, serial = self.run_query(1000, 1000, 70)
+        _, stats, prefetched = self.run_query(1000, 1000, 70, prefetch_depth=2)
+
+        def strip(rows):
+            return [{k: v for k, v in r.items() if k != "_time"} for r in rows]
+        self.assertEqual(strip(serial), strip(prefetched))
+        self.assertEqual(stats.counters["records"], 1000)
+        self.assertIn("wait", stats.timers)
+
+    def test_no_wait_without_prefetch(self):
+        _, stats, _ = self.run_query(250, 1000, 100)
+        self.assertNotIn("wait", stats.timers)
+
+    def test_parallel_merge(self):
+        api = make_api(1000)
+        ids = ["{:05d}".format(n) for n in range(0, 1000, 3)]
+        queries = [{"query": {"class": "fact", "type": "domain", "id": ids[i::4]}}
+                   for i in range(4)]
+        stats = QueryStats()
+        results = list(api.query_catalog_parallel(queries, 50, max_workers=4,
+                                                  fetch_count=20, stats=stats))
+        self.assertEqual([r["id"] for r in results], ids[:50])
+        self.assertEqual(stats.counters["parallel_queries"], 4)
+        # Only what was returned counts as records
+        self.assertEqual(stats.counters["records"], 50)
+        self.assertGreaterEqual(stats.counters["records_fetched"], 50)
+
+    def test_parallel_errors(self):
+        api = make_api(1000, FlakyCatalogSession)
+        api.max_retries = 0
+        queries = [{"query": {"id": ["{:05d}".format(n) for n in range(i, 100, 2)]}}
+                   for i in range(2)]
+        errors = []
+
+        def write_error(s, *args):
+            errors.append(threading.current_thread())
+        results = list(api.query_catalog_parallel(queries, 50, max_workers=1,
+                                                  write_error=write_error))
+        # The session fails only the first request; the other query succeeds
+        self.assertEqual(len(results), 50)
+        self.assertEqual(errors, [threading.current_thread()])
+
+    def test_sort_key(self):
+        rows = [{"id": "b", "n": 1}, {"id": "a", "n": 2}, {"id": "c"}, {"id": "d", "n": 2}]
+        key = result_sort_key([("n", True), ("id", False)])
+        self.assertEqual([r["id"] for r in sorted(rows, key=key)], ["a", "d", "b", "c"])
+
+    def test_adaptive_batch_size(self):
+        api = make_api(1000)
+        query = {"query": {"class": "fact", "type": "domain"}}
+        results = list(api.query_catalog(query, 1000, fetch_count=400, min_fetch_count=50))
+        self.assertEqual(len(results), 1000)
+        limits = [q["limit"] for q in api.session.requests]
+        self.assertEqual(limits[:4], [50, 100, 200, 400])
+        self.assertEqual(sum(limits), 1000)
+
+    def test_retry_resumes(self):
+        for truncate in (False, True):
+            api = make_api(250, FlakyCatalogSession, truncate=truncate)
+            stats = QueryStats()
+            query = {"query": {"class": "fact", "type": "domain"}}
+            results = list(api.query_catalog(query, 1000, fetch_count=100, stats=stats))
+            self.assertEqual([r["id"] for r in results], ["{:05d}".format(n) for n in range(250)])
+            self.assertEqual(stats.counters["retries"], 3)
+            # Each retry uses the last known ellipsis
+            resumes = [q.get("resume") for q in api.session.requests]
+            self.assertEqual(resumes, [None, None, "100", "100", "200", "200"])
+
+    def test_retry_exhausted(self):
+        api = make_api(250, FlakyCatalogSession)
+        api.max_retries = 0
+        errors = []
+        results = list(api.query_catalog({"query": {}}, 1000, fetch_count=100,
+                                         write_error=lambda *a: errors.append(a)))
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 1)
+
+    def test_no_retry_on_bad_body(self):
+        class HTMLSession(FakeCatalogSession):
+            def request(self, method, url, data=None, **kwargs):
+                response = super(HTMLSession, self).request(method, url, data, **kwargs)
+                response.raw = FakeRaw(b"<html><body>Bad Gateway</body></html>", 97)
+                return response
+
+        api = make_api(250, HTMLSession)
+        stats = QueryStats()
+        errors = []
+        results = list(api.query_catalog({"query": {}}, 1000, fetch_count=100, stats=stats,
+                                         write_error=lambda *a: errors.append(a)))
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(len(api.session.requests), 1)
+        self.assertEqual(stats.counters["retries"], 0)
+
+    def test_error_response_closed(self):
+        class ErrorSession(FakeCatalogSession):
+            """ Reject the first query, then fail with server errors """
+
+            def __init__(self, total):
+                super(ErrorSession, self).__init__(total)
+                self.responses = []
+
+            def request(self, method, url, data=None, **kwargs):
+                super(ErrorSession, self).request(method, url, data, **kwargs)
+                if len(self.requests) == 1:
+                    response = FakeResponse({"status": "error", "message": "Bad query"}, 400)
+                else:
+                    response = FakeResponse({}, 503)
+                self.responses.append(response)
+                return response
+
+        api = make_api(250, ErrorSession)
+        api.max_retries = 2
+        errors = []
+        for _ in range(2):
+            list(api.query_catalog({"query": {}}, 1000, write_error=lambda *a: errors.append(a)))
+        self.assertEqual(len(errors), 2)
+        # One rejected query, and a server error that was retried twice
+        self.assertEqual(len(api.session.responses), 4)
+        self.assertTrue(all(r.is_closed for r in api.session.responses))
+
+    def test_page_time_includes_body(self):
+        class Recorder(object):
+            size = 10
+
+            def __init__(self):
+                self.elapsed = []
+
+            def update(self, limit, count, elapsed, size):
+                self.elapsed.append(elapsed)
+        api = make_api(10, SlowCatalogSession, read_delay=0.05)
+        batch_size = Recorder()
+        for records in api._query_catalog_pages({"query": {}}, 10, Deadline(30), QueryStats(),
+                                                batch_size):
+            for n, record in enumerate(records):
+                if n == 0:
+                    time.sleep(0.2)
+        # Headers arrive after 5ms; reading the body takes longer.  Time spent
+        # by the consumer isn't counted.
+        self.assertGreaterEqual(batch_size.elapsed[0], 0.05)
+        self.assertLess(batch_size.elapsed[0], 0.2)
+
+    def test_phase_stats(self):
+        api = make_api(250)
+        stats = QueryStats()
+        list(api.query_catalog({"query": {}}, 1000, fetch_count=100, stats=stats))
+        self.assertEqual(stats.counters["http_calls"], 3)
+        self.assertEqual(stats.counters["pages"], 3)
+        self.assertEqual(stats.counters["records"], 250)
+        self.assertEqual(stats.counters["wire_bytes"], stats.counters["bytes"])
+        for phase in ("http_request", "http_read", "parse", "flatten"):
+            self.assertIn(phase, stats.timers)
+            self.assertGreaterEqual(stats.timers[phase], 0)
+
+    def test_fields(self):
+        api = make_api(50)
+        results = list(api.query_catalog({"query": {}}, 10, fields=["document.n"]))
+        self.assertEqual(len(results), 10)
+        self.assertEqual(set(results[0]), {"id", "class", "type", "document.n", "_time"})
+        results = list(api.query_catalog({"query": {}}, 10, fields=["id", "_raw"]))
+        self.assertEqual(set(results[0]), {"id", "class", "type", "_raw", "_time"})
+        # Left for the caller to set (after caching)
+        results = list(api.query_catalog({"query": {}}, 10, fields=["id"], default_time=False))
+        self.assertEqual(set(results[0]), {"id", "class", "type"})
+
+    def test_time_field(self):
+        api = make_api(50)
+        stats = QueryStats()
+        results = list(api.query_catalog({"query": {}}, 100, time_field="document.n",
+                                         earliest=10, latest=20, stats=stats))
+        self.assertEqual([r["_time"] for r in results], [float(n) for n in range(10, 20)])
+        self.assertEqual(stats.counters["time_skipped"], 40)
+        # Without a time range, all records are returned with their own time
+        results = list(api.query_catalog({"query": {}}, 100, time_field="document.n"))
+        self.assertEqual(len(results), 50)
+        self.assertEqual(results[-1]["_time"], 49.0)
+
+    def test_time_ordered_cutoff(self):
+        api = make_api(1000, DescendingCatalogSession)
+        stats = QueryStats()
+        results = list(api.query_catalog({"query": {}}, 1000, fetch_count=100,
+                                         time_field="document.n", earliest=850,
+                                         time_ordered=True, stats=stats))
+        self.assertEqual(len(results), 150)
+        self.assertEqual(results[-1]["_time"], 850.0)
+        self.assertEqual(stats.counters["time_cutoff"], 1)
+        # No pages are requested past the earliest time
+        self.assertEqual(len(api.session.requests), 2)
+
+    def test_request_timeouts(self):
+        api = make_api(250)
+        list(api.query_catalog({"query": {}}, 1000, timeout=30, fetch_count=100))
+        self.assertEqual(len(api.session.timeouts), 3)
+        for connect, read in api.session.timeouts:
+            self.assertEqual(connect, api.connect_timeout)
+            self.assertEqual(read, 60)
+
+    def test_deadline_between_pages(self):
+        api = make_api(1000, SlowCatalogSession, delay=0.05)
+        stats = QueryStats()
+        warnings = []
+        results = list(api.query_catalog({"query": {}}, 1000, fetch_count=100, stats=stats,
+                                         deadline=Deadline(0.12),
+                                         write_warning=lambda *a: warnings.append(a)))
+        self.assertTrue(0 < len(results) < 1000)
+        self.assertEqual(stats.counters["expired"], 1)
+        self.assertEqual(len(warnings), 1)
+
+    def test_deadline_aborts_stalled_read(self):
+        api = make_api(1000, SlowCatalogSession, stall=True)
+        stats = QueryStats()
+        warnings = []
+        start = time.time()
+        results = list(api.query_catalog({"query": {}}, 1000, fetch_count=100, stats=stats,
+                                         deadline=Deadline(0.2),
+                                         write_warning=lambda *a: warnings.append(a)))
+        self.assertLess(time.time() - start, 5)
+        self.assertLess(len(results), 100)
+        self.assertEqual(stats.counters["expired"], 1)
+        self.assertEqual(stats.counters["retries"], 0)
+        self.assertEqual(len(warnings), 1)
+
+
+class TestTimelineEvents(unittest.TestCase):
+    ids = ["e{:04d}".format(n) for n in range(250)]
+
+    def test_single_response(self):
+        api = make_api(250, FakeTimelineSession)
+        cursor = TimelineCursor()
+        events = list(api.get_timeline_events("abc", cursor=cursor))
+        self.assertEqual([e["id"] for e in events], self.ids)
+        self.assertEqual(cursor.pages, 1)
+        self.assertNotIn("limit", api.session.requests[0])
+
+    def test_pages(self):
+        api = make_api(250, FakeTimelineSession, page_size=100)
+        events = list(api.get_timeline_events("abc", raw=True, page_size=100))
+        self.assertEqual([record["id"] for record, raw in events], self.ids)
+        self.assertEqual(json.loads(events[-1][1]), events[-1][0])
+        self.assertEqual([r.get("resume") for r in api.session.requests], [None, "100", "200"])
+        self.assertEqual(api.session.requests[0]["limit"], 100)
+
+    def test_retry_resumes(self):
+        api = make_api(250, FakeTimelineSession, page_size=100, flaky=True)
+        cursor = TimelineCursor()
+        events = list(api.get_timeline_events("abc", cursor=cursor))
+        self.assertEqual([e["id"] for e in events], self.ids)
+        self.assertEqual(cursor.retries, 3)
+        self.assertEqual([r.get("resume") for r in api.session.requests],
+                         [None, None, "100", "100", "200", "200"])
+
+    def test_resume_with_cursor(self):
+        api = make_api(250, FakeTimelineSession, flaky=True)
+        api.max_retries = 0
+        cursor = TimelineCursor()
+        received = []
+        with self.assertRaises(ValueError):
+            for event in api.get_timeline_events("abc", cursor=cursor):
+                received.append(event["id"])
+        self.assertEqual(cursor.count, len(received))
+        self.assertGreater(cursor.count, 0)
+        # A later call carries on after the last event received
+        received.extend(e["id"] for e in api.get_timeline_events("abc", cursor=cursor))
+        self.assertEqual(received, self.ids)
+        self.assertTrue(cursor.complete)
+
+
+class TestMockServer(unittest.TestCase):
+    """ End-to-end checks over real HTTP against the local mock QuoLab API """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = MockQuoLabServer(records=1234, facets=("display", "document")).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def make_api(self, compression=True):
+        api = QuoLabAPI(self.server.url)
+        api.configure_transport(compression=compression)
+        api.login_token("secret")
+        return api
+
+    def test_catalog_query(self):
+        for compression in (True, False):
+            stats = QueryStats()
+            results = list(self.make_api(compression).query_catalog(
+                {"query": {}}, 5000, fetch_count=500, min_fetch_count=100, prefetch_depth=2,
+                stats=stats))
+            self.assertEqual(len(results), 1234)
+            self.assertEqual(len(set(r["id"] for r in results)), 1234)
+            self.assertIn("document.match.score", results[0])
+            self.assertEqual(json.loads(results[0]["_raw"])["id"], results[0]["id"])
+            self.assertEqual(stats.counters["retries"], 0)
+            if compression:
+                self.assertLess(stats.counters["wire_bytes"], stats.counters["bytes"])
+            else:
+                self.assertEqual(stats.counters["wire_bytes"], stats.counters["bytes"])
+
+    def test_catalog_query_ids(self):
+        ids = ["host{:06d}.example.com".format(n) for n in (5, 7, 2000)]
+        results = list(self.make_api().query_catalog({"query": {"id": ids}}, 100))
+        self.assertEqual([r["id"] for r in results], ids[:2])
+
+    def test_parallel_queries(self):
+        self.server.latency = 0.1
+        self.addCleanup(setattr, self.server, "latency", 0.0)
+        ids = ["host{:06d}.example.com".format(n) for n in range(10)]
+        queries = [{"query": {"id": [i]}} for i in ids]
+        elapsed = {}
+        for max_workers in (1, 5):
+            self.server.max_active = 0
+            start = time.time()
+            api = self.make_api()
+            results = list(api.query_catalog_parallel(queries, 100, max_workers=max_workers))
+            elapsed[max_workers] = time.time() - start
+            self.assertEqual([r["id"] for r in results], ids)
+            self.assertLessEqual(self.server.max_active, max_workers)
+        self.assertEqual(self.server.max_active, 5)
+        self.assertLess(elapsed[5], elapsed[1] / 2)
+
+    def test_timeline_events(self):
+        events = list(self.make_api().get_timeline_events("abc", raw=True))
+        self.assertEqual(len(events), 100)
+        record, raw = events[0]
+        self.assertEqual(json.loads(raw), record)
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, text):
+        self.sent.append(json.loads(text))
+
+    def close(self):
+        pass
+
+
+class TestWebSocketBindings(unittest.TestCase):
+    def make_socket(self, timelines):
+        qws = QuoLabWebSocket("https://quolab.example", lambda r: r, None, None, None, True)
+        self.received = []
+        for timeline in timelines:
+            qws.add_binding(timeline,
+                            lambda j, raw, t=timeline: self.received.append((t, raw)),
+                            lambda *info, t=timeline: self.received.append((t,) + info[:1]),
+                            facets=["display"])
+        return qws
+
+    def message(self, name, cid, event_id="e1"):
+        return json.dumps({"name": name, "cid": cid, "body": {"id": event_id}})
+
+    def test_bind_all(self):
+        qws = self.make_socket(["tl1", "tl2"])
+        ws = FakeSocket()
+        qws.on_open(ws)
+        self.assertTrue(qws.is_setup.wait(5))
+        self.assertEqual([req["attach"]["cid"] for req in ws.sent], ["tl1", "tl2"])
+        self.assertEqual(ws.sent[1]["cid"], "activity-stream-event-tl2")
+        self.assertEqual(ws.sent[1]["body"]["composition"]["catalog"]["facets"], {"display": True})
+
+    def test_routing(self):
+        qws = self.make_socket(["tl1", "tl2"])
+        qws.on_message(None, self.message("bound", "activity-stream-event-tl2"))
+        qws.on_message(None, self.message("event", "activity-stream-event-tl1", "a"))
+        qws.on_message(None, self.message("event", "activity-stream-event-tl2", "b"))
+        qws.on_message(None, self.message("event", "unknown", "c"))
+        self.assertEqual(self.received, [("tl2", "bound"), ("tl1", '{"id": "a"}'),
+                                         ("tl2", '{"id": "b"}')])
+        qws.on_close(FakeSocket())
+        self.assertEqual(self.received[-2:], [("tl1", "close"), ("tl2", "close")])
+        self.assertTrue(qws.is_done.is_set())
+
+    def test_single_binding_without_cid(self):
+        qws = self.make_socket(["tl1"])
+        qws.on_message(None, json.dumps({"name": "event", "body": {"id": "a"}}))
+        self.assertEqual(self.received, [("tl1", '{"id": "a"}')])
+
+
+if __name__ == '__main__':
+    unittest.main()
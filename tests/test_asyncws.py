@@ -0,0 +1,180 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from mock_quolab import MockTimelineSocket
+from ta_quolab.api import QuoLabAPI, QuolabAuth
+from ta_quolab.asyncws import AsyncQuoLabWebSocket
+
+
+class Recorder(object):
+    """ Collect messages and out-of-band notices of one timeline binding """
+
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.events = []
+        self.notices = []
+        self.closed = threading.Event()
+
+    def message(self, record, raw):
+        self.events.append(json.loads(raw)["id"])
+
+    def oob(self, type, *info):
+        self.notices.append(type)
+        if type == "close":
+            self.closed.set()
+
+    def binding(self):
+        return (self.timeline, self.message, self.oob, ["display"])
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestAsyncEngine(unittest.TestCase):
+    def setUp(self):
+        self.server = MockTimelineSocket(events=5).start()
+        self.api = QuoLabAPI(self.server.url)
+        self.api.login_token("secret")
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_subscribe_many(self):
+        recorders = [Recorder("tl{}".format(i)) for i in range(3)]
+        qws = self.api.subscribe_timelines([r.binding() for r in recorders], engine="asyncio")
+        self.assertTrue(qws.is_setup.is_set())
+        self.assertTrue(wait_for(lambda: all(len(r.events) == 5 for r in recorders)))
+        for r in recorders:
+            self.assertEqual(r.notices, ["bound"])
+            self.assertEqual(r.events[0], "{}-0".format(r.timeline))
+        self.assertEqual([b["attach"]["cid"] for b in self.server.binds], ["tl0", "tl1", "tl2"])
+
+        self.server.push("tl1", "late")
+        self.assertTrue(wait_for(lambda: "late" in recorders[1].events))
+        self.assertNotIn("late", recorders[0].events)
+
+        qws.close()
+        self.assertTrue(qws.is_done.wait(5))
+        self.assertTrue(all(r.closed.is_set() for r in recorders))
+
+    def test_server_disconnect(self):
+        recorder = Recorder("tl0")
+        qws = self.api.subscribe_timelines([recorder.binding()], engine="asyncio")
+        self.assertTrue(wait_for(lambda: len(recorder.events) == 5))
+        self.server.disconnect()
+        self.assertTrue(qws.is_done.wait(5))
+        self.assertIn("close", recorder.notices)
+
+    def make_socket(self, recorder, **settings):
+        qws = AsyncQuoLabWebSocket(self.server.url, self.api.get_auth(), None, None, None, True)
+        for name, value in settings.items():
+            setattr(qws, name, value)
+        qws.add_binding(*recorder.binding())
+        qws.start()
+        return qws
+
+    def test_ping_timeout(self):
+        self.server.answer_pings = False
+        recorder = Recorder("tl0")
+        qws = self.make_socket(recorder, ping_interval=0.05, ping_timeout=0.05)
+        self.assertTrue(qws.is_done.wait(5))
+        self.assertEqual(qws.close_code, 1011)
+        self.assertIn("close", recorder.notices)
+
+    def test_message_too_big(self):
+        recorder = Recorder("tl0")
+        qws = self.make_socket(recorder, max_message_size=1000)
+        self.assertTrue(wait_for(lambda: len(recorder.events) == 5))
+        self.server.push("tl0", "x" * 2000)
+        self.assertTrue(qws.is_done.wait(5))
+        self.assertEqual(qws.close_code, 1009)
+        self.assertEqual(len(recorder.events), 5)
+
+    def test_protocol_errors(self):
+        frames = [
+            b"\xa1\x00",                  # RSV2 set (no extension uses it)
+            b"\x83\x00",                  # Reserved opcode
+            b"\x89\x7e\x00\x80" + b"x" * 128,  # Control frame over 125 bytes
+            b"\x09\x00",                  # Fragmented control frame
+            b"\x81\x7f" + b"\x7f" + b"\xff" * 7,  # 2^63 byte frame
+        ]
+        for frame in frames:
+            recorder = Recorder("tl0")
+            qws = self.make_socket(recorder)
+            self.assertTrue(wait_for(lambda: len(recorder.events) == 5))
+            self.server.send_raw(frame)
+            self.assertTrue(qws.is_done.wait(5), frame)
+            self.assertIn(qws.close_code, (1002, 1009), frame)
+            self.assertIn("close", recorder.notices)
+
+    def test_refused(self):
+        # No Authorization header
+        recorder = Recorder("tl0")
+        qws = AsyncQuoLabWebSocket(self.server.url, lambda r: r, None, None, None, True)
+        qws.add_binding(*recorder.binding())
+        qws.start()
+        self.assertTrue(qws.is_done.wait(5))
+        self.assertEqual(recorder.notices, ["error"])
+
+        recorder = Recorder("tl0")
+        # Nothing listens on port 1
+        api = QuoLabAPI("http://127.0.0.1:1")
+        api.login_token("secret")
+        qws = api.subscribe_timelines([recorder.binding()], engine="asyncio")
+        self.assertTrue(qws.is_done.wait(5))
+        self.assertEqual(recorder.notices[0], "error")
+
+
+class TestSetup(unittest.TestCase):
+    def setUp(self):
+        # Connections are accepted (by the OS) but the handshake is never answered
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.recorder = Recorder("tl0")
+        url = "http://127.0.0.1:{}".format(self.listener.getsockname()[1])
+        self.qws = AsyncQuoLabWebSocket(url, QuolabAuth("secret"), None, None, None, True)
+        self.qws.add_binding(*self.recorder.binding())
+        self.qws.close_timeout = 0.1
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_setup_deadline(self):
+        self.qws.connect_timeout = 0.2
+        start = time.time()
+        self.qws.start()
+        self.assertTrue(self.qws.is_done.wait(5))
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(self.recorder.notices, ["error"])
+        self.assertFalse(self.qws.is_setup.is_set())
+
+    def test_close_while_connecting(self):
+        future = self.qws.start()
+        time.sleep(0.1)
+        self.qws.close()
+        self.assertTrue(self.qws.is_done.wait(5))
+        future.result(5)
+        self.assertEqual(self.recorder.notices, ["close"])
+        self.assertIsNone(self.qws.ws)
+
+    def test_close_before_start(self):
+        future = self.qws.start()
+        self.qws.close()
+        self.assertTrue(self.qws.is_done.wait(5))
+        future.result(5)
+        self.assertEqual(self.recorder.notices, ["close"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from ta_quolab.batching import AdaptiveBatchSize
+
+
+class TestAdaptiveBatchSize(unittest.TestCase):
+    def test_grows_when_fast(self):
+        b = AdaptiveBatchSize(50, 1000, target_time=5)
+        sizes = [b.size]
+        for _ in range(6):
+            sizes.append(b.update(b.size, b.size, 0.1, b.size * 100))
+        self.assertEqual(sizes, [50, 100, 200, 400, 800, 1000, 1000])
+        self.assertEqual(str(b), "50,100,200,400,800,1000")
+
+    def test_shrinks_when_slow(self):
+        b = AdaptiveBatchSize(50, 1000, target_time=5)
+        b.size = 800
+        self.assertEqual(b.update(800, 800, 20.0, 1000), 200)
+        # Never below the floor
+        self.assertEqual(b.update(200, 200, 100.0, 1000), 50)
+
+    def test_shrinks_when_heavy(self):
+        b = AdaptiveBatchSize(10, 1000, target_time=5, target_bytes=1000000)
+        b.size = 500
+        # 10KB per record => 100 records fit in the target size
+        self.assertEqual(b.update(500, 500, 0.1, 500 * 10000), 100)
+
+    def test_short_page_does_not_grow(self):
+        b = AdaptiveBatchSize(50, 1000, target_time=5)
+        self.assertEqual(b.update(50, 10, 0.01, 1000), 50)
+
+    def test_fixed(self):
+        b = AdaptiveBatchSize(500, 500, target_time=5)
+        self.assertEqual(b.update(500, 500, 0.01, 10), 500)
+        self.assertEqual(AdaptiveBatchSize(900, 500, 1).size, 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
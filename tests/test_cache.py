@@ -0,0 +1,134 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from ta_quolab.cache import CatalogCache, LRUCache
+from ta_quolab.stats import QueryStats
+
+
+def make_results(n):
+    return [{"id": str(i), "type": "domain", "_raw": "{}"} for i in range(n)]
+
+
+class TestCatalogCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.stats = QueryStats()
+        self.cache = CatalogCache(self.tmpdir, ttl=60, max_bytes=1024 * 1024, stats=self.stats)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def data_files(self):
+        return sorted(name for name in os.listdir(self.tmpdir) if name.endswith(".jsonl"))
+
+    def data_size(self, key):
+        with open(os.path.join(self.tmpdir, key + ".meta")) as fp:
+            return os.path.getsize(os.path.join(self.tmpdir, json.load(fp)["data"]))
+
+    def test_key_normalization(self):
+        q1 = {"query": {"type": "domain", "class": "fact"}, "limit": 10}
+        q2 = {"query": {"class": "fact", "type": "domain"}, "limit": 500, "resume": "x"}
+        self.assertEqual(CatalogCache.make_key("quolab", q1), CatalogCache.make_key("quolab", q2))
+        self.assertNotEqual(CatalogCache.make_key("quolab", q1), CatalogCache.make_key("other", q1))
+        self.assertEqual(CatalogCache.make_key("quolab", q1, fields=None),
+                         CatalogCache.make_key("quolab", q1))
+        self.assertNotEqual(CatalogCache.make_key("quolab", q1, fields=["id"]),
+                            CatalogCache.make_key("quolab", q1))
+
+    def test_round_trip(self):
+        self.assertIsNone(self.cache.get("k", 10))
+        self.assertEqual(list(self.cache.store("k", iter(make_results(5)), 10)), make_results(5))
+        self.assertEqual(list(self.cache.get("k", 10)), make_results(5))
+        self.assertEqual(list(self.cache.get("k", 3)), make_results(3))
+        self.assertEqual(self.stats.counters["cache_hit"], 2)
+        self.assertEqual(self.stats.counters["cache_miss"], 1)
+
+    def test_incomplete_entry(self):
+        # Limit was reached, so a larger request can't be served from the cache
+        list(self.cache.store("k", iter(make_results(10)), 10))
+        self.assertIsNotNone(self.cache.get("k", 10))
+        self.assertIsNone(self.cache.get("k", 20))
+
+    def test_not_stored_when_invalid_or_abandoned(self):
+        list(self.cache.store("k", iter(make_results(5)), 10, valid=lambda: False))
+        self.assertIsNone(self.cache.get("k", 10))
+        stream = self.cache.store("k", iter(make_results(5)), 10)
+        next(stream)
+        stream.close()
+        self.assertIsNone(self.cache.get("k", 10))
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_replace_entry(self):
+        list(self.cache.store("k", iter(make_results(5)), 10))
+        old = self.data_files()
+        # A reader that has started on the old entry keeps its results
+        reader = self.cache.get("k", 10)
+        self.assertEqual(next(reader), make_results(1)[0])
+
+        stream = self.cache.store("k", iter(make_results(3)), 10)
+        next(stream)
+        # Not committed yet; the meta still describes the old data file
+        self.assertEqual(list(self.cache.get("k", 10)), make_results(5))
+        list(stream)
+        self.assertEqual(list(self.cache.get("k", 10)), make_results(3))
+        # The replaced data file was removed
+        self.assertEqual(len(self.data_files()), 1)
+        self.assertNotEqual(self.data_files(), old)
+        self.assertEqual(len(list(reader)), 4)
+
+    def test_orphaned_data_removed(self):
+        list(self.cache.store("k", iter(make_results(5)), 10))
+        orphan = os.path.join(self.tmpdir, "k.1-1.jsonl")
+        with open(orphan, "w") as fp:
+            fp.write("{}\n")
+        self.cache.evict()
+        self.assertTrue(os.path.exists(orphan))
+        past = time.time() - 120
+        os.utime(orphan, (past, past))
+        self.cache.evict()
+        self.assertFalse(os.path.exists(orphan))
+        self.assertEqual(len(list(self.cache.get("k", 10))), 5)
+
+    def test_ttl(self):
+        list(self.cache.store("k", iter(make_results(5)), 10))
+        self.cache.ttl = -1
+        self.assertIsNone(self.cache.get("k", 10))
+
+    def test_lru_eviction(self):
+        list(self.cache.store("a", iter(make_results(50)), 100))
+        size = self.data_size("a")
+        self.cache.max_bytes = size * 2
+        list(self.cache.store("b", iter(make_results(50)), 100))
+        # Make 'a' the most recently used, so that 'b' is evicted
+        past = time.time() - 10
+        os.utime(os.path.join(self.tmpdir, "b.meta"), (past, past))
+        list(self.cache.store("c", iter(make_results(50)), 100))
+        self.assertIsNotNone(self.cache.get("a", 100))
+        self.assertIsNone(self.cache.get("b", 100))
+        self.assertIsNotNone(self.cache.get("c", 100))
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction_order(self):
+        lru = LRUCache(3)
+        for key in "abc":
+            lru[key] = key.upper()
+        self.assertEqual(lru.get("a"), "A")
+        lru["d"] = "D"
+        self.assertNotIn("b", lru)
+        self.assertEqual(len(lru), 3)
+        self.assertIsNone(lru.get("b"))
+        # Cached negative results are distinguishable from missing keys
+        lru["e"] = None
+        self.assertIn("e", lru)
+        self.assertNotIn("c", lru)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from ta_quolab.checkpoint import EventIdJournal
+from ta_quolab.dedupe import DedupeIndex
+
+
+class TestEventIdJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, keep=100):
+        journal = EventIdJournal(self.directory, "quolab_timeline://test")
+        index = DedupeIndex(keep)
+        journal.load(index)
+        return journal, index
+
+    def test_append_and_load(self):
+        journal, _ = self.load()
+        self.assertFalse(journal.exists())
+        for i in range(5):
+            journal.append("id{}".format(i))
+        journal.flush()
+        journal.append("unflushed")
+        # Simulate a crash:  the unflushed id is lost, nothing else
+        journal2, index = self.load()
+        self.assertEqual(index.to_list(), ["id0", "id1", "id2", "id3", "id4"])
+        self.assertEqual(journal2.lines, 5)
+        self.assertTrue(journal2.path.endswith("quolab_timeline__test.ids"))
+        journal.close()
+
+    def test_incomplete_entry(self):
+        journal, _ = self.load()
+        journal.append("id0")
+        journal.close()
+        with open(journal.path, "a") as fp:
+            fp.write("id1-partial")
+        journal, index = self.load()
+        self.assertEqual(index.to_list(), ["id0"])
+        journal.append("id2")
+        journal.close()
+        journal, index = self.load()
+        self.assertEqual(index.to_list(), ["id0", "id2"])
+
+    def test_compact(self):
+        journal, index = self.load(keep=3)
+        for i in range(7):
+            index.add("id{}".format(i))
+            journal.append("id{}".format(i))
+        self.assertTrue(journal.needs_compaction(3))
+        journal.compact(index.to_list())
+        self.assertFalse(journal.needs_compaction(3))
+        journal.append("id7")
+        journal.close()
+        with open(journal.path) as fp:
+            self.assertEqual(fp.read().split(), ["id4", "id5", "id6", "id7"])
+
+    def test_fsync_policy(self):
+        with self.assertRaises(ValueError):
+            EventIdJournal(self.directory, "x", fsync="sometimes")
+        journal = EventIdJournal(self.directory, "x", fsync="always")
+        journal.append("id0")
+        self.assertEqual(journal.lines, 1)
+        journal.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from ta_quolab.build import build_class_from_type
+from ta_quolab.const import quolab_class_from_type, quolab_classes, quolab_types
+
+
+class TestConst(unittest.TestCase):
+    def test_class_from_type_current(self):
+        """ Precomputed lookup table must match quolab_classes """
+        self.assertEqual(quolab_class_from_type, build_class_from_type())
+        self.assertEqual(quolab_types, set(quolab_class_from_type))
+
+    def test_override(self):
+        self.assertEqual(quolab_class_from_type["text"], "sysfact")
+
+    def test_duplicate_without_override(self):
+        classes = dict(quolab_classes, extra=["domain"])
+        with self.assertRaises(AssertionError):
+            build_class_from_type(classes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import os
+import sys
+import time
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from ta_quolab.deadline import Deadline, DeadlineExceeded
+
+
+class TestDeadline(unittest.TestCase):
+    def test_timeouts_capped(self):
+        d = Deadline(100, connect_timeout=10, read_timeout=60)
+        connect, read = d.timeout()
+        self.assertEqual((connect, read), (10, 60))
+
+    def test_timeouts_shrink_with_budget(self):
+        d = Deadline(5, connect_timeout=10, read_timeout=60)
+        connect, read = d.timeout()
+        self.assertLessEqual(connect, 5)
+        self.assertLessEqual(read, 5)
+
+    def test_expired(self):
+        d = Deadline(0.01)
+        time.sleep(0.02)
+        self.assertTrue(d.expired())
+        self.assertEqual(d.remaining(), 0)
+        self.assertRaises(DeadlineExceeded, d.check)
+        self.assertRaises(DeadlineExceeded, d.timeout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from ta_quolab.dedupe import BloomFilter, DedupeIndex
+
+
+class TestDedupeIndex(unittest.TestCase):
+    def check_eviction(self, prefilter):
+        index = DedupeIndex(3, ["a", "b"], prefilter=prefilter)
+        self.assertIn("a", index)
+        self.assertFalse(index.add("b"))
+        self.assertTrue(index.add("c"))
+        self.assertTrue(index.add("d"))
+        # Oldest id is evicted first
+        self.assertNotIn("a", index)
+        self.assertEqual(index.to_list(), ["b", "c", "d"])
+        self.assertEqual(len(index), 3)
+        self.assertTrue(index.add("a"))
+        self.assertEqual(index.to_list(), ["c", "d", "a"])
+
+    def test_eviction(self):
+        self.check_eviction(False)
+
+    def test_eviction_prefilter(self):
+        self.check_eviction(True)
+
+    def test_extend(self):
+        index = DedupeIndex(3, ["a", "b", "a", "c", "d"])
+        self.assertEqual(index.to_list(), ["b", "c", "d"])
+        self.assertNotIn("a", index)
+        index.extend(["d", "e"])
+        self.assertEqual(index.to_list(), ["c", "d", "e"])
+
+    def test_prefilter_rebuild(self):
+        index = DedupeIndex(100, prefilter=True)
+        for i in range(1000):
+            index.add("event{}".format(i))
+        self.assertEqual(index.to_list()[0], "event900")
+        self.assertNotIn("event899", index)
+        self.assertIn("event999", index)
+        self.assertLessEqual(index._bloom.count, 200)
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_error_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(str(i))
+        self.assertTrue(all(str(i) in bloom for i in range(1000)))
+        false_positives = sum(1 for i in range(1000, 11000) if str(i) in bloom)
+        self.assertLess(false_positives, 300)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import unittest
+from io import StringIO
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from splunklib.modularinput import Event, EventWriter
+from ta_quolab.eventwriter import BatchEventWriter
+
+
+class CountingStringIO(StringIO):
+    flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+        super(CountingStringIO, self).flush()
+
+
+class TestBatchEventWriter(unittest.TestCase):
+    def make_writer(self, **kwargs):
+        out = CountingStringIO()
+        ew = EventWriter(output=out)
+        return BatchEventWriter(ew, **kwargs), ew, out
+
+    def test_serialize_matches_splunklib(self):
+        data = '{"msg": "a < b & c > \\"d\\""}'
+        for kwargs in [{}, {"sourcetype": "quolab:timeline"},
+                       {"sourcetype": "x", "time": "1.500", "stanza": 'in"put'}]:
+            out = StringIO()
+            Event(data=data, unbroken=True, **kwargs).write_to(out)
+            self.assertEqual(BatchEventWriter.serialize(data, **kwargs), out.getvalue())
+
+    def test_flush_on_count(self):
+        writer, ew, out = self.make_writer(max_events=3, max_latency=60)
+        self.assertFalse(writer.write("1"))
+        self.assertFalse(writer.write("2"))
+        self.assertEqual(out.getvalue(), "")
+        self.assertTrue(writer.write("3"))
+        self.assertEqual(out.getvalue().count("<event "), 3)
+        self.assertTrue(out.getvalue().startswith("<stream>"))
+        self.assertEqual(out.flushes, 1)
+        self.assertEqual(writer.counter["batch_flush_events"], 1)
+        ew.close()
+        self.assertTrue(out.getvalue().endswith("</event></stream>"))
+
+    def test_shared_event_writer(self):
+        # Batches and single events written through the same EventWriter
+        # share one <stream> header
+        writer, ew, out = self.make_writer(max_events=2)
+        ew.write_event(Event(data="0", unbroken=True))
+        writer.write("1")
+        writer.write("2")
+        ew.close()
+        self.assertEqual(out.getvalue().count("<stream>"), 1)
+        self.assertEqual(out.getvalue().count("<event "), 3)
+        self.assertTrue(out.getvalue().endswith("</event></stream>"))
+
+    def test_flush_on_bytes(self):
+        writer, ew, out = self.make_writer(max_events=100, max_bytes=100)
+        writer.write("x" * 40)
+        self.assertTrue(writer.write("x" * 40))
+        self.assertEqual(writer.counter["batch_flush_bytes"], 1)
+
+    def test_flush_on_latency(self):
+        writer, ew, out = self.make_writer(max_latency=0.05)
+        self.assertEqual(writer.wait_time(30), 30)
+        writer.write("1")
+        self.assertLessEqual(writer.wait_time(30), 0.05)
+        self.assertFalse(writer.flush_if_due())
+        time.sleep(0.06)
+        self.assertEqual(writer.wait_time(30), 0)
+        self.assertTrue(writer.flush_if_due())
+        self.assertEqual(len(writer), 0)
+        self.assertIn("avg_batch_events=1.0", writer.settings_kv())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from catalog_samples import make_records
+from cypresspoint.spath import splunk_dot_notation
+from ta_quolab.flatten import Flattener, build_projection, projection_covers
+
+
+class TestFlattener(unittest.TestCase):
+    def assertSameAsSpath(self, flattener, record):
+        expected = splunk_dot_notation(record)
+        actual = flattener.flatten(record)
+        self.assertEqual(actual, expected)
+        self.assertEqual(list(actual), list(expected))
+
+    def test_catalog_records(self):
+        flattener = Flattener()
+        for record in make_records(50, facets=("display", "refcount", "tagged", "document")):
+            self.assertSameAsSpath(flattener, record)
+
+    def test_edge_cases(self):
+        flattener = Flattener()
+        records = [
+            {"a b": {"c:d": 1}, "_x_": True, "e": None, "f": 1.5},
+            {"list": [[1, 2], [3]], "empty": {}, "none": [], "mixed": [{"a": 1}, 2, {"a": False}]},
+            {"": {"x": "y"}, "dup": [{"v": 1}, {"v": 2}, {"v": 3}]},
+            {"a b": "now a scalar", "e": {"now": "a dict"}},
+        ]
+        for record in records:
+            self.assertSameAsSpath(flattener, record)
+
+    def test_bounded(self):
+        flattener = Flattener(max_paths=10)
+        for n in range(20):
+            record = {"class": "fact", "type": "t{}".format(n % 3), "k{}".format(n): {"x": n}}
+            self.assertSameAsSpath(flattener, record)
+            self.assertLessEqual(flattener._paths, 10)
+
+    def test_projection(self):
+        fields = ["id", "display.label", "tagged{}.name", "document.*"]
+        flattener = Flattener(projection=build_projection(fields))
+        for record in make_records(20, facets=("display", "refcount", "tagged", "document")):
+            expected = {k: v for k, v in splunk_dot_notation(record).items()
+                        if k in ("id", "display.label", "tagged{}.name")
+                        or k.startswith("document.")}
+            # Run twice to use the compiled (cached) paths
+            self.assertEqual(flattener.flatten(record), expected)
+            self.assertEqual(flattener.flatten(record), expected)
+
+    def test_build_projection(self):
+        tree = build_projection(["document", "document.name", "a.b.c", "a.b.d", "x{}.y"])
+        self.assertEqual(tree, {"document": None, "a": {"b": {"c": None, "d": None}},
+                                "x": {"y": None}})
+        self.assertTrue(projection_covers(tree, "document.magic"))
+        self.assertTrue(projection_covers(tree, "a"))
+        self.assertFalse(projection_covers(tree, "a.c"))
+        self.assertFalse(projection_covers(tree, "refcount"))
+
+    def test_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            Flattener().flatten({"a": object()})
+        with self.assertRaises(ValueError):
+            Flattener().flatten(["a"])
+
+
+if __name__ == '__main__':
+    unittest.main()
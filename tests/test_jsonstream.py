@@ -0,0 +1,107 @@
+import json
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from ta_quolab.jsonstream import (JSONRecordStream, TruncatedResponse, append_fields,
+                                  decode_object_spans)
+
+
+def chunked(doc, size):
+    data = doc.encode("utf-8")
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestJSONRecordStream(unittest.TestCase):
+    body = {
+        "status": "OK",
+        "records": [
+            {"id": "a", "document": {"name": "café ☃", "n": 12345, "tags": ["x", "y"]}},
+            {"id": "b", "document": {"escaped": "quote \" brace } [", "f": 1.5e3, "b": True}},
+            {"id": "c", "document": None},
+        ],
+        "ellipsis": "abc123",
+        "count": 123456789,
+    }
+
+    def parse(self, doc, size):
+        stream = JSONRecordStream(chunked(doc, size))
+        records = list(stream)
+        return stream, records
+
+    def test_all_chunk_sizes(self):
+        doc = json.dumps(self.body, indent=2)
+        for size in (1, 2, 3, 7, 64, 100000):
+            stream, records = self.parse(doc, size)
+            self.assertEqual(records, self.body["records"], "chunk size {}".format(size))
+            self.assertEqual(stream.meta, {"status": "OK", "ellipsis": "abc123",
+                                           "count": 123456789})
+            self.assertEqual(stream.count, 3)
+            self.assertTrue(stream.complete)
+
+    def test_records_before_completion(self):
+        # First record is available before the rest of the document arrives
+        doc = json.dumps(self.body)
+        chunks = iter(chunked(doc, 10))
+        stream = JSONRecordStream(chunks)
+        stream.min_fill = 1
+        first = next(iter(stream))
+        self.assertEqual(first["id"], "a")
+        self.assertTrue(len(list(chunks)) > 0)
+
+    def test_empty(self):
+        stream, records = self.parse('{"status": "OK", "records": []}', 4)
+        self.assertEqual(records, [])
+        self.assertEqual(stream.meta, {"status": "OK"})
+        stream, records = self.parse('{}', 4)
+        self.assertEqual(records, [])
+
+    def test_null_records(self):
+        stream, records = self.parse('{"records": null, "status": "OK"}', 4)
+        self.assertEqual(records, [])
+        self.assertEqual(stream.meta, {"records": None, "status": "OK"})
+
+    def test_truncated(self):
+        doc = json.dumps(self.body)
+        for end in range(1, len(doc)):
+            with self.assertRaises(TruncatedResponse):
+                self.parse(doc[:end], 16)
+
+    def test_invalid(self):
+        for doc in ('<html></html>', '{"records": [1, x]}', '{"a": 1 "b": 2}'):
+            with self.assertRaises(ValueError) as cm:
+                self.parse(doc, 4)
+            self.assertNotIsInstance(cm.exception, TruncatedResponse)
+
+    def test_raw_text(self):
+        doc = json.dumps(self.body, indent=2)
+        for size in (1, 5, 100000):
+            stream = JSONRecordStream(chunked(doc, size), raw=True)
+            pairs = list(stream)
+            self.assertEqual([record for record, _ in pairs], self.body["records"])
+            for record, raw in pairs:
+                self.assertIn(raw, doc)
+                self.assertEqual(json.loads(raw), record)
+
+
+class TestObjectHelpers(unittest.TestCase):
+    def test_decode_object_spans(self):
+        msg = '{ "name" : "event", "body": {"id": "x", "n": [1, 2]} , "cid":"c1"}'
+        spans = decode_object_spans(msg)
+        self.assertEqual(spans["name"], ("event", '"event"'))
+        self.assertEqual(spans["body"], ({"id": "x", "n": [1, 2]}, '{"id": "x", "n": [1, 2]}'))
+        self.assertEqual(spans["cid"][0], "c1")
+        self.assertEqual(decode_object_spans(b" {} "), {})
+        with self.assertRaises(ValueError):
+            decode_object_spans('{"a": 1 "b": 2}')
+
+    def test_append_fields(self):
+        self.assertEqual(append_fields('{"a": 1}', {"TA": "x"}), '{"a": 1,"TA":"x"}')
+        self.assertEqual(append_fields('{ }', {"TA": 1}), '{"TA":1}')
+        self.assertEqual(append_fields('{"a": "{"}\n', {"b": None}), '{"a": "{","b":null}')
+        self.assertEqual(append_fields('{"a": 1}', {}), '{"a": 1}')
+
+
+if __name__ == '__main__':
+    unittest.main()
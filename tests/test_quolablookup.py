@@ -0,0 +1,91 @@
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+import quolab_lookup
+from mock_quolab import MockQuoLabServer
+from ta_quolab.api import QuoLabAPI
+from ta_quolab.cache import LRUCache
+
+
+def host(n):
+    return "host{:06d}.example.com".format(n)
+
+
+class TestQuoLabLookupCommand(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = MockQuoLabServer(records=100, facets=("display", "refcount")).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        del self.server.requests[:]
+
+    def make_command(self, **options):
+        command = quolab_lookup.QuoLabLookupCommand()
+        command.quolab_api = QuoLabAPI(self.server.url)
+        command.quolab_api.login_token("secret")
+        command.api_timeout = 30
+        command.api_fetch_count = 100
+        command.api_id_batch_size = 3
+        command.api_max_concurrency = 2
+        command.lookup_cache = LRUCache(100)
+        command.type = "domain"
+        command.field = "query"
+        command.prefix = "quolab."
+        for name, value in options.items():
+            setattr(command, name, value)
+        return command
+
+    def test_enrich_batched(self):
+        command = self.make_command(fields=["display.label"])
+        events = [{"query": host(n % 5)} for n in range(20)]
+        events.append({"query": host(500)})
+        events.append({"other": "no value"})
+        events.append({"query": [host(1), host(2)]})
+        output = list(command.stream(events))
+
+        self.assertEqual(len(output), 23)
+        self.assertEqual(output[0]["quolab.id"], host(0))
+        self.assertEqual(output[0]["quolab.display.label"], host(0))
+        self.assertNotIn("quolab._raw", output[0])
+        self.assertNotIn("quolab.refcount.fact", output[0])
+        self.assertNotIn("quolab.id", output[20])
+        self.assertNotIn("quolab.id", output[21])
+        self.assertEqual(output[22]["quolab.id"], [host(1), host(2)])
+        # 6 distinct values in batches of 3
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[0]["facets"], {"display": 1})
+
+    def test_cache_across_chunks(self):
+        command = self.make_command(prefix="ql_")
+        list(command.stream([{"query": host(1)}, {"query": host(999)}]))
+        output = list(command.stream([{"query": host(1)}, {"query": host(999)},
+                                      {"query": host(2)}]))
+        self.assertEqual(output[0]["ql_id"], host(1))
+        self.assertNotIn("ql_id", output[1])
+        # Only host(2) was queried for the second chunk; unknown ids are cached too
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[1]["query"]["id"], [host(2)])
+        self.assertEqual(command.lookup_stats.counters["cache_hits"], 2)
+
+    def test_batch_spans_pages(self):
+        # Adaptive paging starts below the id batch size, so each batch is resumed
+        command = self.make_command(api_fetch_count=200, api_min_fetch_count=50,
+                                    api_id_batch_size=200)
+        events = [{"query": host(n)} for n in range(100)]
+        output = list(command.stream(events))
+        self.assertEqual([e["quolab.id"] for e in output], [host(n) for n in range(100)])
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[1]["resume"], "50")
+        for query in self.server.requests:
+            self.assertEqual(query["order"], [["id", "ascending"]])
+        self.assertEqual(command.lookup_stats.counters["found"], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
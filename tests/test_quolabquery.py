@@ -1,10 +1,18 @@
 import unittest
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
 
 
 import quolab_query
+from splunklib.searchcommands.internals import ObjectView
+from ta_quolab.cache import CatalogCache
+from ta_quolab.searchcommand import apply_projection
+from ta_quolab.stats import QueryStats
 
 # COOKIECUTTER-TODO: Fill in unit tests logic, as required.  Remove default tests
 
@@ -32,5 +40,153 @@ class TestQuoLabQueryCommand(unittest.TestCase):
         os.listdir(os.environ["SPLUNK_HOME"])
 
 
+class TestFieldProjection(unittest.TestCase):
+    def make_command(self, search, raw_args):
+        command = quolab_query.QuoLabQueryCommand()
+        command._metadata = ObjectView({"searchinfo": ObjectView({
+            "sid": "1234.5", "search": search, "raw_args": raw_args})})
+        return command
+
+    def test_split_pipeline(self):
+        split = quolab_query.QuoLabQueryCommand._split_pipeline
+        self.assertEqual(split('| quolabquery query="{\'a\': \'x|y\'}" | table id'),
+                         ["", 'quolabquery query="{\'a\': \'x|y\'}"', "table id"])
+        self.assertEqual(split("search [| inputlookup a | fields id] | stats count"),
+                         ["search [| inputlookup a | fields id]", "stats count"])
+
+    def test_fields_from_search(self):
+        for search, expected in [
+            ("| quolabquery type=domain | table id, type document.name",
+             ["id", "type", "document.name"]),
+            ("| quolabquery type=domain | fields + id", ["id", "_raw"]),
+            ("| quolabquery type=domain | fields - id", None),
+            ("| quolabquery type=domain | table doc*", None),
+            ("| quolabquery type=domain | stats count by id", None),
+            ("| quolabquery type=domain", None),
+            ("| quolabquery type=url | table id", None),
+        ]:
+            command = self.make_command(search, ["type=domain"])
+            self.assertEqual(command._fields_from_search(), expected, search)
+
+    def test_apply_projection(self):
+        query = {"query": {}, "facets": {"display": 1, "tagged": 1}}
+        apply_projection(query, ["id", "display.label", "refcount"])
+        self.assertEqual(query["facets"], {"display": 1, "refcount": 1})
+        query = {"query": {}, "facets": {"display": 1}}
+        apply_projection(query, ["id"])
+        self.assertNotIn("facets", query)
+
+
+class TestTimeRange(unittest.TestCase):
+    def make_command(self, earliest, latest, time_field="document.last"):
+        command = quolab_query.QuoLabQueryCommand()
+        command._metadata = ObjectView({"searchinfo": ObjectView({
+            "sid": "1234.5", "earliest_time": earliest, "latest_time": latest})})
+        command.time_field = time_field
+        command.order = []
+        return command
+
+    def test_search_time_range(self):
+        command = self.make_command("1700000000.000", "0")
+        self.assertEqual(command._search_time_range(), (1700000000.0, None))
+        command = self.make_command("", None)
+        self.assertEqual(command._search_time_range(), (None, None))
+
+    def test_time_order(self):
+        query = {"query": {}}
+        self.assertTrue(self.make_command(0, 0)._time_order_to_dict(query))
+        self.assertEqual(query["documents"]["order"], [["last", "descending"]])
+        query = {"query": {}}
+        self.assertFalse(self.make_command(0, 0, "refcount.total")._time_order_to_dict(query))
+        self.assertEqual(query, {"query": {}})
+
+
+class TestCount(unittest.TestCase):
+    def make_command(self, by):
+        command = quolab_query.QuoLabQueryCommand()
+        command.by = by
+        return command
+
+    def test_count_results(self):
+        results = [{"type": "domain", "tag": ["a", "b"]},
+                   {"type": "domain", "tag": "a"},
+                   {"type": "url"}]
+        self.assertEqual(self.make_command(None)._count_results(results), [{"count": 3}])
+        self.assertEqual(self.make_command(None)._count_results([]), [{"count": 0}])
+        self.assertEqual(self.make_command(["type"])._count_results(results),
+                         [{"type": "domain", "count": 2}, {"type": "url", "count": 1}])
+        self.assertEqual(self.make_command(["type", "tag"])._count_results(results),
+                         [{"type": "domain", "tag": "a", "count": 2},
+                          {"type": "domain", "tag": "b", "count": 1},
+                          {"type": "url", "count": 1}])
+
+    def test_count_limit(self):
+        warnings = []
+        command = self.make_command(["type"])
+        command.api_max_count = 2
+        command.server = "main"
+        command.query_stats = QueryStats()
+        command.write_warning = lambda *args: warnings.append(args)
+
+        def query_catalog_api(query, query_limit):
+            return iter([{"type": "domain"}, {"type": "url"}, {"type": "url"}][:query_limit])
+        command._query_catalog_api = query_catalog_api
+
+        self.assertEqual(command._count_catalog({}),
+                         [{"type": "domain", "count": 1}, {"type": "url", "count": 1}])
+        self.assertEqual(len(warnings), 1)
+        command.api_max_count = 3
+        command.query_stats = QueryStats()
+        self.assertEqual(command._count_catalog({}),
+                         [{"type": "url", "count": 2}, {"type": "domain", "count": 1}])
+        self.assertEqual(len(warnings), 1)
+
+
+class TestCachedTime(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_time_set_on_emit(self):
+        cache = CatalogCache(self.directory, 60, 1024 * 1024)
+        stamp = quolab_query.QuoLabQueryCommand._stamp_time
+        list(stamp(cache.store("key", iter([{"id": "a"}, {"id": "b", "_time": 5.0}]), 10)))
+        before = time.time()
+        results = list(stamp(cache.get("key", 10)))
+        # Not the time the entry was stored
+        self.assertGreaterEqual(results[0]["_time"], before)
+        self.assertEqual(results[1]["_time"], 5.0)
+
+
+class TestStartup(unittest.TestCase):
+    """ Guard the cold start time of quolabquery.  See bench_startup.py for timings """
+    bin_dir = os.path.join(os.path.dirname(__file__), "..", "bin")
+
+    def run_python(self, code):
+        return subprocess.check_output([sys.executable, "-c", code], cwd=self.bin_dir,
+                                       universal_newlines=True)
+
+    def test_import_skips_http_stack(self):
+        output = self.run_python("import sys, quolab_query; "
+                                 "print(sorted(m for m in ('requests', 'ta_quolab.api', "
+                                 "'ta_quolab.transport') if m in sys.modules))")
+        self.assertEqual(output.strip(), "[]")
+
+    def test_parse_only_prepare(self):
+        output = self.run_python(
+            "import sys, quolab_query\n"
+            "from splunklib.searchcommands.internals import ObjectView\n"
+            "command = quolab_query.QuoLabQueryCommand()\n"
+            "searchinfo = ObjectView({'sid': 'searchparsetmp_1'})\n"
+            "command._metadata = ObjectView({'searchinfo': searchinfo})\n"
+            "command._fieldnames = []\n"
+            "command.type = 'domain'\n"
+            "command.prepare()\n"
+            "print(command.mode, 'requests' in sys.modules)\n")
+        self.assertEqual(output.strip(), "simple False")
+
+
 if __name__ == '__main__':
     unittest.main()
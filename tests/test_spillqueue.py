@@ -0,0 +1,108 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from queue import Empty
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from ta_quolab.spillqueue import SpillQueue
+
+
+def item(n):
+    return ("websocket", "id{}".format(n), '{{"id": "id{}", "text": "line\\nbreak"}}'.format(n))
+
+
+class TestSpillQueue(unittest.TestCase):
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+    def segments(self):
+        return sorted(os.listdir(self.spill_dir))
+
+    def drain(self, q):
+        items = []
+        while True:
+            try:
+                items.append(q.get_nowait())
+            except Empty:
+                return items
+
+    def test_spill_in_order(self):
+        counter = {}
+        q = SpillQueue(3, self.spill_dir, "quolab_timeline://tl1", counter=counter)
+        q.segment_bytes = 200
+        for n in range(10):
+            q.put(item(n))
+        self.assertEqual(q.qsize(), 10)
+        self.assertEqual(counter["spill_events"], 7)
+        self.assertGreater(len(self.segments()), 1)
+        self.assertEqual(q.get(), item(0))
+        # Once spilling, new items go after the spilled ones
+        q.put(item(10))
+        self.assertEqual(self.drain(q), [item(n) for n in range(1, 11)])
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(counter["spill_read_events"], 8)
+        self.assertIn("queue_depth=0", q.stats_kv())
+
+        # Back to memory only
+        q.put(item(11))
+        self.assertEqual(counter["spill_events"], 8)
+        self.assertEqual(q.get(timeout=1), item(11))
+        with self.assertRaises(Empty):
+            q.get(timeout=0.01)
+
+    def test_recover(self):
+        q = SpillQueue(2, self.spill_dir, "quolab_timeline://tl1")
+        for n in range(5):
+            q.put(item(n))
+        q.close()
+        with open(os.path.join(self.spill_dir, self.segments()[-1]), "a") as fp:
+            fp.write('[0, "websocket", "torn')
+
+        counter = {}
+        q = SpillQueue(2, self.spill_dir, "quolab_timeline://tl1", counter=counter)
+        self.assertEqual(q.qsize(), 3)
+        q.put(item(5))
+        self.assertEqual(self.drain(q), [item(2), item(3), item(4), item(5)])
+        self.assertEqual(self.segments(), [])
+        # Latency is only measured for items spilled by this process
+        self.assertEqual(counter["spill_read_events"], 1)
+        # Other inputs' segments are left alone
+        SpillQueue(1, self.spill_dir, "quolab_timeline://tl2").put(item(0))
+        SpillQueue(1, self.spill_dir, "quolab_timeline://tl2").put(item(1))
+        self.assertEqual(SpillQueue(1, self.spill_dir, "quolab_timeline://tl1").qsize(), 0)
+
+    def test_spill_limit(self):
+        q = SpillQueue(1, self.spill_dir, "x", max_spill_bytes=1)
+        q.put(item(0))
+        q.put(item(1))
+        t = threading.Thread(target=q.put, args=(item(2),))
+        t.start()
+        t.join(0.1)
+        self.assertTrue(t.is_alive())
+        self.assertEqual(q.get(), item(0))
+        self.assertEqual(q.get(), item(1))
+        t.join(5)
+        self.assertEqual(q.get(), item(2))
+        self.assertEqual(q.counter["spill_blocked"], 1)
+
+    def test_no_spill(self):
+        q = SpillQueue(1, self.spill_dir, "x", max_spill_bytes=0)
+        q.put(item(0))
+        t = threading.Thread(target=q.put, args=(item(1),))
+        t.start()
+        t.join(0.1)
+        self.assertTrue(t.is_alive())
+        self.assertEqual(q.get(), item(0))
+        t.join(5)
+        self.assertEqual(q.get(), item(1))
+        self.assertEqual(self.segments(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from ta_quolab.stats import QueryStats, time_consumer, time_producer
+
+
+def slow_range(n, delay):
+    for i in range(n):
+        time.sleep(delay)
+        yield i
+
+
+class TestQueryStats(unittest.TestCase):
+    def test_to_kv(self):
+        stats = QueryStats()
+        stats.incr("pages", 2)
+        stats.add_time("parse", 0.25)
+        stats.add_time("parse", 0.5)
+        self.assertEqual(stats.to_kv(), "pages=2 parse=0.750")
+
+    def test_merge(self):
+        a, b = QueryStats(), QueryStats()
+        a.incr("records", 3)
+        b.incr("records", 4)
+        b.add_time("flatten", 1.0)
+        a.merge(b)
+        self.assertEqual(a.counters["records"], 7)
+        self.assertEqual(a.timers["flatten"], 1.0)
+
+    def test_time_producer(self):
+        stats = QueryStats()
+        output = []
+        for i in time_producer(slow_range(3, 0.01), stats, "fetch"):
+            time.sleep(0.02)
+            output.append(i)
+        self.assertEqual(output, [0, 1, 2])
+        self.assertGreaterEqual(stats.timers["fetch"], 0.03)
+        self.assertLess(stats.timers["fetch"], 0.06)
+
+    def test_time_consumer(self):
+        stats = QueryStats()
+        for i in time_consumer(slow_range(3, 0.01), stats, "emit"):
+            time.sleep(0.02)
+        self.assertGreaterEqual(stats.timers["emit"], 0.06)
+        self.assertLess(stats.timers["emit"], 0.09)
+
+    def test_time_consumer_closed_early(self):
+        stats = QueryStats()
+        gen = time_consumer(range(10), stats, "emit")
+        next(gen)
+        gen.close()
+        self.assertIn("emit", stats.timers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,257 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from collections import OrderedDict
+from io import StringIO
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+if "SPLUNK_HOME" not in os.environ:
+    # quolab_timeline sets up its log file on import
+    os.environ["SPLUNK_HOME"] = tempfile.mkdtemp()
+    os.makedirs(os.path.join(os.environ["SPLUNK_HOME"], "var", "log", "splunk"))
+
+import quolab_timeline  # noqa
+from mock_quolab import MockTimelineSocket  # noqa
+from splunklib.modularinput import EventWriter  # noqa
+from ta_quolab.api import QuoLabAPI  # noqa
+
+
+def make_item(timeline, **kwargs):
+    item = {"__app": "TA-quolab", "server": "quolab", "timeline": timeline,
+            "backfill": "1", "log_level": "INFO", "batch_max_latency": "0.01"}
+    item.update(kwargs)
+    return item
+
+
+def raw_event(event_id):
+    return '{{"id": "{}", "type": "test"}}'.format(event_id)
+
+
+class FakeTimelineAPI(object):
+    """ Serves a fixed timeline buffer of (id, timestamp) events """
+
+    url = "http://quolab.example"
+
+    def __init__(self, events):
+        self.events = events
+        self.calls = 0
+
+    def get_timeline_events(self, timeline_id, facets=None, raw=False, cursor=None):
+        self.calls += 1
+        for event_id, timestamp in self.events:
+            body = {"id": event_id, "type": "test", "timestamp": timestamp}
+            yield body, raw_event(event_id)
+
+
+class TestTimelineInput(unittest.TestCase):
+    def setUp(self):
+        self.checkpoint_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        quolab_timeline.shutdown.clear()
+        shutil.rmtree(self.checkpoint_dir)
+
+    def make_input(self, timeline):
+        ti = quolab_timeline.TimelineInput("quolab_timeline://" + timeline,
+                                           make_item(timeline), self.checkpoint_dir)
+        ti.maint_interval = 0.05
+        ti.open_checkpoint()
+        return ti
+
+    def wait_for(self, condition, timeout=5):
+        end = time.time() + timeout
+        while not condition() and time.time() < end:
+            time.sleep(0.01)
+
+    def test_multiple_inputs(self):
+        out = StringIO()
+        ew = EventWriter(output=out)
+        lock = threading.Lock()
+        inputs = [self.make_input("tl1"), self.make_input("tl2")]
+        for n, ti in enumerate(inputs):
+            for i in range(20):
+                ti.put_event_queue({"body": {"id": "{}-{}".format(n, i)}}, raw_event(i))
+            # Duplicate from the backfill
+            ti.queue.put(("backfill", "{}-0".format(n), raw_event(0)))
+        threads = [threading.Thread(target=ti.ingest, args=(ew, lock)) for ti in inputs]
+        for t in threads:
+            t.start()
+        self.wait_for(lambda: all(ti.counter["events_ingested"] == 20 for ti in inputs))
+        quolab_timeline.shutdown.set()
+        for t in threads:
+            t.join(5)
+
+        output = out.getvalue()
+        self.assertEqual(output.count("<event "), 40)
+        self.assertEqual(output.count('stanza="quolab_timeline://tl1"'), 20)
+        self.assertEqual(output.count('stanza="quolab_timeline://tl2"'), 20)
+        for ti in inputs:
+            self.assertEqual(ti.counter["backfill_skipped"], 1)
+
+        # Ids were saved per input
+        ti = self.make_input("tl2")
+        self.assertEqual(len(ti.known_ids), 20)
+        self.assertIn("1-19", ti.known_ids)
+        self.assertTrue(ti.load_from_buffer)
+
+    def test_failed_write_not_journaled(self):
+        class BrokenOutput(StringIO):
+            def flush(self):
+                raise IOError("Broken pipe")
+
+        ti = quolab_timeline.TimelineInput("quolab_timeline://tl1",
+                                           make_item("tl1", checkpoint_fsync="always"),
+                                           self.checkpoint_dir)
+        ti.open_checkpoint()
+        ti.put_event_queue({"body": {"id": "e1"}}, raw_event("e1"))
+        with self.assertRaises(IOError):
+            ti.ingest(EventWriter(output=BrokenOutput()))
+        journaled = []
+        ti.journal.load(journaled)
+        self.assertNotIn("e1", journaled)
+
+    def test_first_run_without_backfill(self):
+        ti = quolab_timeline.TimelineInput("quolab_timeline://x", make_item("x", backfill="0"),
+                                           self.checkpoint_dir)
+        ti.open_checkpoint()
+        self.assertFalse(ti.load_from_buffer)
+
+    def test_out_of_band(self):
+        ti = self.make_input("tl1")
+        ti.out_of_band("bound", {"cid": "activity-stream-event-tl1"})
+        self.assertTrue(ti.subscribed.is_set())
+        ti.out_of_band("close")
+        self.assertFalse(ti.subscribed.is_set())
+        # The websocket is reopened in-process, rather than by Splunk
+        self.assertFalse(quolab_timeline.shutdown.is_set())
+
+    def test_gap_backfill(self):
+        ti = self.make_input("tl1")
+        ti.gap_overlap = 10
+        ti.last_event_time = 1000.0
+        ti.api = FakeTimelineAPI([("e{}".format(n), 1000 + n * 10) for n in range(10)])
+        ti.out_of_band("bound", {})
+        ti.put_event_queue({"body": {"id": "e5", "timestamp": 1050}}, raw_event("e5"))
+        ti.known_ids.add(ti.queue.get()[1])
+        self.assertEqual(ti.last_event_time, 1050)
+        self.assertEqual(ti.api.calls, 0)
+
+        ti.out_of_band("close")
+        ti.out_of_band("bound", {})
+        self.wait_for(lambda: ti.counter["gap_backfill_queued"] == 5)
+        queued = [ti.queue.get_nowait() for _ in range(ti.queue.qsize())]
+        self.assertEqual([(source, event_id) for source, event_id, _ in queued],
+                         [("gap_backfill", "e4"), ("gap_backfill", "e6"),
+                          ("gap_backfill", "e7"), ("gap_backfill", "e8"),
+                          ("gap_backfill", "e9")])
+        self.assertEqual(ti.counter["gap_backfill_older"], 4)
+        self.assertEqual(ti.counter["gap_backfill_skipped"], 1)
+
+    def test_reader_stops_with_ingest(self):
+        class FakeSocket(object):
+            def __init__(self):
+                self.is_done = threading.Event()
+                self.closed = False
+
+            def close(self):
+                self.closed = True
+
+        class FakeAPI(object):
+            url = "http://quolab.example"
+
+            def __init__(self):
+                self.sockets = []
+
+            def subscribe_timelines(self, bindings, engine="thread"):
+                self.sockets.append(FakeSocket())
+                return self.sockets[-1]
+
+        inputs = [self.make_input("tl1"), self.make_input("tl2")]
+        for ti in inputs:
+            ti.ingest_thread = threading.Thread(target=time.sleep, args=(0.1,))
+            ti.ingest_thread.start()
+        api = FakeAPI()
+        reader = threading.Thread(target=quolab_timeline.QuoLabTimelineModularInput
+                                  .websocket_reader, args=(api, inputs))
+        reader.start()
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(len(api.sockets), 1)
+        self.assertTrue(api.sockets[0].closed)
+        self.assertFalse(quolab_timeline.shutdown.is_set())
+
+    def test_duplicate_timeline(self):
+        class Inputs(object):
+            inputs = OrderedDict([
+                ("quolab_timeline://a", make_item("tl1")),
+                ("quolab_timeline://b", make_item("tl1")),
+                ("quolab_timeline://c", make_item("tl1", websocket_engine="asyncio")),
+                ("quolab_timeline://d", make_item("tl2")),
+            ])
+
+        modinput = quolab_timeline.QuoLabTimelineModularInput()
+        modinput.connect_server = lambda server_name: FakeTimelineAPI([])
+        with self.assertLogs(quolab_timeline.logger, "ERROR") as logs:
+            groups = modinput.group_inputs(Inputs(), self.checkpoint_dir)
+        # The second input for tl1 on the same websocket is skipped
+        self.assertEqual([[ti.name for ti in tis] for tis in groups.values()],
+                         [["quolab_timeline://a", "quolab_timeline://d"],
+                          ["quolab_timeline://c"]])
+        self.assertIn('input_name="quolab_timeline://b"', logs.output[0])
+
+
+class TestReconnect(unittest.TestCase):
+    def setUp(self):
+        self.checkpoint_dir = tempfile.mkdtemp()
+        self.server = MockTimelineSocket(events=5).start()
+        self.modinput = quolab_timeline.QuoLabTimelineModularInput
+        self.modinput.reconnect_delay = 0.01
+
+    def tearDown(self):
+        quolab_timeline.shutdown.set()
+        self.server.stop()
+        del self.modinput.reconnect_delay
+        quolab_timeline.shutdown.clear()
+        shutil.rmtree(self.checkpoint_dir)
+
+    def test_reconnect(self):
+        ti = quolab_timeline.TimelineInput("quolab_timeline://tl1", make_item("tl1"),
+                                           self.checkpoint_dir)
+        ti.open_checkpoint()
+        now = time.time()
+        ti.api = FakeTimelineAPI([("old", now - 3600), ("missed", now + 1)])
+        out = StringIO()
+        ingest = threading.Thread(target=ti.ingest, args=(EventWriter(output=out),))
+        ingest.start()
+        api = QuoLabAPI(self.server.url)
+        api.login_token("secret")
+        reader = threading.Thread(target=self.modinput.websocket_reader,
+                                  args=(api, [ti], "asyncio"))
+        reader.start()
+        end = time.time() + 5
+        while ti.counter["events_ingested"] < 5 and time.time() < end:
+            time.sleep(0.01)
+
+        self.server.disconnect()
+        while ti.counter["gap_backfill_ingested"] < 1 and time.time() < end + 5:
+            time.sleep(0.01)
+        quolab_timeline.shutdown.set()
+        reader.join(5)
+        ingest.join(5)
+
+        self.assertEqual(len(self.server.binds), 2)
+        self.assertEqual(ti.bound_count, 2)
+        self.assertEqual(ti.counter["websocket_reconnects"], 1)
+        # Events resent after rebinding were known; only the missed one was added
+        self.assertEqual(ti.counter["websocket_skipped"], 5)
+        self.assertEqual(ti.counter["gap_backfill_older"], 1)
+        self.assertEqual(ti.counter["events_ingested"], 6)
+        self.assertIn("missed", out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
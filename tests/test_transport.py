@@ -0,0 +1,78 @@
+import gzip
+import io
+import os
+import socket
+import sys
+import unittest
+import zlib
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bin"))  # noqa
+
+from ta_quolab.api import QuoLabAPI
+from ta_quolab.stats import QueryStats
+from ta_quolab.transport import build_socket_options, iter_response_chunks, transport_options
+
+
+class FakeRaw(object):
+    def __init__(self, content):
+        self._fp = io.BytesIO(content)
+
+    def read(self, amt=None, decode_content=None):
+        assert decode_content is False
+        return self._fp.read(amt)
+
+
+class FakeResponse(object):
+    def __init__(self, content, encoding=None):
+        self.raw = FakeRaw(content)
+        self.headers = {"content-encoding": encoding} if encoding else {}
+
+
+class TestTransport(unittest.TestCase):
+    payload = b'{"status": "OK", "records": [' + b",".join([b'{"id": "abc"}'] * 5000) + b']}'
+
+    def read_all(self, content, encoding):
+        stats = QueryStats()
+        data = b"".join(iter_response_chunks(FakeResponse(content, encoding), 1024, stats))
+        return data, stats
+
+    def test_identity(self):
+        data, stats = self.read_all(self.payload, None)
+        self.assertEqual(data, self.payload)
+        self.assertEqual(stats.counters["wire_bytes"], len(self.payload))
+
+    def test_gzip(self):
+        compressed = gzip.compress(self.payload)
+        data, stats = self.read_all(compressed, "gzip")
+        self.assertEqual(data, self.payload)
+        self.assertEqual(stats.counters["wire_bytes"], len(compressed))
+        self.assertLess(len(compressed), len(self.payload))
+        self.assertIn("decompress", stats.timers)
+
+    def test_deflate(self):
+        self.assertEqual(self.read_all(zlib.compress(self.payload), "deflate")[0], self.payload)
+        raw_deflate = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        content = raw_deflate.compress(self.payload) + raw_deflate.flush()
+        self.assertEqual(self.read_all(content, "deflate")[0], self.payload)
+
+    def test_transport_options(self):
+        conf = {"http_pool_maxsize": "20", "http_compression": "false", "tcp_keepalive": "1",
+                "url": "https://example"}
+        self.assertEqual(transport_options(conf),
+                         {"pool_maxsize": 20, "compression": False, "tcp_keepalive": True})
+
+    def test_socket_options(self):
+        options = build_socket_options(tcp_nodelay=False, tcp_keepalive=True)
+        self.assertNotIn((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1), options)
+        self.assertIn((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1), options)
+
+    def test_configure_transport(self):
+        api = QuoLabAPI("https://quolab.example")
+        api.configure_transport(pool_maxsize=32, compression=False, keep_alive=False)
+        adapter = api.session.get_adapter("https://quolab.example/v1/catalog/query")
+        self.assertEqual(adapter._pool_maxsize, 32)
+        self.assertEqual(api.session.headers["Accept-Encoding"], "identity")
+        self.assertEqual(api.session.headers["Connection"], "close")
+
+
+if __name__ == '__main__':
+    unittest.main()